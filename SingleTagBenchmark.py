@@ -0,0 +1,478 @@
+##################
+### BACKGROUND ###
+##################
+
+# Benchmark for SingleTagDecombinator.py, to track its speed and accuracy between versions.
+# Synthesises FASTQ reads from the same V and J FASTA and tag files that Decombinator uses (found or downloaded as import_tcr_info does),
+# keeping a ground truth file of the rearrangement each read came from. SingleTagDecombinator is then run on each file, reporting
+# reads per second, peak memory use and how many of the rearrangements it assigned correctly, so a speed-up that loses sensitivity shows.
+
+# Each synthetic rearrangement joins a V gene (with some 3' deletions) to a J gene (with some 5' deletions) through a random insert.
+# A read is a window of it covering the V tag or the J tag (or both, if the read is long enough), along with the end of that gene next
+# to the insert where the read is long enough; a fraction of the reads are random sequence instead. Reads can then be given substitution errors, be reverse complemented, have a random barcode added to their start,
+# or be repeats of earlier reads. The same settings and seed always give the same reads.
+
+##################
+###### INPUT #####
+##################
+
+# python SingleTagBenchmark.py -c "a b"
+  # Generates (unless already generated by an earlier run) and decombines synthetic files of each of the --sizes given.
+# python SingleTagBenchmark.py -c "a b" -sz 1e7 -np 8
+  # Any flags that are not benchmark flags are passed on to SingleTagDecombinator, to benchmark its options.
+# python SingleTagBenchmark.py -c "a b" -- -col -cs 100000
+  # Flags after -- are always passed on. Needed for SingleTagDecombinator flags that start like a benchmark flag (e.g. -col or -cs, 
+  # which would otherwise be read as -c).
+
+# Benchmark flags:
+  # -sz/--sizes: Comma separated numbers of reads to benchmark with. Default = 1e4,1e5,1e6
+  # -go/--generateonly: Only generate the synthetic FASTQ and ground truth files.
+  # -od/--outdir: Folder for the synthetic files, Decombinator output and benchmark_results.csv. Default = SingleTagBenchmark
+  # -sd/--seed: Seed for the random number generator. Default = 1
+  # -gz/--gzipmembers: Write the synthetic FASTQ gzipped as many gzip members (a new one every 64 KB of reads, as in BGZF files), 
+    # e.g. to benchmark SingleTagDecombinator's --gzipindex on. The reads are the same as without the flag.
+
+# Synthetic read flags:
+  # -rl/--readlength: Length of the reads, not counting barcodes. Default = 60
+  # -er/--errorrate: Chance of a substitution error at each base. Default = 0.005
+  # -dm/--deletionmean: Mean number of deletions at each end of the insert (drawn from a geometric distribution). Default = 3
+  # -dx/--maxdeletions: Most deletions at either end of the insert (and never into a tag). Default = 12
+  # -rv/--reversefraction: Fraction of reads that are reverse complemented, as in reads from the Innate2Adaptive protocol. Default = 1
+  # -tf/--tcrfraction: Fraction of reads taken from a rearrangement, rather than random sequence. Default = 0.8
+  # -bc/--barcoded: Add a random 30 base barcode to the start of every read (otherwise Decombinator is run with --nobarcoding).
+  # -dr/--duplication: Fraction of reads that repeat an earlier read, with its errors. Default = 0.2
+
+# The --chain, --species, --tags, --tagfastadir, --tagcache and --offline flags choose the genes as for SingleTagDecombinator, and are passed on to it.
+
+##################
+##### OUTPUT #####
+##################
+
+# In --outdir, for each size:
+  # synthetic_<size>_<settings hash>.fq: the reads (.fq.gz with --gzipmembers)
+  # synthetic_<size>_<settings hash>.truth: the ground truth, one line per read in the same comma delimited style as Decombinator output:
+    # read id, chain, V index, J index (n/a for tags not in the read, or for random reads), V deletions, J deletions, insert length, strand
+  # bench_<size>_...n12: SingleTagDecombinator's output
+  # bench_<size>_..._Profile.json: its stage timings, when --profile is passed on (Decombinator is run with -s, so they are kept
+    # next to its output rather than in Logs). The stage times are also printed after each run.
+# A table of results is printed, and added to benchmark_results.csv:
+  # DecombineSeconds and ReadsPerSecond are for decombining alone (as reported by Decombinator), WallSeconds includes starting up
+  # PeakRSS(MB) is the most memory that the Decombinator process used
+  # Sensitivity is the fraction of reads holding a tag that were assigned the right gene(s), with no wrong assignment
+  # Precision is the fraction of the assignments made that were right
+  # (Accuracy is not scored when --collapse is passed on, as collapsed output has no read ids)
+
+##################
+#### PACKAGES ####
+##################
+
+from __future__ import division
+import os
+import sys
+import re
+import math
+import random
+import zlib
+import hashlib
+import itertools
+import argparse
+import subprocess
+import collections as coll
+from time import time, strftime
+
+import SingleTagDecombinator
+
+benchmark_barcode_length = 30 # As SingleTagDecombinator takes the first 30 bases of barcoded reads as the barcode
+benchmark_max_insert = 15
+generator_version = 1 # Part of the synthetic file names, so that files from a changed generator are not reused
+
+def args(argv=None):
+  """args(argv): Obtains command line arguments, returning the benchmark's arguments and those to pass on to SingleTagDecombinator:
+    any it does not recognise, and all of those after a '--'"""
+  if argv is None:
+    argv = sys.argv[1:]
+  passed_on = []
+  if '--' in argv:
+    passed_on = argv[argv.index('--') + 1:]
+    argv = argv[:argv.index('--')]
+  parser = argparse.ArgumentParser(
+      description='Generates synthetic FASTQ reads from the V and J FASTA and tag files, and benchmarks SingleTagDecombinator on them')
+  parser.add_argument(
+      '-sz', '--sizes', type=str, help='Comma separated numbers of reads to benchmark with. Default = 1e4,1e5,1e6', required=False, default="1e4,1e5,1e6")
+  parser.add_argument(
+      '-go', '--generateonly', action='store_true', help='Only generate the synthetic FASTQ and ground truth files', required=False)
+  parser.add_argument(
+      '-od', '--outdir', type=str, help='Folder for the synthetic files, output and results. Default = SingleTagBenchmark', required=False, default="SingleTagBenchmark")
+  parser.add_argument(
+      '-sd', '--seed', type=int, help='Seed for the random number generator. Default = 1', required=False, default=1)
+  parser.add_argument(
+      '-gz', '--gzipmembers', action='store_true', help='Write the synthetic FASTQ gzipped as many gzip members, as in BGZF files', required=False)
+  parser.add_argument(
+      '-rl', '--readlength', type=int, help='Length of the reads, not counting barcodes. Default = 60', required=False, default=60)
+  parser.add_argument(
+      '-er', '--errorrate', type=float, help='Chance of a substitution error at each base. Default = 0.005', required=False, default=0.005)
+  parser.add_argument(
+      '-dm', '--deletionmean', type=float, help='Mean number of deletions at each end of the insert. Default = 3', required=False, default=3)
+  parser.add_argument(
+      '-dx', '--maxdeletions', type=int, help='Most deletions at either end of the insert. Default = 12', required=False, default=12)
+  parser.add_argument(
+      '-rv', '--reversefraction', type=float, help='Fraction of reads that are reverse complemented. Default = 1', required=False, default=1)
+  parser.add_argument(
+      '-tf', '--tcrfraction', type=float, help='Fraction of reads taken from a rearrangement rather than random sequence. Default = 0.8', required=False, default=0.8)
+  parser.add_argument(
+      '-bc', '--barcoded', action='store_true', help='Add a random 30 base barcode to the start of every read', required=False)
+  parser.add_argument(
+      '-dr', '--duplication', type=float, help='Fraction of reads that repeat an earlier read. Default = 0.2', required=False, default=0.2)
+  parser.add_argument(
+      '-c', '--chain', type=str, help='TCR chain (a/b/g/d)', required=True)
+  parser.add_argument(
+      '-sp', '--species', type=str, help='Specify which species TCR repertoire the data consists of (human or mouse). Default = human', required=False, default="human")
+  parser.add_argument(
+      '-tg', '--tags', type=str, help='Specify which Decombinator tag set to use (extended or original). Default = extended', required=False, default="extended")
+  parser.add_argument(
+      '-tfdir', '--tagfastadir', type=str, help='Path to folder containing TCR FASTA and Decombinator tag files', required=False, default="Decombinator-Tags-FASTAs")
+  parser.add_argument(
+      '-tc', '--tagcache', type=str, help='Folder in which to cache the compiled tags between runs', required=False)
+  parser.add_argument(
+      '-off', '--offline', action='store_true', help='Never try to download tag and FASTA files, only using local copies', required=False)
+  benchargs, unknown = parser.parse_known_args(argv)
+  return benchargs, unknown + passed_on
+
+#####################################
+########## SYNTHETIC READS ##########
+#####################################
+
+def load_tags(benchargs):
+  """load_tags(benchargs): Returns the TagIndex that SingleTagDecombinator would use with these settings"""
+  inputargs = SingleTagDecombinator.default_inputargs(chain=benchargs['chain'], species=benchargs['species'], tags=benchargs['tags'],
+    tagfastadir=benchargs['tagfastadir'], tagcache=benchargs['tagcache'], offline=benchargs['offline'])
+  return SingleTagDecombinator.import_tcr_info(inputargs)
+
+def usable_genes(tags, gene):
+  """usable_genes(tags, gene): Returns, for each chain, the (tag index, tag start in region) of the genes whose tag is found where
+    Decombinator expects it in the FASTA sequence, and is not shared with an earlier gene (which Decombinator would assign instead)"""
+  genes = coll.defaultdict(list)
+  for i in range(len(tags.seqs[gene])):
+    tag = tags.seqs[gene][i]
+    region = tags.regions[gene][i]
+    if gene == 'v':
+      start = len(region) - tags.jumps[gene][i]
+    else:
+      start = tags.jumps[gene][i]
+    if region[start:start + len(tag)] == tag and tags.tag_to_index[gene][tag] == i:
+      genes[tags.index_to_chain[gene][i][0]].append((i, start))
+  return genes
+
+def draw_deletions(rng, mean, most):
+  """draw_deletions(rng, mean, most): Returns a number of deletions from a geometric distribution with the given mean, up to most"""
+  if mean <= 0 or most <= 0:
+    return 0
+  p = 1 / (mean + 1)
+  return min(int(math.log(1 - rng.random()) / math.log(1 - p)), most)
+
+def add_errors(seq, rate, rng):
+  """add_errors(seq, rate, rng): Returns seq with each base substituted at the given rate, and a quality string marking the errors"""
+  if rate <= 0:
+    return seq, 'I' * len(seq)
+  seq = list(seq)
+  qual = ['I'] * len(seq)
+  log_miss = math.log(1 - rate) if rate < 1 else None
+  pos = -1
+  while True:
+    # Skip straight to the next error, rather than drawing a number for every base
+    if log_miss is None:
+      pos += 1
+    else:
+      pos += int(math.log(1 - rng.random()) / log_miss) + 1
+    if pos >= len(seq):
+      break
+    seq[pos] = rng.choice([b for b in 'ACGT' if b != seq[pos]])
+    qual[pos] = '+'
+  return ''.join(seq), ''.join(qual)
+
+def random_bases(rng, length):
+  return ''.join([rng.choice('ACGT') for i in range(length)])
+
+def synthesise_reads(tags, benchargs, number, seed):
+  """synthesise_reads(tags, benchargs, number, seed): Yields (readid, seq, qual, truth) for number synthetic reads, where truth is
+    (chain, V index, J index, V deletions, J deletions, insert length, strand), with 'n/a' for the fields that do not apply to a read"""
+  rng = random.Random(seed)
+  v_genes = usable_genes(tags, 'v')
+  j_genes = usable_genes(tags, 'j')
+  chains = [c for c in tags.chain if v_genes[c] and j_genes[c]]
+  if not chains:
+    print "None of the tags were found in their FASTA sequences; cannot synthesise reads."
+    sys.exit()
+
+  read_length = benchargs['readlength']
+  earlier = []  # A bounded pool of earlier reads to repeat, so memory use does not grow with the number of reads
+
+  for n in xrange(number):
+    readid = "syn" + str(n)
+
+    if earlier and rng.random() < benchargs['duplication']:
+      seq, qual, truth = earlier[rng.randrange(len(earlier))]
+      yield readid, seq, qual, truth
+      continue
+
+    if rng.random() < benchargs['tcrfraction']:
+      chain = rng.choice(chains)
+      v, v_start = rng.choice(v_genes[chain])
+      j, j_start = rng.choice(j_genes[chain])
+      v_region = tags.regions['v'][v]
+      j_region = tags.regions['j'][j]
+      v_end = v_start + len(tags.seqs['v'][v])
+      j_end = j_start + len(tags.seqs['j'][j])
+
+      # Deletions never reach into a tag, so every tag is still there to be found
+      v_dels = draw_deletions(rng, benchargs['deletionmean'], min(benchargs['maxdeletions'], len(v_region) - v_end))
+      j_dels = draw_deletions(rng, benchargs['deletionmean'], min(benchargs['maxdeletions'], j_start))
+      insert = random_bases(rng, rng.randint(0, benchmark_max_insert))
+      rearrangement = v_region[:len(v_region) - v_dels] + insert + j_region[j_dels:]
+
+      # Tag positions in the rearrangement, and the extent of each tag with the end of its gene next to the insert
+      j_offset = len(v_region) - v_dels + len(insert) - j_dels
+      tag_starts = {'v': v_start, 'j': j_offset + j_start}
+      tag_ends = {'v': v_end, 'j': j_offset + j_end}
+      junction_spans = {'v': (v_start, len(v_region) - v_dels), 'j': (j_offset + j_dels, j_offset + j_end)}
+
+      # A window of the rearrangement holding one of the tags, and where possible the end of its gene too,
+      # as Decombinator needs to see where the gene ends to count its deletions
+      gene = rng.choice(['v', 'j'])
+      span_start, span_end = junction_spans[gene]
+      if span_end - span_start > read_length:
+        span_start, span_end = tag_starts[gene], tag_ends[gene]
+      lowest = max(0, span_end - read_length)
+      highest = max(lowest, min(span_start, len(rearrangement) - read_length))
+      start = rng.randint(lowest, highest)
+      seq = rearrangement[start:start + read_length]
+
+      v_found = tag_starts['v'] >= start and tag_ends['v'] <= start + read_length
+      j_found = tag_starts['j'] >= start and tag_ends['j'] <= start + read_length
+      truth = [tags.index_to_chain['v'][v][0], tags.index_to_chain['v'][v][1] if v_found else 'n/a',
+        tags.index_to_chain['j'][j][1] if j_found else 'n/a', v_dels, j_dels, len(insert)]
+
+    else:
+      seq = random_bases(rng, read_length)
+      truth = ['n/a'] * 6
+
+    seq, qual = add_errors(seq, benchargs['errorrate'], rng)
+
+    if rng.random() < benchargs['reversefraction']:
+      seq = SingleTagDecombinator.revcomp(seq)
+      qual = qual[::-1]
+      truth.append('reverse')
+    else:
+      truth.append('forward')
+
+    if benchargs['barcoded']:
+      seq = random_bases(rng, benchmark_barcode_length) + seq
+      qual = 'I' * benchmark_barcode_length + qual
+
+    truth = tuple(truth)
+    if len(earlier) < 10000:
+      earlier.append((seq, qual, truth))
+    else:
+      earlier[rng.randrange(len(earlier))] = (seq, qual, truth)
+    yield readid, seq, qual, truth
+
+def settings_hash(benchargs):
+  """settings_hash(benchargs): Returns a short hash of the settings that change the synthetic reads, to name their files by"""
+  keys = ['seed', 'readlength', 'errorrate', 'deletionmean', 'maxdeletions', 'reversefraction', 'tcrfraction', 'barcoded', 'duplication',
+    'chain', 'species', 'tags']
+  return hashlib.md5(repr([generator_version] + [(k, benchargs[k]) for k in keys])).hexdigest()[:8]
+
+def synthetic_files(benchargs, number):
+  """synthetic_files(benchargs, number): Returns the names of the FASTQ and ground truth files for number reads with these settings"""
+  stem = os.path.join(benchargs['outdir'], "synthetic_" + str(number) + "_" + settings_hash(benchargs))
+  return stem + (".fq.gz" if benchargs['gzipmembers'] else ".fq"), stem + ".truth"
+
+class GzipMemberWriter(object):
+  """GzipMemberWriter(f): Writes to the file f gzipped, starting a new gzip member every member_bytes of data (as BGZF files do),
+    so SingleTagDecombinator's --gzipindex can split it between its workers"""
+  member_bytes = 1 << 16
+
+  def __init__(self, f):
+    self.f = f
+    self.pending = []
+    self.size = 0
+
+  def write(self, data):
+    self.pending.append(data)
+    self.size += len(data)
+    if self.size >= self.member_bytes:
+      self.flush_member()
+
+  def flush_member(self):
+    if self.pending:
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      self.f.write(compressor.compress("".join(self.pending)) + compressor.flush())
+      self.pending = []
+      self.size = 0
+
+def generate(tags, benchargs, number):
+  """generate(tags, benchargs, number): Writes the synthetic FASTQ and ground truth files for number reads, unless already written"""
+  fqname, truthname = synthetic_files(benchargs, number)
+  if os.path.exists(fqname) and os.path.exists(truthname):
+    print "Using", fqname
+    return fqname, truthname
+
+  print "Generating", "{:,}".format(number), "reads in", fqname + "..."
+  # Written under temporary names, so an interrupted run does not leave incomplete files to be reused
+  with open(fqname + ".tmp", "wb") as fqfile, open(truthname + ".tmp", "w") as truthfile:
+    fq = GzipMemberWriter(fqfile) if benchargs['gzipmembers'] else fqfile
+    for readid, seq, qual, truth in synthesise_reads(tags, benchargs, number, benchargs['seed']):
+      fq.write("@" + readid + "\n" + seq + "\n+\n" + qual + "\n")
+      truthfile.write(readid + ", " + ", ".join(map(str, truth)) + "\n")
+    if benchargs['gzipmembers']:
+      fq.flush_member()
+  os.rename(fqname + ".tmp", fqname)
+  os.rename(truthname + ".tmp", truthname)
+  return fqname, truthname
+
+#####################################
+############# BENCHMARK #############
+#####################################
+
+def decombinator_args(benchargs, passed_on, fqname, prefix):
+  """decombinator_args(benchargs, passed_on, fqname, prefix): Returns the SingleTagDecombinator command line for a benchmark run"""
+  command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "SingleTagDecombinator.py"),
+    "-fq", fqname, "-c", benchargs['chain'], "-sp", benchargs['species'], "-tg", benchargs['tags'], "-tfdir", benchargs['tagfastadir'],
+    "-pf", prefix, "-dz", "-dc", "-s"]
+  if benchargs['tagcache']:
+    command += ["-tc", benchargs['tagcache']]
+  if benchargs['offline']:
+    command.append("-off")
+  if not benchargs['barcoded']:
+    command.append("-nbc")
+  if "-or" not in passed_on and "--orientation" not in passed_on:
+    if benchargs['reversefraction'] >= 1:
+      command += ["-or", "reverse"]
+    elif benchargs['reversefraction'] <= 0:
+      command += ["-or", "forward"]
+    else:
+      command += ["-or", "both"]
+  return command + passed_on
+
+def run_decombinator(command):
+  """run_decombinator(command): Runs SingleTagDecombinator, returning its output, wall clock time and peak memory use (in MB)"""
+  start = time()
+  process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = process.stdout.read()
+  pid, status, usage = os.wait4(process.pid, 0)
+  wall_time = time() - start
+  if status != 0:
+    print output
+    print "SingleTagDecombinator failed, running:", " ".join(command)
+    sys.exit()
+  # ru_maxrss is in kilobytes on Linux, but bytes on Mac OS
+  peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+  return output, wall_time, peak_rss
+
+def read_assignments(outname, barcoded):
+  """read_assignments(outname, barcoded): Yields (read id, list of (chain, V index, J index) assignments) for the reads with assignments
+    in a Decombinator output file (text or --binary), in file order, which is the order of the reads"""
+  if outname.endswith(".dcrb"):
+    import dcrbinary
+    assignments = ((str(r[3]), (r[0], str(r[1]), str(r[2]))) for r in dcrbinary.read_records(outname))
+  else:
+    seqid_field = 4 if barcoded else 3
+    assignments = ((fields[seqid_field], (fields[0], fields[1], fields[2])) for fields in
+      (line.rstrip("\n").split(", ") for line in open(outname)))
+  for readid, group in itertools.groupby(assignments, key=lambda a: a[0]):
+    yield readid, [a[1] for a in group]
+
+def is_right(assignment, chain, v, j):
+  """is_right(assignment, chain, v, j): Whether a (chain, V index, J index) assignment agrees with a read's ground truth"""
+  assigned_chain, assigned_v, assigned_j = assignment
+  if assigned_v == 'n/a' and assigned_j == 'n/a':
+    return False
+  return assigned_chain == chain and assigned_v in ['n/a', v] and assigned_j in ['n/a', j]
+
+def score(truthname, assignments):
+  """score(truthname, assignments): Returns the sensitivity and precision of Decombinator's assignments (from read_assignments),
+    against the ground truth. An assignment is right if its chain matches, and each V or J index it gives matches the truth (see is_right).
+    Both files are in read order, so they are read through together rather than held in memory."""
+  tcr_reads = 0
+  found = 0
+  right = 0
+  made = 0
+  assignments = iter(assignments)
+  next_assigned = next(assignments, (None, []))
+  with open(truthname) as f:
+    for line in f:
+      readid, chain, v, j = line.rstrip("\n").split(", ")[:4]
+      read_assignments = []
+      if next_assigned[0] == readid:
+        read_assignments = next_assigned[1]
+        next_assigned = next(assignments, (None, []))
+      made += len(read_assignments)
+      correct = [a for a in read_assignments if is_right(a, chain, v, j)]
+      right += len(correct)
+      if v != 'n/a' or j != 'n/a':
+        tcr_reads += 1
+        if correct and len(correct) == len(read_assignments):
+          found += 1
+  if next_assigned[0] is not None:
+    print "Warning:", next_assigned[0], "in the output is not in the ground truth (or is out of order)"
+  return found / max(tcr_reads, 1), right / max(made, 1)
+
+def benchmark(tags, benchargs, passed_on, number):
+  """benchmark(tags, benchargs, passed_on, number): Runs SingleTagDecombinator on number synthetic reads, returning a row of results"""
+  fqname, truthname = generate(tags, benchargs, number)
+  prefix = os.path.join(benchargs['outdir'], "bench_" + str(number) + "_")
+  command = decombinator_args(benchargs, passed_on, fqname, prefix)
+
+  print "Decombining", "{:,}".format(number), "reads..."
+  output, wall_time, peak_rss = run_decombinator(command)
+  outname = re.search(r"^Reading from .*, writing to (.*)$", output, re.MULTILINE).group(1)
+  decombine_time = float(re.search(r"^Took ([0-9.]+) seconds", output, re.MULTILINE).group(1))
+  profile = re.search(r"^(Stage times .*)\n(?:.*\n)*?Profile written to (.*)$", output, re.MULTILINE)
+  if profile:
+    print profile.group(1)
+    print "Profile written to", profile.group(2)
+
+  if outname.endswith(".freq"):
+    sensitivity = precision = 'n/a' # --collapse output has no read ids to check against the truth
+  else:
+    sensitivity, precision = score(truthname, read_assignments(outname, benchargs['barcoded']))
+  return coll.OrderedDict([('Date', strftime("%Y_%m_%d %H:%M:%S")), ('Version', SingleTagDecombinator.__version__), ('Reads', number),
+    ('DecombineSeconds', round(decombine_time, 2)), ('ReadsPerSecond', int(number / max(decombine_time, 1e-6))),
+    ('WallSeconds', round(wall_time, 2)), ('PeakRSS(MB)', round(peak_rss, 1)), ('Sensitivity', sensitivity if sensitivity == 'n/a' else round(sensitivity, 4)),
+    ('Precision', precision if precision == 'n/a' else round(precision, 4)), ('Settings', settings_hash(benchargs)), ('DecombinatorArgs', " ".join(passed_on))])
+
+def main(benchargs, passed_on):
+  if not os.path.exists(benchargs['outdir']):
+    os.makedirs(benchargs['outdir'])
+  sizes = [int(float(size)) for size in benchargs['sizes'].split(",")]
+  tags = load_tags(benchargs)
+
+  results = []
+  for number in sizes:
+    if benchargs['generateonly']:
+      generate(tags, benchargs, number)
+    else:
+      results.append(benchmark(tags, benchargs, passed_on, number))
+
+  if not results:
+    return results
+
+  columns = results[0].keys()
+  shown = ['Reads', 'DecombineSeconds', 'ReadsPerSecond', 'WallSeconds', 'PeakRSS(MB)', 'Sensitivity', 'Precision']
+  print "\n" + "\t".join(shown)
+  for result in results:
+    print "\t".join(str(result[c]) for c in shown)
+
+  resultsname = os.path.join(benchargs['outdir'], "benchmark_results.csv")
+  new_file = not os.path.exists(resultsname)
+  with open(resultsname, "a") as f:
+    if new_file:
+      f.write(",".join(columns) + "\n")
+    for result in results:
+      f.write(",".join(str(result[c]) for c in columns) + "\n")
+  print "Results added to", resultsname
+  return results
+
+if __name__ == '__main__':
+  benchargs, passed_on = args()
+  main(vars(benchargs), passed_on)
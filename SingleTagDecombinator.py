@@ -44,10 +44,28 @@
 
 # Other optional flags:
   
+  # -fq2/--fastq2: A second FASTQ file (e.g. R2 reads) to decombine along with the first, into the same output file and summary.
+    # The two files are read and decombined at the same time (in parallel with --nproc), but output is the same as if they were decombined one after the other.
+
   # -s/--supresssummary: Supress the production of a summary file containing details of the run into a 'Logs' directory. 
       
   # -dz/--dontgzip: Suppress the automatic compression of output demultiplexed FASTQ files with gzip. 
     # Using this flag makes the script execute faster, but data will require more storage space. 
+
+  # -cl/--compresslevel: The gzip compression level (1-9) of the output file. Default = 6. Lower levels are faster but give larger files.
+    # Output is compressed in a background thread as it is written, so an uncompressed copy is never written to disk.
+    
+  # -bin/--binary: Write the output in a compact, columnar binary format (extension '.dcrb') instead of the text format,
+    # which is much faster to write and to read back in. Read it with the functions in dcrbinary.py (which needs NumPy), as ReconstructTCR does.
+    # Output is still gzipped unless -dz is used, but quality strings make up most of what is left to compress.
+    
+  # -col/--collapse: Write each distinct rearrangement (chain, V, J, sequence, and barcode unless using -nbc) once, followed by the number of reads 
+    # it was found in, to a '.freq' file, instead of writing a line for every read. Shrinks the output and all downstream work for redundant libraries.
+    # Lines are written in sorted order. Always written as text, so cannot be combined with --binary.
+
+  # -ck/--collapsekeys: Number of distinct rearrangements to count in memory when collapsing. Default = 2,000,000. 
+    # Past this the counts are sorted and spilled to temporary files (in TMPDIR), which are merged at the end, so very diverse libraries
+    # still finish in bounded memory. The number of spills is written to the summary file.
     
   # -dc/--dontcount: Suppress the whether or not to show the running line count, every 100,000 reads. 
     # Helps in monitoring progress of large batches.
@@ -61,6 +79,15 @@
 
   # -or/--orientation: Allows users to specify which DNA orientations to check for TCR reads. Default = reverse only, as that's what the protocol produces.
     # This will likely need to be changed for analysing data produced by protocols other than our own.
+    # 'auto' decombines a sample of reads from the start of the (first) input file both ways, then runs in whichever orientation they were found in:
+      # forward or reverse, or both if at least --automixed of those found were found each way (or none were found either way).
+      # How many were found each way is written to the summary file. Saves searching both strands of every read when unsure.
+
+  # -as/--autosample: Number of reads sampled to choose the orientation with '-or auto'. Default = 10,000.
+
+  # -am/--automixed: With '-or auto', the fraction of the sampled rearrangements that must be found on each strand for both to be searched. Default = 0.1.
+    # With fewer on one strand, only the other is searched, and a warning gives how many of those sampled were on the strand left out.
+    # 0 always searches both strands.
 
   # -tg/--tags: Allows users to specify which tag set they wish to use. For human alpha/beta TCRs, a new 'extended' tag set is recommended, as it covers more genes.
     # Unfortunately an extended tag set is only currently available for human a/b genes.
@@ -77,9 +104,57 @@
     # By default the script looks for the required files in the present working directory, then in a subdirectory called "Decombinator-Tags-FASTAs", then online.
     # Files are hosted on GitHub, here: https://github.com/innate2adaptive/Decombinator-Tags-FASTAs
 
+  # -tc/--tagcache: A folder in which to keep the tags compiled from the tag and FASTA files, so later runs can skip reading and compiling them.
+    # Cached tags are stored per species/tag set/chains, and are rebuilt if the local tag and FASTA files they came from change.
+    # Recommended when launching many small (e.g. per cell) jobs. If the source files are not available locally, the cache is used as is.
+
+  # -off/--offline: Never try to download the tag and FASTA files, only looking for local copies (or using the tag cache).
+    # Avoids waiting on network timeouts on compute nodes without internet access.
+
   # -nbc/--nobarcoding: Run Decombinator without any barcoding, i.e. use the whole read. 
     # Recommended when running on data not produced using the Innate2Adaptive lab's ligation-mediated amplification protocol
 
+  # -tv/--tagvariants: Assign tags containing errors using an index of every variant of every tag within --tagthreshold substitutions, 
+    # rather than by finding an exact half tag and checking the hamming distance of the rest. This also finds tags with errors in both halves.
+    # Substitutions include N, so tags with ambiguous base calls are assigned as by the half tag path. 
+    # The index grows quickly with the threshold (each substitution can be any of 4 other bases): thresholds of 1 or 2 are practical.
+    # Speed and results, measured on 20,000 reads decombined in both orientations (a and b chains):
+      # -tt 1: slightly faster than the half tag path (0.65 vs 0.71 seconds), finding one more rearrangement and losing none.
+      # -tt 2: about 1.8 times slower (1.25 vs 0.69 seconds), as the shorter tag pieces used to find variants match more often.
+        # Found 43 rearrangements the half tag path did not, while 2 of its rearrangements were assigned differently or not at all.
+
+  # -ss/--singlescan: Search both strands of each read with one scan, using reverse complemented as well as forward tags.
+    # Only reads with tags found on the reverse strand are then reverse complemented (or all reads, with --tagvariants). 
+    # Output is the same as without the flag, for any orientation.
+
+  # -cs/--cachesize: Number of distinct read sequences to remember the decombining results for, so repeats of a sequence are not re-analysed.
+    # Useful for highly redundant (e.g. single cell) libraries. The cache hit rate is written to the summary file, to help size it. Default = 0 (off).
+    # When running with --nproc each worker process keeps its own cache of this size.
+
+  # -np/--nproc: Number of worker processes to decombine reads with. Default = 1, i.e. everything runs in the one process.
+    # The compiled tag index is handed to each worker once; output is written in input order, so is identical to that of a single process run.
+
+  # -th/--threaded: Run reading (and decompressing) the input, decombining and writing the output as three threads, connected by queues of
+    # batches of reads. The queues are bounded, so memory use stays flat. The time each stage spends stalled waiting on the others
+    # is reported in the summary file: the stage that stalls least is the one limiting throughput.
+
+  # -gi/--gzipindex: With --nproc, split a gzipped FASTQ file into ranges that the worker processes decompress themselves, rather than
+    # decompressing it all in the main process. Only works for files made of many gzip members, e.g. BGZF files written by bgzip, or gzip files
+    # concatenated together: plain gzip files can only be decompressed from the start. The first run decompresses the file in the main process
+    # as usual, indexing its gzip members as it goes, and saves the index next to the input file (as <file>.dcridx) for later runs to split it.
+    # Output is the same as without the flag. Not used with --threaded, or for two input files (-fq2).
+    # Only worth it with many workers: reading a gzipped file in the main process (about 230,000 reads a second on our test machine) is 
+    # only the bottleneck once the workers together decombine faster than that (each did about 26,000 reads a second, decombining a and b
+    # in both orientations), i.e. with more than about 8 of them. SingleTagBenchmark.py's -gz flag writes files to try it on.
+
+  # -prof/--profile: Time each stage of decombining (reading, reverse complementing, the tag scan, V and J assignment from full tags, 
+    # the half tag or tag variant fallbacks, the deletion search, formatting and writing), and the time taken by a sample of 1 in 100 reads.
+    # Written as JSON to the Logs folder next to the summary file (as ..._Profile.json), or with -s next to the output file (as <output name>_Profile.json).
+    # Stage times are summed over worker processes.
+    # Without the flag no timing code is run.
+
+  # -bs/--batchsize: Number of reads handed to each worker process (or between threads) at a time with --nproc or --threaded. Default = 10000.
+
 ##################
 ##### OUTPUT #####  
 ##################
@@ -87,6 +162,8 @@
 # Produces a '.n12' file by default, which is a standard comma-delimited Decombinator output file with several additional fields:
   # V index, J index, # V deletions, # J deletions, insert, ID, TCR sequence, TCR quality, barcode sequence, barcode quality
   # NB The TCR sequence given here is the 'inter-tag' region, i.e. the sequence between the start of the found V tag the end of the found J tag 
+# Or with --binary, a '.dcrb' file holding the same fields in the binary format described in dcrbinary.py
+# Or with --collapse, a '.freq' file giving: chain, V index, J index, TCR sequence, (barcode sequence,) count
 
 ##################
 #### PACKAGES ####  
@@ -100,10 +177,19 @@ import string
 import collections as coll
 import argparse
 import gzip
+import hashlib
+import cPickle
+import threading
+import Queue
+import mmap
+import zlib
+import itertools
+import heapq
+import tempfile
+import json
+import multiprocessing as mp
 import Levenshtein as lev
 import collections
-from Bio import SeqIO
-from Bio.Seq import Seq
 from acora import AcoraBuilder
 from time import time, strftime
 
@@ -113,8 +199,8 @@ __version__ = '3.1'
 ############# READ IN COMMAND LINE ARGUMENTS #############
 ##########################################################
 
-def args():
-  """args(): Obtains command line arguments which dictate the script's behaviour"""
+def args(argv=None):
+  """args(argv): Obtains command line arguments (from sys.argv, unless a list of them is given) which dictate the script's behaviour"""
 
   # Help flag
   parser = argparse.ArgumentParser(
@@ -131,6 +217,15 @@ def args():
       '-s', '--suppresssummary', action='store_true', help='Suppress the production of summary data log file', required=False)
   parser.add_argument(
       '-dz', '--dontgzip', action='store_true', help='Stop the output FASTQ files automatically being compressed with gzip', required=False)
+  parser.add_argument(
+      '-cl', '--compresslevel', type=int, choices=range(1, 10), help='gzip compression level (1-9) of the output file. Default = 6', required=False, default=6)
+  parser.add_argument(
+      '-bin', '--binary', action='store_true', help='Write the output in the compact binary format read by dcrbinary.py, rather than as text', required=False)
+  parser.add_argument(
+      '-col', '--collapse', action='store_true', help='Write each distinct rearrangement once, with the number of times it was found', required=False)
+  parser.add_argument(
+      '-ck', '--collapsekeys', type=int, help='Number of distinct rearrangements to count in memory when collapsing, before spilling to disk. Default = 2000000', \
+      required=False, default=2000000)
   parser.add_argument(
       '-dk', '--dontcheck', action='store_true', help='Skip the FASTQ check', required=False, default=False)  
   parser.add_argument(
@@ -140,7 +235,11 @@ def args():
   parser.add_argument(
       '-pf', '--prefix', type=str, help='Specify the prefix of the output DCR file. Default = \"dcr_\"', required=False, default="dcr_")
   parser.add_argument(
-      '-or', '--orientation', type=str, help='Specify the orientation to search in (forward/reverse/either/both). Default = reverse', required=False, default="reverse")  
+      '-or', '--orientation', type=str, help='Specify the orientation to search in (forward/reverse/either/both/auto). Default = reverse', required=False, default="reverse")  
+  parser.add_argument(
+      '-as', '--autosample', type=int, help='Number of reads to sample to choose the orientation with \'-or auto\'. Default = 10000', required=False, default=10000)
+  parser.add_argument(
+      '-am', '--automixed', type=float, help='With \'-or auto\', search both strands if at least this fraction of the sampled rearrangements are found on each. Default = 0.1', required=False, default=0.1)
   parser.add_argument(
       '-tg', '--tags', type=str, help='Specify which Decombinator tag set to use (extended or original). Default = extended', required=False, default="extended")
   parser.add_argument(
@@ -152,11 +251,34 @@ def args():
   parser.add_argument(
       '-tfdir', '--tagfastadir', type=str, help='Path to folder containing TCR FASTA and Decombinator tag files, for offline analysis.', \
       required=False, default="Decombinator-Tags-FASTAs")
+  parser.add_argument(
+      '-tc', '--tagcache', type=str, help='Folder in which to cache the compiled tags between runs, for faster startup', required=False)
+  parser.add_argument(
+      '-off', '--offline', action='store_true', help='Never try to download tag and FASTA files, only using local copies', required=False)
   parser.add_argument(
       '-nbc', '--nobarcoding', action='store_true', help='Option to run Decombinator without barcoding, i.e. so as to run on data produced by any protocol.', required=False)
   parser.add_argument(
       '-tt', '--tagthreshold', type=int, help='Allowed hamming distance mismatch for half tags', required=False, default=1)
-  return parser.parse_known_args()
+  parser.add_argument(
+      '-tv', '--tagvariants', action='store_true', help='Match tags with errors by looking up every tag variant (substituting A, C, G, T or N) within the tag threshold, instead of by half tags. Finds tags with errors in both halves too, at the cost of a larger tag index. About as fast as half tags with -tt 1, but slower with -tt 2 (see the notes at the top of this file)', required=False)
+  parser.add_argument(
+      '-ss', '--singlescan', action='store_true', help='Find tags on both strands in one scan of each read, only reverse complementing reads with reverse strand hits', required=False)
+  parser.add_argument(
+      '-cs', '--cachesize', type=int, help='Number of distinct read sequences to cache decombining results for. Default = 0 (no caching)', required=False, default=0)
+  parser.add_argument(
+      '-np', '--nproc', type=int, help='Number of worker processes to decombine reads with. Default = 1', required=False, default=1)
+  parser.add_argument(
+      '-th', '--threaded', action='store_true', help='Run reading, decombining and writing in separate threads, reporting the time each stage stalls', required=False)
+  parser.add_argument(
+      '-gi', '--gzipindex', action='store_true', help='With --nproc, have the workers decompress ranges of a multi-member (e.g. bgzip) gzipped FASTQ, using an index file', required=False)
+  parser.add_argument(
+      '-prof', '--profile', action='store_true', help='Time each stage of decombining, writing the timings as JSON next to the summary file (or the output file, with -s)', required=False)
+  parser.add_argument(
+      '-bs', '--batchsize', type=int, help='Number of reads handed to a worker process at a time. Default = 10000', required=False, default=10000)
+  parsed = parser.parse_known_args(argv)
+  if parsed[0].collapse and parsed[0].binary:
+    parser.error("--collapse output is always text, so cannot be combined with --binary")
+  return parsed
 
 ##########################################################
 ############# FASTQ SANITY CHECK AND PARSING #############
@@ -167,7 +289,11 @@ def fastq_check(infile):
   
   success = True
     
-  #if infile.endswith('.gz'):
+  if infile.endswith('.gz'):
+    opener = gzip.open
+  else:
+    opener = open
+
   with opener(infile) as possfq:
     try:
       read = [next(possfq) for x in range(4)]
@@ -185,32 +311,49 @@ def fastq_check(infile):
     success = False
   return(success)
 
+# Same (IUPAC ambiguous DNA) complement table as Biopython uses, without building a Seq object for every read
+complement_table = string.maketrans('ACGTMRWSYKVHDBXNacgtmrwsykvhdbxn', 'TGCAKYWSRMBDHVXNtgcakywsrmbdhvxn')
+
 def revcomp(read):
-  """rc(read): Wrapper for SeqIO reverse complement function"""
-  return str(Seq(read).reverse_complement())
+  """rc(read): Reverse complement function"""
+  return read.translate(complement_table)[::-1]
+
+tag_url = "https://raw.githubusercontent.com/innate2adaptive/Decombinator-Tags-FASTAs/master/"
 
-def read_tcr_file(species, tagset, chain, gene, filetype, expected_dir_name):
+def tcr_file_name(species, tagset, chain, gene, filetype):
+  """ Gives the expected name of the FASTA or tag file for a TCR locus """
+  return species + "_" + tagset + "_" + "TR" + chain.upper() + gene.upper() + "." + filetype
+
+def find_local_tcr_file(expected_file, expected_dir_name):
+  """ Gives the path of a local copy of a FASTA or tag file (in pwd or in bundled directory), or None """
+  if os.path.isfile(expected_file):
+    return expected_file
+  elif os.path.isfile(expected_dir_name + os.sep + expected_file):
+    return expected_dir_name + os.sep + expected_file
+  return None
+
+def read_tcr_file(species, tagset, chain, gene, filetype, expected_dir_name, offline=False):
   """ Reads in the FASTA and tag data for the appropriate TCR locus """
   
   # Define expected file name
-  expected_file = species + "_" + tagset + "_" + "TR" + chain.upper() + gene.upper() + "." + filetype
-  # expected_file = species + "_" + tagset + "_" + "TR" + chain.upper() + gene.upper() + "." + filetype
+  expected_file = tcr_file_name(species, tagset, chain, gene, filetype)
 
   # First check whether the files are available locally (in pwd or in bundled directory)
-  if os.path.isfile(expected_file):
-    fl = expected_file
-    fl_opener = open
-  elif os.path.isfile(expected_dir_name + os.sep + expected_file):
-    fl = expected_dir_name + os.sep + expected_file
+  fl = find_local_tcr_file(expected_file, expected_dir_name)
+  if fl:
     fl_opener = open
+  elif offline:
+    print "Cannot find following file locally, and not looking online as running offline:", expected_file
+    print "Please point Decombinator to local copies of the tag and FASTA files with the \'-tfdir\' flag."
+    sys.exit()
   else:
     try:
-      fl = "https://raw.githubusercontent.com/innate2adaptive/Decombinator-Tags-FASTAs/master/" + expected_file
-      urllib2.urlopen(urllib2.Request(fl))      # Request URL, see whether is found
+      fl = tag_url + expected_file
+      urllib2.urlopen(urllib2.Request(fl), timeout=10)      # Request URL, see whether is found
       fl_opener = urllib2.urlopen
     except:
       print "Cannot find following file locally or online:", expected_file
-      print "Please either run Decombinator with internet access, or point Decombinator to local copies of the tag and FASTA files with the \'-tf\' flag."
+      print "Please either run Decombinator with internet access, or point Decombinator to local copies of the tag and FASTA files with the \'-tfdir\' flag."
       sys.exit()
   
   # Return opened file, for either FASTA or tag file parsing
@@ -252,41 +395,346 @@ def readfq(fp):
                 yield name, seq, None # yield a fasta record instead
                 break
 
+def read_blocks(fqfile, block_size=1 << 24):
+  """read_blocks(fqfile): Yields the (decompressed) contents of a file in large blocks. 
+    Plain files are memory mapped; gzipped files are decompressed a block at a time, including multi-member (concatenated) gzip files."""
+  
+  if fqfile.endswith('.gz'):
+    with open(fqfile, 'rb') as f:
+      decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      while True:
+        data = f.read(block_size)
+        if not data:
+          break
+        block = decompressor.decompress(data)
+        while decompressor.unused_data: # Start of the next gzip member
+          data = decompressor.unused_data
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          block += decompressor.decompress(data)
+        if block:
+          yield block
+      block = decompressor.flush()
+      if block:
+        yield block
+
+  else:
+    with open(fqfile, 'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        return
+      mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        for start in xrange(0, len(mapped), block_size):
+          yield mapped[start:start + block_size]
+      finally:
+        mapped.close()
+
+def readfq_blocks(blocks):
+  """readfq_blocks(blocks): Block based equivalent of readfq, yielding the same (name, seq, qual) records from blocks of file contents.
+    Splits whole blocks into lines and takes standard four line FASTQ records straight from them. As soon as anything else turns up
+    (FASTA, multi-line records, a last line with no newline) the rest of the data is handed over to readfq itself."""
+
+  blocks = iter(blocks)
+  tail = ''
+  for block in blocks:
+    lines = (tail + block).split('\n')
+    tail = lines.pop() # Incomplete final line, carried over to the next block
+    complete = len(lines) - len(lines) % 4
+
+    i = 0
+    for header, seq, plus, qual in itertools.izip(lines[0:complete:4], lines[1:complete:4], lines[2:complete:4], lines[3:complete:4]):
+      if header[:1] != '@' or plus[:1] != '+' or seq[:1] in '@+>' or len(seq) != len(qual):
+        # Not a plain FASTQ record: hand readfq everything from here on, as lines with their newlines
+        remaining = itertools.chain([l + '\n' for l in lines[i:]], block_lines(tail, blocks))
+        for record in readfq(remaining):
+          yield record
+        return
+      yield header[1:].partition(" ")[0], seq, qual
+      i += 4
+
+    tail = '\n'.join(lines[complete:] + [tail])
+
+  if tail:
+    for record in readfq(block_lines(tail, [])):
+      yield record
+
+def block_lines(tail, blocks):
+  """block_lines(tail, blocks): Yields the lines (with newlines, as when iterating over a file) of tail followed by the remaining blocks"""
+  for block in itertools.chain(blocks, ['']):
+    lines = (tail + block).split('\n')
+    tail = lines.pop()
+    for l in lines:
+      yield l + '\n'
+  if tail:
+    yield tail
+
+#####################################
+############# GZIP INDEX ############
+#####################################
+
+# A gzip file can only be decompressed from the start of one of its members. Files made of many members (e.g. BGZF, as written by
+# bgzip, or gzip files concatenated together) are indexed into ranges of whole members, each at least gzip_index_chunk bytes
+# when decompressed, noting where the first FASTQ record starting in each range begins. Each range can then be decompressed and
+# decombined by a different worker process. The index is built while the file is first decombined (read in this process as usual),
+# and kept next to the FASTQ file, as <file>.dcridx, for later runs.
+
+gzip_index_version = 1
+gzip_index_chunk = 1 << 22
+
+def gzip_index_file(fqfile):
+  return fqfile + '.dcridx'
+
+def new_decompressor():
+  return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+class GzipIndexer(object):
+  """GzipIndexer(chunk_bytes): Builds the ranges of a gzipped FASTQ file from its decompressed data (see add) and the compressed offsets
+    where its gzip members end (see member_end), as read_gzip_indexing gives them. Records are found by counting lines, so the file must
+    be made up of plain four line FASTQ records. The first record of each range is checked for its '@' header and '+' separator lines,
+    and ranges() returns None if either is missing."""
+
+  def __init__(self, chunk_bytes=None):
+    self.chunk_bytes = gzip_index_chunk if chunk_bytes is None else chunk_bytes
+    self.starts = [0]
+    self.firsts = [0]
+    self.valid = True
+    self.lines = 0             # Newlines before the data being indexed
+    self.at_line_start = True
+    self.chunk_seen = 0        # Decompressed bytes seen in the current range
+    self.to_skip = 0           # Newlines still to pass before the current range's first record starts
+    self.head = ''             # The first record of the current range up to its '+' line, while it is being checked (else None)
+
+  def check_head(self, data, start):
+    # Adds data from start to the head of the current range's first record, checking it once its first three lines are complete
+    end = start
+    for n in range(3 - self.head.count('\n')):
+      end = data.find('\n', end) + 1
+      if not end:
+        self.head += data[start:]
+        return True
+    lines = (self.head + data[start:end]).split('\n')
+    self.head = None
+    return lines[0].startswith('@') and lines[2].startswith('+')
+
+  def add(self, data):
+    """add(data): Finds the first record of the current range, if it has not yet been found, and keeps count of lines"""
+    if not data or not self.valid:
+      return
+    if self.to_skip:
+      pos = -1
+      while self.to_skip:
+        pos = data.find('\n', pos + 1)
+        if pos < 0:
+          break
+        self.to_skip -= 1
+      if not self.to_skip:
+        self.firsts[-1] = self.chunk_seen + pos + 1
+        self.head = ''
+        self.valid = self.check_head(data, pos + 1)
+    elif self.head is not None:
+      self.valid = self.check_head(data, 0)
+    self.lines += data.count('\n')
+    self.at_line_start = data.endswith('\n')
+    self.chunk_seen += len(data)
+
+  def member_end(self, end):
+    """member_end(end): Starts a new range at the end of a member, once the current range is big enough and its first record found"""
+    if self.chunk_seen >= self.chunk_bytes and not self.to_skip and self.head is None:
+      self.starts.append(end)
+      self.firsts.append(0)
+      self.chunk_seen = 0
+      if self.at_line_start:
+        self.to_skip = -self.lines % 4
+      else:
+        self.to_skip = (-self.lines - 1) % 4 + 1
+      if self.to_skip == 0:
+        self.head = ''
+
+  def ranges(self, size):
+    """ranges(size): Returns the list of (start, end, first) ranges of the file, of size compressed bytes, once it has all been read:
+      the start and end offsets of a run of whole gzip members, and the offset of the first record starting in them once decompressed"""
+    if not self.valid or self.head:
+      return None # Not four line FASTQ records, or the file ends within the first three lines of a record
+    starts = list(self.starts)
+    firsts = list(self.firsts)
+    if self.to_skip or self.head == '':
+      # The last range holds no records: the range before it reads on to the end of the file
+      starts.pop()
+      firsts.pop()
+    return zip(starts, starts[1:] + [size], firsts)
+
+def read_gzip_indexing(fqfile, indexer, block_size=1 << 24):
+  """read_gzip_indexing(fqfile, indexer): Yields the decompressed contents of a gzipped file in large blocks, as read_blocks does,
+    also handing the data and the ends of its gzip members to indexer (a GzipIndexer)."""
+  with open(fqfile, 'rb') as f:
+    position = 0
+    decompressor = new_decompressor()
+    while True:
+      data = f.read(block_size)
+      if not data:
+        break
+      position += len(data)
+      block = decompressor.decompress(data)
+      indexer.add(block)
+      while decompressor.unused_data: # Start of the next gzip member
+        data = decompressor.unused_data
+        member_tail = decompressor.flush()
+        indexer.add(member_tail)
+        indexer.member_end(position - len(data))
+        decompressor = new_decompressor()
+        member_start = decompressor.decompress(data)
+        indexer.add(member_start)
+        block += member_tail + member_start
+      if block:
+        yield block
+    block = decompressor.flush()
+    indexer.add(block)
+    if block:
+      yield block
+
+def build_gzip_index(fqfile, chunk_bytes=None):
+  """build_gzip_index(fqfile, chunk_bytes): Reads through a gzipped FASTQ file, returning its ranges as GzipIndexer.ranges does
+    (None if it is not made up of plain four line FASTQ records)"""
+  indexer = GzipIndexer(chunk_bytes)
+  for block in read_gzip_indexing(fqfile, indexer):
+    pass
+  return indexer.ranges(os.path.getsize(fqfile))
+
+def load_gzip_index(fqfile):
+  """load_gzip_index(fqfile): Returns the ranges of a gzipped FASTQ file from its index file, or None if there is no up to date index"""
+  try:
+    with open(gzip_index_file(fqfile), 'rb') as f:
+      index = cPickle.load(f)
+    stat = os.stat(fqfile)
+    if index['version'] == gzip_index_version and index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+      return index['ranges']
+  except (IOError, OSError, EOFError, KeyError, TypeError, cPickle.UnpicklingError):
+    pass
+  return None
+
+def save_gzip_index(fqfile, ranges):
+  """save_gzip_index(fqfile, ranges): Saves the ranges of a gzipped FASTQ file next to it, where possible"""
+  stat = os.stat(fqfile)
+  index = {'version': gzip_index_version, 'size': stat.st_size, 'mtime': stat.st_mtime, 'ranges': ranges}
+  try:
+    with open(gzip_index_file(fqfile), 'wb') as f:
+      cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+  except (IOError, OSError):
+    print "Could not save the gzip index", gzip_index_file(fqfile), "- it will be rebuilt on the next run."
+
+def gzip_index(fqfile):
+  """gzip_index(fqfile): Returns the ranges of a gzipped FASTQ file (see build_gzip_index), from its index file if up to date,
+    otherwise building the index in a pass of its own and saving it next to the file where possible"""
+  ranges = load_gzip_index(fqfile)
+  if ranges is not None:
+    return ranges
+
+  print "Indexing gzip members of", fqfile
+  ranges = build_gzip_index(fqfile)
+  if ranges is not None:
+    save_gzip_index(fqfile, ranges)
+  return ranges
+
+def decompress_members(data):
+  """decompress_members(data): Decompresses a string of one or more whole gzip members"""
+  blocks = []
+  while data:
+    decompressor = new_decompressor()
+    blocks.append(decompressor.decompress(data))
+    blocks.append(decompressor.flush())
+    data = decompressor.unused_data
+  return ''.join(blocks)
+
+def decompress_prefix(f, length, block_size=1 << 16):
+  """decompress_prefix(f, length): Returns the first length bytes of the gzip members from the current position of file f"""
+  blocks = []
+  have = 0
+  decompressor = new_decompressor()
+  while have < length:
+    data = f.read(block_size)
+    if not data:
+      break
+    while data:
+      block = decompressor.decompress(data)
+      data = decompressor.unused_data
+      if data:
+        block += decompressor.flush()
+        decompressor = new_decompressor()
+      blocks.append(block)
+      have += len(block)
+  return ''.join(blocks)[:length]
+
+def read_gzip_range(fqfile, gzip_range, next_range=None):
+  """read_gzip_range(fqfile, gzip_range, next_range): Returns the decompressed FASTQ records starting in one range of a gzip file,
+    including the end of the last one, which is read from the start of the next range"""
+  start, end, first = gzip_range
+  with open(fqfile, 'rb') as f:
+    f.seek(start)
+    data = decompress_members(f.read(end - start))[first:]
+    if next_range and next_range[2]:
+      f.seek(next_range[0])
+      data += decompress_prefix(f, next_range[2])
+  return data
+
 #####################################
 ############# DECOMBINE #############
 #####################################
 
-def vanalysis(read, inputargs):
+def vanalysis(read, hits, inputargs, tags, counts, stages):
 
   half_tag_threshold = inputargs['tagthreshold']
-  hold_v = v_key.findall(read)
+  v_seqs = tags.seqs['v']
+  jump_to_end_v = tags.jumps['v']
+  v_half_split = tags.half_split['v']
+  hold_v = hits[('full', 'v')]
   
   if hold_v:
     if len(hold_v) > 1:
       counts['multiple_v_matches'] += 1
       return
-    v_match = v_seqs.index(hold_v[0][0]) # Assigns V
+    v_match = tags.tag_to_index['v'][hold_v[0][0]] # Assigns V
     temp_end_v = hold_v[0][1] + jump_to_end_v[v_match] - 1 # Finds where the end of a full V would be
     
     v_seq_start = hold_v[0][1]      
-    end_v_v_dels = get_v_deletions( read, v_match, temp_end_v, v_regions )      
+    end_v_v_dels = stages.get_v_deletions( read, v_match, temp_end_v, tags.regions['v'], tags.deletion_windows['v'], counts )      
     if end_v_v_dels: # If the number of deletions has been found
       return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
+
+  elif tags.variant_distance:
+
+    # Look the tag up from its variants, instead of by half tags
+    hold_vv = tags.find_variants(read, 'v', hits)
+
+    if hold_vv:
+      for i in range(len(hold_vv)):
+        for k in tags.variant_to_indices['v'][hold_vv[i][0]]:
+          v_match = k
+          temp_end_v = hold_vv[i][1] + jump_to_end_v[v_match] - 1 # Finds where the end of a full V would be
+          end_v_v_dels = stages.get_v_deletions( read, v_match, temp_end_v, tags.regions['v'], tags.deletion_windows['v'], counts )
+          if end_v_v_dels:
+            counts['vvariant'] += 1
+            v_seq_start = hold_vv[i][1]
+            return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
+      counts['foundvvariantnotassigned'] += 1
+      return
+
+    else:
+      counts['no_vtags_found'] += 1
+      return
       
   else:
     
-    hold_v1 = half1_v_key.findall(read)
+    hold_v1 = hits[('half1', 'v')]
     
     if hold_v1:
       for i in range(len(hold_v1)):
-        indices = [y for y, x in enumerate(half1_v_seqs) if x == hold_v1[i][0] ]
+        indices = tags.half1_to_indices['v'][hold_v1[i][0]]
         for k in indices:
-          if len(v_seqs[k]) == len(read[hold_v1[i][1]:hold_v1[i][1]+len(v_seqs[half1_v_seqs.index(hold_v1[i][0])])]):
+          if len(v_seqs[k]) == len(read[hold_v1[i][1]:hold_v1[i][1]+len(v_seqs[indices[0]])]):
             if lev.hamming( v_seqs[k], read[hold_v1[i][1]:hold_v1[i][1]+len(v_seqs[k])] ) <= half_tag_threshold:
               counts['verr2'] += 1
               v_match = k
               temp_end_v = hold_v1[i][1] + jump_to_end_v[v_match] - 1 # Finds where the end of a full V would be
-              end_v_v_dels = get_v_deletions( read, v_match, temp_end_v, v_regions )
+              end_v_v_dels = stages.get_v_deletions( read, v_match, temp_end_v, tags.regions['v'], tags.deletion_windows['v'], counts )
               if end_v_v_dels:
                 v_seq_start = hold_v1[i][1]  
                 return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
@@ -295,17 +743,17 @@ def vanalysis(read, inputargs):
     
     else:
       
-      hold_v2 = half2_v_key.findall(read)
+      hold_v2 = hits[('half2', 'v')]
       if hold_v2:
         for i in range(len(hold_v2)):
-          indices = [y for y, x in enumerate(half2_v_seqs) if x == hold_v2[i][0] ]
+          indices = tags.half2_to_indices['v'][hold_v2[i][0]]
           for k in indices:
-            if len(v_seqs[k]) == len(read[hold_v2[i][1]-v_half_split:hold_v2[i][1]-v_half_split+len(v_seqs[half2_v_seqs.index(hold_v2[i][0])])]):
+            if len(v_seqs[k]) == len(read[hold_v2[i][1]-v_half_split:hold_v2[i][1]-v_half_split+len(v_seqs[indices[0]])]):
               if lev.hamming( v_seqs[k], read[hold_v2[i][1]-v_half_split:hold_v2[i][1]+len(v_seqs[k])-v_half_split] ) <= half_tag_threshold:
                 counts['verr1'] += 1
                 v_match = k
                 temp_end_v = hold_v2[i][1] + jump_to_end_v[v_match] - v_half_split - 1 # Finds where the end of a full V would be
-                end_v_v_dels = get_v_deletions( read, v_match, temp_end_v, v_regions )
+                end_v_v_dels = stages.get_v_deletions( read, v_match, temp_end_v, tags.regions['v'], tags.deletion_windows['v'], counts )
                 if end_v_v_dels:
                   v_seq_start = hold_v2[i][1] - v_half_split      
                   return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
@@ -316,60 +764,85 @@ def vanalysis(read, inputargs):
         counts['no_vtags_found'] += 1
         return
       
-def janalysis(read, inputargs):
+def janalysis(read, hits, inputargs, tags, counts, stages):
   
   half_tag_threshold = inputargs['tagthreshold']
+  j_seqs = tags.seqs['j']
+  jump_to_start_j = tags.jumps['j']
+  j_half_split = tags.half_split['j']
 
-  hold_j = j_key.findall(read)
+  hold_j = hits[('full', 'j')]
   
   if hold_j:
     if len(hold_j) > 1:
       counts['multiple_j_matches'] += 1
       return
   
-    j_match = j_seqs.index(hold_j[0][0]) # Assigns J
+    j_match = tags.tag_to_index['j'][hold_j[0][0]] # Assigns J
     temp_start_j = hold_j[0][1] - jump_to_start_j[j_match] # Finds where the start of a full J would be
     
     j_seq_end = hold_j[0][1] + len(hold_j[0][0])      
         
-    start_j_j_dels = get_j_deletions( read, j_match, temp_start_j, j_regions )
+    start_j_j_dels = stages.get_j_deletions( read, j_match, temp_start_j, tags.regions['j'], tags.deletion_windows['j'], counts )
     
     if start_j_j_dels: # If the number of deletions has been found
 
       return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
+
+  elif tags.variant_distance:
+
+    # Look the tag up from its variants, instead of by half tags
+    hold_jv = tags.find_variants(read, 'j', hits)
+
+    if hold_jv:
+      for i in range(len(hold_jv)):
+        for k in tags.variant_to_indices['j'][hold_jv[i][0]]:
+          j_match = k
+          temp_start_j = hold_jv[i][1] - jump_to_start_j[j_match] # Finds where the start of a full J would be
+          start_j_j_dels = stages.get_j_deletions( read, j_match, temp_start_j, tags.regions['j'], tags.deletion_windows['j'], counts )
+          if start_j_j_dels:
+            counts['jvariant'] += 1
+            j_seq_end = hold_jv[i][1] + len(hold_jv[i][0])
+            return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
+      counts['foundjvariantnotassigned'] += 1
+      return
+
+    else:
+      counts['no_j_assigned'] += 1
+      return
           
   else:
     
-    hold_j1 = half1_j_key.findall(read)
+    hold_j1 = hits[('half1', 'j')]
     if hold_j1:
       for i in range(len(hold_j1)):
-        indices = [y for y, x in enumerate(half1_j_seqs) if x == hold_j1[i][0] ]
+        indices = tags.half1_to_indices['j'][hold_j1[i][0]]
         for k in indices:
-          if len(j_seqs[k]) == len(read[hold_j1[i][1]:hold_j1[i][1]+len(j_seqs[half1_j_seqs.index(hold_j1[i][0])])]):
+          if len(j_seqs[k]) == len(read[hold_j1[i][1]:hold_j1[i][1]+len(j_seqs[indices[0]])]):
             if lev.hamming( j_seqs[k], read[hold_j1[i][1]:hold_j1[i][1]+len(j_seqs[k])] ) <= half_tag_threshold:
               counts['jerr2'] += 1
               j_match = k
               temp_start_j = hold_j1[i][1] - jump_to_start_j[j_match] # Finds where the start of a full J would be
               j_seq_end = hold_j1[i][1] + len(hold_j1[i][0]) + j_half_split                                              
-              start_j_j_dels = get_j_deletions( read, j_match, temp_start_j, j_regions )
+              start_j_j_dels = stages.get_j_deletions( read, j_match, temp_start_j, tags.regions['j'], tags.deletion_windows['j'], counts )
               if start_j_j_dels:
                 return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
       counts['foundj1notj2'] += 1
       return              
             
     else:        
-      hold_j2 = half2_j_key.findall(read)
+      hold_j2 = hits[('half2', 'j')]
       if hold_j2:
         for i in range(len(hold_j2)):
-          indices = [y for y, x in enumerate(half2_j_seqs) if x == hold_j2[i][0] ]
+          indices = tags.half2_to_indices['j'][hold_j2[i][0]]
           for k in indices:
-            if len(j_seqs[k]) == len(read[hold_j2[i][1]-j_half_split:hold_j2[i][1]-j_half_split+len(j_seqs[half2_j_seqs.index(hold_j2[i][0])])]):
+            if len(j_seqs[k]) == len(read[hold_j2[i][1]-j_half_split:hold_j2[i][1]-j_half_split+len(j_seqs[indices[0]])]):
               if lev.hamming( j_seqs[k], read[hold_j2[i][1]-j_half_split:hold_j2[i][1]+len(j_seqs[k])-j_half_split] ) <= half_tag_threshold:
                 counts['jerr1'] += 1
                 j_match = k
                 temp_start_j = hold_j2[i][1] - jump_to_start_j[j_match] - j_half_split # Finds where the start of a full J would be
                 j_seq_end = hold_j2[i][1] + len(hold_j2[i][0])                                                
-                start_j_j_dels = get_j_deletions( read, j_match, temp_start_j, j_regions )
+                start_j_j_dels = stages.get_j_deletions( read, j_match, temp_start_j, tags.regions['j'], tags.deletion_windows['j'], counts )
                 if start_j_j_dels:
                   return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
         counts['foundv2notv1'] += 1
@@ -379,51 +852,31 @@ def janalysis(read, inputargs):
          counts['no_j_assigned'] += 1
          return
        
-def dcr(read, inputargs, chain_order):
+def dcr(read, inputargs, tags, counts, hits=None, stages=None):
 
   """dcr(read): Core function which checks a read (in the given frame) for a rearranged TCR of the specified chain.
     Returns a list giving: V gene index (if found), J gene index (if found), seq from end of V tag to end or read
     (or from start of read to start of J tag), position of end of V tag in read (or position of start of read), 
     position of end of read (or position of start of J tag in read). The last two fields are used to find the 
     appropriate quality score of the relevant sequence.
+    If the tag matches for the read have already been found (with TagIndex.scan or scan_strands) they can be passed in as hits.
+    The stage functions are called through stages (a DcrStages, plain_stages if not given).
      """
 
-  vdat = vanalysis(read, inputargs)
+  stages = stages or plain_stages
+
+  if hits is None:
+    hits = stages.scan(tags, read) # A single pass finds full and half tags of both genes
+
+  vdat = stages.vanalysis(read, hits, inputargs, tags, counts, stages)
   
-  jdat = janalysis(read, inputargs)
+  jdat = stages.janalysis(read, hits, inputargs, tags, counts, stages)
 
   if vdat:
-    v_chain_order = []
-    lim = 0
-    v_seq_count = 0
-    for i in range(len(chain_order)):
-      if 'v' in chain_order[i]:
-        v_chain_order.append(chain_order[i])
-
-    for i in range(len(v_chain_order)):
-      v_seq_count = lim
-      lim += v_chain_order[i][2]
-      if vdat[0] < lim:
-        chain_type = v_chain_order[i][0]
-        break
-    vindex = vdat[0] - v_seq_count #adjusts to give correct index if analysing for multiple chainnams
-
+    chain_type, vindex = tags.index_to_chain['v'][vdat[0]] # Local index gives correct index if analysing for multiple chains
 
   if jdat:
-    j_chain_order = []
-    lim = 0
-    j_seq_count = 0
-    for i in range(len(chain_order)):
-      if 'j' in chain_order[i]:
-        j_chain_order.append(chain_order[i])
-
-    for i in range(len(j_chain_order)):
-      j_seq_count = lim
-      lim += j_chain_order[i][2]
-      if jdat[0] < lim:
-        chain_type = j_chain_order[i][0]
-        break
-    jindex = jdat[0] - j_seq_count
+    chain_type, jindex = tags.index_to_chain['j'][jdat[0]]
 
   if not vdat:
     #vdat = ["n/a"]
@@ -433,12 +886,10 @@ def dcr(read, inputargs, chain_order):
     jindex = "n/a"
 
   if jindex != "n/a":
-    start_of_j = jdat[3]-len(j_seqs[jdat[0]])   
     j_details = [vindex, jindex, read[0:jdat[3]], 0, jdat[3], chain_type]
     return j_details
 
   elif vindex != "n/a":
-    end_of_v = vdat[3]+len(v_seqs[vdat[0]])
     v_details = [vindex, jindex, read[vdat[3]:len(read)], vdat[3], len(read), chain_type]
     return v_details
   else:
@@ -449,6 +900,8 @@ def dcr(read, inputargs, chain_order):
 ############# ANCILLARY DECOMBINING FUNCTIONS #############
 ###########################################################
 
+chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
+
 def get_chain(inputargs):
 
   nochain_error = "TCR chains not recognised. \n \
@@ -456,21 +909,15 @@ def get_chain(inputargs):
       or use the \'-c\' flag with an explicit chain option (a/b/g/d, case-insensitive).\n \
       Decombinator accepts a/b/g/d chains only."
 
-  global chainnams, counts
-  counts = coll.Counter()
-
-  chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
-   
   # Detect whether chain specified in filename
-  inner_filename_chains = [x for x in chainnams.values() if x in inputargs['fastq'].lower()]
-  counts['chain_detected'] = len(inner_filename_chains)
+  inner_filename_chains = filename_chains(inputargs)
   
 
   if inputargs['chain']:
     input_chains = inputargs['chain'].upper().split(" ")
   else:
     # If no chain provided, try and infer from filename
-    if counts['chain_detected'] >= 1:
+    if len(inner_filename_chains) >= 1:
       
       input_chains = [c[0].upper() for c in inner_filename_chains]
     
@@ -498,17 +945,226 @@ def get_chain(inputargs):
     chains = list(set(chains))
   return chains
 
+def filename_chains(inputargs):
+  """filename_chains(inputargs): Returns the chain names spelt out in full in the input file name"""
+  return [x for x in chainnams.values() if x in inputargs['fastq'].lower()]
+
 def flatten(l):
   return [item for sublist in l for item in sublist]
 
-
+def build_automaton(keywords):
+  """build_automaton(keywords): Builds an Aho-Corasick automaton (keyword trie) over the given sequences"""
+  builder = AcoraBuilder()
+  for keyword in keywords:
+    builder.add(str(keyword))
+  return builder.build()
+
+def group_indices(seqs):
+  """group_indices(seqs): Maps each distinct sequence to the tuple of indices at which it occurs"""
+  grouped = {}
+  for i in range(len(seqs)):
+    grouped.setdefault(seqs[i], []).append(i)
+  return dict((seq, tuple(indices)) for seq, indices in grouped.items())
+
+variant_bases = 'ACGTN' # Including N, as the half tag path (by hamming distance) also assigns tags with Ns in them
+
+def tag_variants(tag, distance):
+  """tag_variants(tag, distance): Yields every sequence that differs from tag by between 1 and distance base substitutions"""
+  for n in range(1, distance + 1):
+    for positions in itertools.combinations(range(len(tag)), n):
+      for bases in itertools.product(variant_bases, repeat=n):
+        if any(tag[p] == b for p, b in zip(positions, bases)):
+          continue # Not a substitution, so covered by a smaller n
+        variant = list(tag)
+        for p, b in zip(positions, bases):
+          variant[p] = b
+        yield ''.join(variant)
+
+class TagIndex(object):
+  """TagIndex: Compiled, read-only V and J tag information for the chains being decombined.
+    Each attribute below is a dict keyed on gene ('v' or 'j'):
+      seqs, half1_seqs, half2_seqs, jumps, regions: tuples indexed by tag index (tag indices run across all chains in chain_order)
+      tag_to_index: full tag -> tag index
+      half1_to_indices, half2_to_indices: half tag -> tuple of the indices of all tags sharing that half
+      index_to_chain: tuple giving (chain, index within that chain's tag file) for each tag index
+      variant_to_indices: every sequence within variant_distance substitutions of a tag (but not itself a tag of that gene)
+        -> tuple of the indices of the tags it is a variant of; empty unless variant_distance is set
+      deletion_windows: per tag index, the region's 10-mers tried when counting deletions, indexed by number of deletions;
+        for V the 10-mer ending that many bases before the region's end, for J the one starting that many bases after its start
+    All full and half tags of both genes go into one Aho-Corasick automaton, so that each read only needs scanning once (see scan).
+    A second automaton also holds their reverse complements, to find tags on both strands in one scan (see scan_strands).
+    Variants are too many to build into an automaton cheaply, so each tag is split into variant_distance + 1 pieces, one of which any variant
+    of it must hold unchanged. Only the windows of a read around matches of the pieces are looked up in variant_to_indices (see find_variants).
+    Within one substitution the pieces are the half tags, which the scan has already found; otherwise they have an automaton of their own.
+    The automata are built on first use (see __getattr__) rather than pickled, so the index can be handed to worker processes,
+    and a run loading it from the tag cache only builds the automaton it scans with."""
+
+  genes = ('v', 'j')
+  kinds = ('full', 'half1', 'half2')
+
+  def __init__(self, chain, chain_order, half_split, seqs, half1_seqs, half2_seqs, jumps, regions, variant_distance=0):
+    self.chain = tuple(chain)
+    self.variant_distance = variant_distance
+    self.chain_order = tuple(tuple(c) for c in chain_order)
+    self.half_split = dict(half_split)
+    self.labels = tuple([(kind, gene) for gene in self.genes for kind in self.kinds])
+    self.seqs = {}
+    self.half1_seqs = {}
+    self.half2_seqs = {}
+    self.jumps = {}
+    self.regions = {}
+    self.tag_to_index = {}
+    self.half1_to_indices = {}
+    self.half2_to_indices = {}
+    self.variant_to_indices = {}
+    self.index_to_chain = {}
+    self.deletion_windows = {}
+
+    for gene in self.genes:
+      self.seqs[gene] = tuple(seqs[gene])
+      self.half1_seqs[gene] = tuple(half1_seqs[gene])
+      self.half2_seqs[gene] = tuple(half2_seqs[gene])
+      self.jumps[gene] = tuple(jumps[gene])
+      self.regions[gene] = tuple(str(r) for r in regions[gene])
+
+      self.tag_to_index[gene] = {}
+      for i in range(len(self.seqs[gene])):
+        self.tag_to_index[gene].setdefault(self.seqs[gene][i], i) # Duplicated tags resolve to their first index, as list.index did
+      self.half1_to_indices[gene] = group_indices(self.half1_seqs[gene])
+      self.half2_to_indices[gene] = group_indices(self.half2_seqs[gene])
+
+      variant_to_indices = {}
+      for i in range(len(self.seqs[gene])):
+        for variant in tag_variants(self.seqs[gene][i], self.variant_distance):
+          if variant not in self.tag_to_index[gene]:
+            variant_to_indices.setdefault(variant, []).append(i)
+      self.variant_to_indices[gene] = dict((v, tuple(indices)) for v, indices in variant_to_indices.items())
+
+      index_to_chain = []
+      for c, g, n in self.chain_order:
+        if g == gene:
+          index_to_chain.extend([(c, i) for i in range(n)])
+      self.index_to_chain[gene] = tuple(index_to_chain)
+
+      # Slices as compared in get_v_deletions/get_j_deletions, which fall back to slicing the region beyond the end of these tables
+      if gene == 'v':
+        self.deletion_windows[gene] = tuple([tuple([r[len(r)-10-n:len(r)-n] for n in range(len(r)-9)]) for r in self.regions[gene]])
+      else:
+        self.deletion_windows[gene] = tuple([tuple([r[n:n+10] for n in range(len(r))]) for r in self.regions[gene]])
+
+    self.label_keywords()
+
+  def label_keywords(self):
+    # Label every keyword with each (kind, gene) tag set it belongs to, as e.g. a V and J half tag can coincide
+    self.keyword_labels = {}
+    self.rc_keyword_labels = {}
+    self.rc_keywords = {}
+    for gene in self.genes:
+      for kind, kind_seqs in zip(self.kinds, [self.seqs, self.half1_seqs, self.half2_seqs]):
+        for keyword in set(kind_seqs[gene]):
+          self.keyword_labels.setdefault(keyword, []).append((kind, gene))
+          self.rc_keyword_labels.setdefault(revcomp(keyword), []).append((kind, gene))
+          self.rc_keywords[revcomp(keyword)] = keyword
+
+  def __getattr__(self, name):
+    # Only called for attributes not yet set: builds each automaton the first time it is needed, after which it is found directly
+    if name == 'automaton':
+      self.automaton = build_automaton(self.keyword_labels)
+      return self.automaton
+    if name == 'strand_automaton':
+      self.strand_automaton = build_automaton(set(self.keyword_labels) | set(self.rc_keyword_labels))
+      return self.strand_automaton
+    if name == 'variant_pieces':
+      self.variant_pieces = {}
+      for gene in self.genes:
+        # Piece -> the (offset in the tag, tag length) it was cut from, for every tag with variants
+        pieces = {}
+        for i in set(i for indices in self.variant_to_indices[gene].values() for i in indices):
+          tag = self.seqs[gene][i]
+          if self.variant_distance == 1:
+            cuts = [0, self.half_split[gene], len(tag)]
+          else:
+            cuts = [k * len(tag) // (self.variant_distance + 1) for k in range(self.variant_distance + 2)]
+          for start, end in zip(cuts, cuts[1:]):
+            if end > start:
+              pieces.setdefault(tag[start:end], set()).add((start, len(tag)))
+        self.variant_pieces[gene] = pieces
+      return self.variant_pieces
+    if name == 'variant_automata':
+      self.variant_automata = dict((gene, build_automaton(self.variant_pieces[gene])) for gene in self.genes)
+      return self.variant_automata
+    raise AttributeError(name)
+
+  def scan(self, read):
+    """scan(read): Runs the combined automaton over a read, returning the (tag, position) matches of each tag set keyed on (kind, gene).
+      Matches keep the order that a findall over that tag set alone would give."""
+    hits = {}
+    for label in self.labels:
+      hits[label] = []
+    for match in self.automaton.findall(read):
+      for label in self.keyword_labels[match[0]]:
+        hits[label].append(match)
+    return hits
+
+  def find_variants(self, read, gene, hits):
+    """find_variants(read, gene, hits): Looks the windows of the read holding a piece of a tag up in variant_to_indices, returning
+      (variant, position) matches by position (then length), as looking up every window would. hits are the read's matches from scan."""
+    if self.variant_distance == 1:
+      piece_matches = hits[('half1', gene)] + hits[('half2', gene)]
+    else:
+      piece_matches = self.variant_automata[gene].findall(read)
+    windows = set()
+    pieces = self.variant_pieces[gene]
+    for piece, pos in piece_matches:
+      for offset, length in pieces.get(piece, ()): # A half tag may be cut from a tag with no variants
+        start = pos - offset
+        if start >= 0 and start + length <= len(read):
+          windows.add((start, length))
+    variants = self.variant_to_indices[gene]
+    matches = []
+    for start, length in sorted(windows):
+      if read[start:start+length] in variants:
+        matches.append((read[start:start+length], start))
+    return matches
+
+  def scan_strands(self, read):
+    """scan_strands(read): Scans a read once for tags on both strands, returning (forward hits, reverse hits), each as given by scan.
+      Reverse hits are those scan would find in the reverse complement of the read, positioned and ordered as in that sequence."""
+    forward = {}
+    reverse = {}
+    for label in self.labels:
+      forward[label] = []
+      reverse[label] = []
+    read_len = len(read)
+    for match in self.strand_automaton.findall(read):
+      if match[0] in self.keyword_labels:
+        for label in self.keyword_labels[match[0]]:
+          forward[label].append(match)
+      if match[0] in self.rc_keyword_labels:
+        rc_match = (self.rc_keywords[match[0]], read_len - match[1] - len(match[0]))
+        for label in self.rc_keyword_labels[match[0]]:
+          reverse[label].append(rc_match)
+    # The automaton reports matches by end position, then start position; restore that order for the reversed strand
+    for label in self.labels:
+      if len(reverse[label]) > 1:
+        reverse[label].sort(key=lambda m: (m[1] + len(m[0]), m[1]))
+    return forward, reverse
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop('automaton', None)
+    state.pop('strand_automaton', None)
+    state.pop('variant_automata', None)
+    state.pop('variant_pieces', None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
 
 def import_tcr_info(inputargs):
   """ import_tcr_info: Gathers the required TCR chain information for Decombining """
     
   # Get chain information
-  global chain
-
   chain = get_chain(inputargs)
 
   #################################################
@@ -533,11 +1189,10 @@ def import_tcr_info(inputargs):
 
   # Set tag split position, and check tag set. Note that original tags use shorter length J half tags, as these tags were originally shorter.
 
-  global v_half_split, j_half_split
   if inputargs['tags'] == "extended":
-    v_half_split, j_half_split = [10,10] 
+    half_split = {'v': 10, 'j': 10}
   elif inputargs['tags'] == "original":
-    v_half_split, j_half_split = [10,6] 
+    half_split = {'v': 10, 'j': 6}
   else:
     print "Tag set unrecognised; should be either \'extended\' or \'original\' for human, or just \'original\' for mouse. \n \
     Please check tag set and species flag."
@@ -554,7 +1209,24 @@ def import_tcr_info(inputargs):
     # Note that fasta/tag files fit the pattern "species_tagset_gene.[fasta/tags]"
     # I.e. "[human/mouse]_[extended/original]_TR[A/B/G/D][V/J].[fasta/tags]"
   
-  chain_order= []
+  if inputargs['tagvariants']:
+    variant_distance = inputargs['tagthreshold']
+  else:
+    variant_distance = 0
+
+  # Use the compiled tags from a previous run if possible
+  if inputargs['tagcache']:
+    cache_file = tag_cache_file(inputargs, chain, variant_distance)
+    source_hash = tag_source_hash(inputargs, chain)
+    tags = load_cached_tags(cache_file, source_hash)
+    if tags:
+      print 'Loaded compiled tags from', cache_file
+      return tags
+
+  from Bio import SeqIO # Only needed when parsing the FASTA files, so not imported when using cached tags
+
+  chain_order = []
+  seqs, half1_seqs, half2_seqs, jumps, regions = {}, {}, {}, {}, {}
 
   for gene in ['v', 'j']:
 
@@ -562,17 +1234,11 @@ def import_tcr_info(inputargs):
     fasta_holder = []
 
     for i in range(len(chain)):
-      fasta_file = read_tcr_file(inputargs['species'], inputargs['tags'], chain[i], gene, "fasta", inputargs['tagfastadir'])  
+      fasta_file = read_tcr_file(inputargs['species'], inputargs['tags'], chain[i], gene, "fasta", inputargs['tagfastadir'], inputargs['offline'])  
       fasta_holder.append(list(SeqIO.parse(fasta_file, "fasta")))
       fasta_file.close()
-      chain
-    globals()[gene + "_genes"] = flatten(fasta_holder)
-    
-    
-    
-    globals()[gene+"_regions"] = []
-    for g in range(0, len(globals()[gene+"_genes"])):
-        globals()[gene+"_regions"].append(string.upper(globals()[gene+"_genes"][g].seq))  
+
+    regions[gene] = [string.upper(g.seq) for g in flatten(fasta_holder)]
         
     # Get tag data
 
@@ -582,10 +1248,8 @@ def import_tcr_info(inputargs):
     jumpfunction_holder = []
 
     for i in range(len(chain)):
-      tag_file = read_tcr_file(inputargs['species'], inputargs['tags'], chain[i], gene, "tags", inputargs['tagfastadir'])  # get tag data
-      if gene == 'v': jumpfunction = "jump_to_end_v"
-      elif gene == 'j': jumpfunction = "jump_to_start_j"
-      tag_info_holder = globals()["get_"+gene+"_tags"](tag_file, globals()[gene+"_half_split"])
+      tag_file = read_tcr_file(inputargs['species'], inputargs['tags'], chain[i], gene, "tags", inputargs['tagfastadir'], inputargs['offline'])  # get tag data
+      tag_info_holder = globals()["get_"+gene+"_tags"](tag_file, half_split[gene])
       gene_seq_holder.append(tag_info_holder[0])
       half1_gene_seq_holder.append(tag_info_holder[1])
       half2_gene_seq_holder.append(tag_info_holder[2])
@@ -593,49 +1257,101 @@ def import_tcr_info(inputargs):
       chain_order.append([chain[i],gene, len(gene_seq_holder[i])])
       tag_file.close()
 
-    globals()[gene+"_seqs"] = flatten(gene_seq_holder)
-    globals()["half1_"+gene+"_seqs"] = flatten(half1_gene_seq_holder)
-    globals()["half2_"+gene+"_seqs"] = flatten(half2_gene_seq_holder)
-    globals()[jumpfunction] = flatten(jumpfunction_holder)
+    seqs[gene] = flatten(gene_seq_holder)
+    half1_seqs[gene] = flatten(half1_gene_seq_holder)
+    half2_seqs[gene] = flatten(half2_gene_seq_holder)
+    jumps[gene] = flatten(jumpfunction_holder)
+
+  # Compile lookup tables and build the Aho-Corasick trie over full and split, half-tags
+  tags = TagIndex(chain, chain_order, half_split, seqs, half1_seqs, half2_seqs, jumps, regions, variant_distance)
 
-    # Build Aho-Corasick tries
-    globals()[gene+"_builder"] = AcoraBuilder()
-    for i in range(0,len(globals()[gene+"_seqs"])):
-        globals()[gene+"_builder"].add(str(globals()[gene+"_seqs"][i])) # Add all V tags to keyword trie
-    globals()[gene+"_key"] = globals()[gene+"_builder"].build()
+  if inputargs['tagcache']:
+    save_cached_tags(cache_file, source_hash, tags)
+    print 'Saved compiled tags to', cache_file
 
-    # And tries for split, half-tags
-    globals()[gene+"_half1_builder"] = AcoraBuilder()
-    for i in range(0,len(globals()["half1_"+gene+"_seqs"])):
-        globals()[gene+"_half1_builder"].add(str(globals()["half1_"+gene+"_seqs"][i]))
-    globals()["half1_"+gene+"_key"] = globals()[gene+"_half1_builder"].build()
+  return tags
 
-    globals()[gene+"_half2_builder"] = AcoraBuilder()
-    for i in range(0,len(globals()["half2_"+gene+"_seqs"])):
-        globals()[gene+"_half2_builder"].add(str(globals()["half2_"+gene+"_seqs"][i]))
-    globals()["half2_"+gene+"_key"] = globals()[gene+"_half2_builder"].build()
+##############################################
+############# COMPILED TAG CACHE #############
+##############################################
 
-  return chain_order
+tag_cache_format = 2 # Increase whenever TagIndex changes, to invalidate existing caches
 
-def get_v_deletions( read, v_match, temp_end_v, v_regions_cut ):
+def tag_cache_file(inputargs, chain, variant_distance):
+  """ Gives the path of the cached TagIndex for this species, tag set, chains and variant distance """
+  return os.path.join(inputargs['tagcache'], "_".join([inputargs['species'], inputargs['tags'], "".join(chain), \
+    "variants" + str(variant_distance), "v" + __version__]) + ".tagindex")
+
+def tag_source_hash(inputargs, chain):
+  """ MD5 of the contents of the local FASTA and tag files the tags would be built from, or None if any are not available locally """
+  source_hash = hashlib.md5()
+  for gene in ['v', 'j']:
+    for c in chain:
+      for filetype in ['fasta', 'tags']:
+        fl = find_local_tcr_file(tcr_file_name(inputargs['species'], inputargs['tags'], c, gene, filetype), inputargs['tagfastadir'])
+        if not fl:
+          return None
+        with open(fl, 'rb') as source_file:
+          source_hash.update(source_file.read())
+  return source_hash.hexdigest()
+
+def load_cached_tags(cache_file, source_hash):
+  """ Returns the cached TagIndex, or None if there is none or it is out of date.
+    If the source files are not available locally (source_hash is None) the cached copy is trusted, so no network access is needed. """
+  if not os.path.isfile(cache_file):
+    return None
+  try:
+    with open(cache_file, 'rb') as f:
+      cached = cPickle.load(f)
+  except Exception:
+    print "Ignoring unreadable tag cache file", cache_file
+    return None
+  if cached['format'] != tag_cache_format or (source_hash and cached['source_hash'] != source_hash):
+    return None
+  # The state is stored rather than the TagIndex itself, so it does not matter what module TagIndex was pickled from
+  tags = TagIndex.__new__(TagIndex)
+  tags.__setstate__(cached['state'])
+  return tags
+
+def save_cached_tags(cache_file, source_hash, tags):
+  """ Saves the TagIndex for later runs. Writes to a temporary file first, so concurrent runs never read a partly written cache """
+  cache_dir = os.path.dirname(cache_file)
+  if cache_dir and not os.path.exists(cache_dir):
+    try:
+      os.makedirs(cache_dir)
+    except OSError: # Made by a concurrent run
+      pass
+  temp_file = cache_file + "." + str(os.getpid()) + ".tmp"
+  with open(temp_file, 'wb') as f:
+    cPickle.dump({'format': tag_cache_format, 'source_hash': source_hash, 'state': tags.__getstate__()}, f, cPickle.HIGHEST_PROTOCOL)
+  os.rename(temp_file, cache_file)
+
+def get_v_deletions( read, v_match, temp_end_v, v_regions_cut, v_end_windows, counts ):
     # This function determines the number of V deletions in sequence read
     # by comparing it to v_match, beginning by making comparisons at the
     # end of v_match and at position temp_end_v in read.
+    # v_end_windows holds the 10-mer of each V region ending n bases before its end, indexed by n (see TagIndex).
     function_temp_end_v = temp_end_v
     pos = len(v_regions_cut[v_match]) -10    # changed from -1 for new checking technique
+    windows = v_end_windows[v_match]
+    read_len = len(read)
     is_v_match = 0
     
     # Catch situations in which the temporary end of the V exists beyond the end of the read
-    if function_temp_end_v >= len(read):
+    if function_temp_end_v >= read_len:
       counts['v_del_failed_tag_at_end'] += 1
       return
     
     function_temp_end_v += 1
     num_del = 0
 
-    while is_v_match == 0 and 0 <= function_temp_end_v < len(read):
+    while is_v_match == 0 and 0 <= function_temp_end_v < read_len:
         # Require a 10 base match to determine where end of germ-line sequence lies
-        if str(v_regions_cut[v_match])[pos:pos+10] == read[function_temp_end_v-10:function_temp_end_v]:
+        if num_del < len(windows):
+            window = windows[num_del]
+        else:
+            window = v_regions_cut[v_match][pos:pos+10]
+        if window == read[function_temp_end_v-10:function_temp_end_v]:
             is_v_match = 1
             deletions_v = num_del            
             end_v = temp_end_v - num_del
@@ -650,16 +1366,23 @@ def get_v_deletions( read, v_match, temp_end_v, v_regions_cut ):
         counts['v_del_failed'] += 1
         return 
 
-def get_j_deletions( read, j_match, temp_start_j, j_regions_cut ):
+def get_j_deletions( read, j_match, temp_start_j, j_regions_cut, j_start_windows, counts ):
     # This function determines the number of J deletions in sequence read
     # by comparing it to j_match, beginning by making comparisons at the
     # end of j_match and at position temp_end_j in read.
+    # j_start_windows holds the 10-mer of each J region starting n bases after its start, indexed by n (see TagIndex).
     function_temp_start_j = temp_start_j
     pos = 0
+    windows = j_start_windows[j_match]
+    read_len = len(read)
     is_j_match = 0
-    while is_j_match == 0 and 0 <= function_temp_start_j+2 < len(str(read)):
+    while is_j_match == 0 and 0 <= function_temp_start_j+2 < read_len:
         # Require a 10 base match to determine where end of germ-line sequence lies
-        if str(j_regions_cut[j_match])[pos:pos+10] == read[function_temp_start_j:function_temp_start_j+10]:
+        if pos < len(windows):
+            window = windows[pos]
+        else:
+            window = j_regions_cut[j_match][pos:pos+10]
+        if window == read[function_temp_start_j:function_temp_start_j+10]:
             is_j_match = 1
             deletions_j = pos
             start_j = function_temp_start_j
@@ -710,69 +1433,689 @@ def get_j_tags(file_j, half_split):
 
     return [j_seqs, half1_j_seqs, half2_j_seqs, jump_to_start_j]
 
-def findTCRs(fqfile, write_type):
-    # Scroll through input file and find TCRs
-  print "Writing to "+name_results+suffix+"..."
-  with open(name_results + suffix, write_type) as outfile:   
-    with opener(fqfile) as f:
-      
-      for readid, seq, qual in readfq(f):
-        start_time = time()
-        
-        if inputargs['nobarcoding'] == False:
-          bc = seq[:30]   
-          vdj = seq[30:] 
-        else:
-          vdj = seq
+def decombine_vdj(vdj, inputargs, tags, counts, stages=None):
+  """decombine_vdj(vdj, inputargs, tags, counts, stages): Runs dcr on the read in the requested orientation(s).
+    Returns (forward recombination, reverse recombination), either of which is None if not found or not searched for."""
 
-        if inputargs['nobarcoding'] == False:
-          if "N" in bc and inputargs['allowNs'] == False:       # Ambiguous base in barcode region
-            counts['dcrfilter_barcodeN'] += 1
-        
-        counts['read_count'] += 1
-        if counts['read_count'] % 100000 == 0 and inputargs['dontcount'] == False:
-          print '\t read', counts['read_count'] 
-    
-        # Get details of the VJ recombination
-
-        if inputargs['orientation'] == 'reverse':
-          frameR = 'reverse'
-          recomR = dcr(revcomp(vdj), inputargs, chain_order)
-          recomF = None
-
-        elif inputargs['orientation'] == 'forward':
-          frameF = 'forward'
-          recomF = dcr(vdj, inputargs, chain_order)
-          recomR = None
-
-        elif inputargs['orientation'] == 'either':              # Looks for reverse, but will look for forward if no reverse found
-          recomR = dcr(revcomp(vdj), inputargs, chain_order)
-          frameR = 'reverse'
-          recomF = None
-          if not recomR:
-            recomF = dcr(vdj, inputargs, chain_order)
-            frameF = 'forward'
-            recomR = None
-
-        elif inputargs['orientation'] == 'both':
-          recomR = dcr(revcomp(vdj), inputargs, chain_order)
-          frameR = 'reverse'
-          recomF = dcr(vdj, inputargs, chain_order)
-          frameF = 'forward'
-
-        if recomR:
-          counts['vj_count'] += 1
-          dcr_string = build_dcr_string(recomR, frameR, qual, readid, stemplate)
-          outfile.write(dcr_string + '\n')
-       
-        if recomF:        
-          counts['vj_count'] += 1
-          dcr_string = build_dcr_string(recomF, frameF, qual, readid, stemplate)
-          outfile.write(dcr_string + '\n')
+  stages = stages or plain_stages
+
+  if inputargs['singlescan']:
+    recomF, recomR = dcr_single_scan(vdj, inputargs, tags, counts, stages)
+
+  elif inputargs['orientation'] == 'reverse':
+    recomR = dcr(stages.revcomp(vdj), inputargs, tags, counts, stages=stages)
+    recomF = None
+
+  elif inputargs['orientation'] == 'forward':
+    recomF = dcr(vdj, inputargs, tags, counts, stages=stages)
+    recomR = None
+
+  elif inputargs['orientation'] == 'either':              # Looks for reverse, but will look for forward if no reverse found
+    recomR = dcr(stages.revcomp(vdj), inputargs, tags, counts, stages=stages)
+    recomF = None
+    if not recomR:
+      recomF = dcr(vdj, inputargs, tags, counts, stages=stages)
+      recomR = None
+
+  elif inputargs['orientation'] == 'both':
+    recomR = dcr(stages.revcomp(vdj), inputargs, tags, counts, stages=stages)
+    recomF = dcr(vdj, inputargs, tags, counts, stages=stages)
+
+  return recomF, recomR
+
+class DcrCache(object):
+  """DcrCache(size): Bounded, least recently used cache of decombine_vdj results keyed on the VDJ sequence.
+    Each entry keeps the counts its sequence added, so that repeat reads still add them to the summary counts.
+    Hits and misses are tallied in counts as cache_hits/cache_misses, so they merge across worker processes like any other count."""
+
+  def __init__(self, size):
+    self.size = size
+    self.entries = coll.OrderedDict()
+
+  def lookup(self, vdj, inputargs, tags, counts, stages=None):
+    entry = self.entries.pop(vdj, None)
+
+    if entry is None:
+      counts['cache_misses'] += 1
+      # Decombine against a fresh Counter, to capture the counts this sequence adds
+      vdj_counts = coll.Counter()
+      recoms = decombine_vdj(vdj, inputargs, tags, vdj_counts, stages)
+      counts.update(vdj_counts)
+      entry = (recoms, vdj_counts.items())
+      if len(self.entries) >= self.size:
+        self.entries.popitem(last=False)
+
+    else:
+      counts['cache_hits'] += 1
+      for count, value in entry[1]:
+        counts[count] += value
+
+    self.entries[vdj] = entry # (Re)inserted as the most recently used
+    return entry[0]
+
+def dcr_single_scan(vdj, inputargs, tags, counts, stages=None):
+  """dcr_single_scan(vdj, inputargs, tags, counts, stages): Equivalent of the orientation handling in decombine_vdj, using one scan of the read for both strands.
+    Only reads with tags found on the reverse strand are reverse complemented. Returns (forward recombination, reverse recombination)."""
+
+  stages = stages or plain_stages
+  forward_hits, reverse_hits = stages.scan_strands(tags, vdj)
+  recomF = None
+  recomR = None
+
+  if inputargs['orientation'] in ['reverse', 'either', 'both']:
+    if any(reverse_hits.values()) or tags.variant_distance: # Variants are not found by the scan, so need looking for in the read
+      recomR = dcr(stages.revcomp(vdj), inputargs, tags, counts, reverse_hits, stages)
+    else:
+      recomR = dcr('', inputargs, tags, counts, reverse_hits, stages) # Nothing to find, but the failures still need counting
+
+  if inputargs['orientation'] == 'forward' or inputargs['orientation'] == 'both' or \
+      (inputargs['orientation'] == 'either' and not recomR):
+    recomF = dcr(vdj, inputargs, tags, counts, forward_hits, stages)
+
+  return recomF, recomR
+
+def read_batches(records, batch_size):
+  """read_batches(records, batch_size): Groups FASTQ records into lists of batch_size records"""
+  batch = []
+  for record in records:
+    batch.append(record)
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def make_dcr_cache(inputargs):
+  """make_dcr_cache(inputargs): Returns a DcrCache of the requested size, or None if caching is switched off"""
+  if inputargs['cachesize'] > 0:
+    return DcrCache(inputargs['cachesize'])
+  return None
+
+def make_stemplate(inputargs):
+  """make_stemplate(inputargs): Returns the template of an output line"""
+  if inputargs['nobarcoding'] == False:
+    return string.Template('$chain $v $j $del_v_or_j $seqid $tcr_seq $tcr_qual $barcode $barqual')
+  else:
+    return string.Template('$chain $v $j $seqid $tcr_seq $tcr_qual')
+
+def default_inputargs(**settings):
+  """default_inputargs(**settings): Returns inputargs with the given settings, and the command line defaults for the rest"""
+  inputargs = vars(args(['--fastq', ''])[0])
+  inputargs.update(settings)
+  return inputargs
+
+#####################################
+############# PROFILING #############
+#####################################
+
+# With --profile, a Decombiner looks up the functions for each stage of decombining in a DcrStages of timed versions of them,
+# so runs without it are not slowed by any timing code, and other Decombiners in the same process are left untimed.
+# Stage times and call counts are kept in the Decombiner's profile_counts, which is added to each batch's counts (see drain_profile),
+# so they merge across worker processes like the other counts.
+# The time taken to analyse every profile_latency_sample'th read is also tallied, in buckets of powers of two microseconds.
+
+profile_latency_sample = 100
+
+# Stages in the order they are reported
+profile_stages = ['read', 'revcomp', 'tag_scan', 'v_assign', 'v_fallback', 'j_assign', 'j_fallback', 'deletions', 'format', 'write']
+
+def timed_stage(function, stage, profile_counts):
+  """timed_stage(function, stage, profile_counts): Returns a version of function which adds its time and calls to profile_counts as the given stage"""
+  def timed(*args):
+    start = time()
+    result = function(*args)
+    profile_counts['profile_time_' + stage] += time() - start
+    profile_counts['profile_calls_' + stage] += 1
+    return result
+  timed.__name__ = function.__name__
+  timed.__doc__ = function.__doc__
+  return timed
+
+def timed_gene_analysis(function, gene, profile_counts):
+  """timed_gene_analysis(function, gene, profile_counts): Times vanalysis or janalysis, as an assignment from a full tag, or as a fallback to half tags or tag variants"""
+  assign = timed_stage(function, gene + '_assign', profile_counts)
+  fallback = timed_stage(function, gene + '_fallback', profile_counts)
+  def timed(read, hits, inputargs, tags, counts, stages):
+    if hits[('full', gene)]:
+      return assign(read, hits, inputargs, tags, counts, stages)
+    return fallback(read, hits, inputargs, tags, counts, stages)
+  timed.__name__ = function.__name__
+  return timed
+
+class DcrStages(object):
+  """DcrStages(profile_counts=None): The functions for each stage of decombining, which dcr and the functions around it call through.
+    Given a Counter as profile_counts, they are timed versions of themselves, adding their times and calls to it (see timed_stage).
+    plain_stages holds the untimed functions, and is used when no stages are given."""
+
+  def __init__(self, profile_counts=None):
+    self.profile_counts = profile_counts
+    if profile_counts is None:
+      self.revcomp = revcomp
+      self.scan = TagIndex.scan.im_func
+      self.scan_strands = TagIndex.scan_strands.im_func
+      self.vanalysis = vanalysis
+      self.janalysis = janalysis
+      self.get_v_deletions = get_v_deletions
+      self.get_j_deletions = get_j_deletions
+      self.build_dcr_string = build_dcr_string
+    else:
+      self.revcomp = timed_stage(revcomp, 'revcomp', profile_counts)
+      self.scan = timed_stage(TagIndex.scan.im_func, 'tag_scan', profile_counts)
+      self.scan_strands = timed_stage(TagIndex.scan_strands.im_func, 'tag_scan', profile_counts)
+      self.vanalysis = timed_gene_analysis(vanalysis, 'v', profile_counts)
+      self.janalysis = timed_gene_analysis(janalysis, 'j', profile_counts)
+      self.get_v_deletions = timed_stage(get_v_deletions, 'deletions', profile_counts)
+      self.get_j_deletions = timed_stage(get_j_deletions, 'deletions', profile_counts)
+      self.build_dcr_string = timed_stage(build_dcr_string, 'format', profile_counts)
+
+def latency_bucket(seconds):
+  """latency_bucket(seconds): Returns k for a time between 2^(k-1) and 2^k microseconds (0 for under a microsecond)"""
+  return int(seconds * 1e6).bit_length()
+
+def timed_records(records, profile_counts):
+  """timed_records(records, profile_counts): Yields records from an iterator, adding the time taken to read them to profile_counts"""
+  read_time = 0
+  count = 0
+  records = iter(records)
+  try:
+    while True:
+      start = time()
+      try:
+        record = next(records)
+      except StopIteration:
+        return
+      read_time += time() - start
+      count += 1
+      yield record
+  finally:
+    # Added once at the end, as reader threads share profile_counts
+    profile_counts['profile_time_read'] += read_time
+    profile_counts['profile_calls_read'] += count
+
+class TimedWriter(object):
+  """TimedWriter(outfile, profile_counts): Wraps an output file (or DcrBinaryWriter), adding the time spent writing to profile_counts"""
+
+  def __init__(self, outfile, profile_counts):
+    self.outfile = outfile
+    self.profile_counts = profile_counts
+
+  def write(self, data):
+    start = time()
+    self.outfile.write(data)
+    self.profile_counts['profile_time_write'] += time() - start
+    self.profile_counts['profile_calls_write'] += 1
+
+  def write_records(self, records):
+    # Records are decombined as they are written, so time each record's write rather than the whole call
+    for record in records:
+      start = time()
+      self.outfile.write_record(record)
+      self.profile_counts['profile_time_write'] += time() - start
+      self.profile_counts['profile_calls_write'] += 1
+
+  def close(self):
+    start = time()
+    self.outfile.close()
+    self.profile_counts['profile_time_write'] += time() - start
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+def profile_report(counts, inputargs, timetaken):
+  """profile_report(counts, inputargs, timetaken): Returns the profile of a run, from its counts, as a dict ready to be written as JSON"""
+  stages = coll.OrderedDict()
+  for stage in profile_stages:
+    stages[stage] = coll.OrderedDict([('seconds', round(counts['profile_time_' + stage], 6)), ('calls', counts['profile_calls_' + stage])])
+
+  buckets = sorted(int(key.split('_')[-1]) for key in counts if key.startswith('profile_latency_'))
+  histogram = []
+  for k in buckets:
+    histogram.append(coll.OrderedDict([('min_us', 0 if k == 0 else 2 ** (k - 1)), ('max_us', 2 ** k), ('reads', counts['profile_latency_' + str(k)])]))
+
+  report = coll.OrderedDict()
+  report['version'] = __version__
+  report['input_file'] = inputargs['fastq']
+  report['total_seconds'] = round(timetaken, 6)
+  report['reads'] = counts['read_count']
+  report['rearrangements'] = counts['vj_count']
+  report['processes'] = max(inputargs['nproc'], 1)
+  report['note'] = 'Stage times are summed over all processes and threads. The v_ and j_ stage times include their deletion searches.'
+  report['stages'] = stages
+  report['latency_sample_every'] = profile_latency_sample
+  report['latency_histogram'] = histogram
+  return report
+
+class Decombiner(object):
+  """Decombiner(inputargs, tags=None): Decombines reads with the settings in inputargs (as given by args or default_inputargs).
+    All the state of a run is held here rather than in globals, so Decombinator can be used from other scripts, and several
+    runs can share one process. A TagIndex from a previous Decombiner (its tags attribute) can be passed in, to skip rebuilding it.
+    decombine(records) yields the output lines (or DcrRecords) for (readid, seq, qual) records; the run's statistics accumulate in counts."""
+
+  def __init__(self, inputargs, tags=None):
+    self.inputargs = dict(inputargs) # Copied, as tag set fallbacks are written back into it
+    self.counts = coll.Counter()
+    if tags is None:
+      tags = import_tcr_info(self.inputargs)
+    self.tags = tags
+    self.chain = tags.chain
+    self.stemplate = make_stemplate(self.inputargs)
+    self.dcr_cache = make_dcr_cache(self.inputargs)
+    self.profile_counts = None
+    self.stages = plain_stages
+    if self.inputargs['profile']:
+      self.profile_counts = coll.Counter()
+      self.stages = DcrStages(self.profile_counts)
+      self.analyse_read = self.analyse_read_sampled
+
+  def read_file(self, fqfile):
+    """read_file(fqfile): Returns an iterator over the (readid, seq, qual) records of a FASTQ file (timed, with --profile)"""
+    records = readfq_blocks(read_blocks(fqfile))
+    if self.inputargs['profile']:
+      return timed_records(records, self.profile_counts)
+    return records
+
+  def analyse_read(self, readid, seq, qual, counts):
+    """analyse_read(readid, seq, qual, counts): Decombines a single FASTQ record, returning a DcrRecord for each rearrangement found"""
+
+    dcr_records = []
+    bc = None
+
+    if self.inputargs['nobarcoding'] == False:
+      bc = seq[:30]
+      vdj = seq[30:]
+    else:
+      vdj = seq
+
+    if self.inputargs['nobarcoding'] == False:
+      if "N" in bc and self.inputargs['allowNs'] == False:       # Ambiguous base in barcode region
+        counts['dcrfilter_barcodeN'] += 1
+
+    counts['read_count'] += 1
+
+    # Get details of the VJ recombination
+
+    if self.dcr_cache:
+      recomF, recomR = self.dcr_cache.lookup(vdj, self.inputargs, self.tags, counts, self.stages)
+    else:
+      recomF, recomR = decombine_vdj(vdj, self.inputargs, self.tags, counts, self.stages)
+
+    if recomR:
+      counts['vj_count'] += 1
+      dcr_records.append(make_record(recomR, 'reverse', qual, readid, bc))
+
+    if recomF:
+      counts['vj_count'] += 1
+      dcr_records.append(make_record(recomF, 'forward', qual, readid, bc))
+
+    return dcr_records
+
+  def analyse_read_sampled(self, readid, seq, qual, counts):
+    """analyse_read_sampled(readid, seq, qual, counts): analyse_read, timing every profile_latency_sample'th read (used with --profile)"""
+    if counts['read_count'] % profile_latency_sample:
+      return Decombiner.analyse_read(self, readid, seq, qual, counts)
+    start = time()
+    dcr_records = Decombiner.analyse_read(self, readid, seq, qual, counts)
+    counts['profile_latency_' + str(latency_bucket(time() - start))] += 1
+    return dcr_records
+
+  def analyse_batch(self, batch, formatted=True):
+    """analyse_batch(batch, formatted): Returns the output lines (or DcrRecords if not formatted) for a batch of records and the counts it accrued"""
+    batch_counts = coll.Counter()
+    dcr_records = []
+    for readid, seq, qual in batch:
+      dcr_records.extend(self.analyse_read(readid, seq, qual, batch_counts))
+    if formatted:
+      dcr_records = [self.stages.build_dcr_string(record, self.stemplate) for record in dcr_records]
+    if self.profile_counts is not None:
+      batch_counts.update(self.drain_profile())
+    return dcr_records, batch_counts
+
+  def drain_profile(self):
+    """drain_profile(): Returns the stage timings gathered by this Decombiner (in this process) since the last call, and resets them"""
+    drained = self.profile_counts.copy()
+    self.profile_counts.clear()
+    return drained
+
+  def detect_orientation(self, records):
+    """detect_orientation(records): For '-or auto', decombines the first autosample records both ways, and chooses the orientation
+      to decombine in from how many rearrangements were found each way (see --automixed). 
+      Returns an iterator over all the records, including those sampled, which still need decombining in the chosen orientation."""
+    records = iter(records)
+    sample = list(itertools.islice(records, self.inputargs['autosample']))
+    sample_counts = coll.Counter() # The sample is decombined again, so these are not added to counts
+    forward = 0
+    reverse = 0
+
+    for readid, seq, qual in sample:
+      if self.inputargs['nobarcoding'] == False:
+        vdj = seq[30:]
+      else:
+        vdj = seq
+      if dcr(vdj, self.inputargs, self.tags, sample_counts, stages=self.stages):
+        forward += 1
+      if dcr(self.stages.revcomp(vdj), self.inputargs, self.tags, sample_counts, stages=self.stages):
+        reverse += 1
+
+    if forward + reverse == 0 or min(forward, reverse) >= self.inputargs['automixed'] * (forward + reverse):
+      self.inputargs['orientation'] = 'both'
+    elif forward > reverse:
+      self.inputargs['orientation'] = 'forward'
+    else:
+      self.inputargs['orientation'] = 'reverse'
+
+    self.counts['auto_sampled'] = len(sample)
+    self.counts['auto_forward'] = forward
+    self.counts['auto_reverse'] = reverse
+    print "Found", forward, "forward and", reverse, "reverse rearrangements in", len(sample), "sampled reads; decombining in orientation:", self.inputargs['orientation']
+    if self.inputargs['orientation'] != 'both' and min(forward, reverse):
+      print "Warning: rearrangements on the other strand (" + str(round(100.0 * min(forward, reverse) / (forward + reverse), 2)) + "% of those sampled)", \
+        "will not be found. Use '-or both', or a lower --automixed, to search both strands."
+    return itertools.chain(sample, records)
+
+  def make_pool(self):
+    """make_pool(): Returns a pool of nproc worker processes, each set up with this Decombiner's settings and tags, or None if nproc is 1"""
+    if self.inputargs['orientation'] == 'auto':
+      raise ValueError("The orientation needs detecting (with detect_orientation) before the worker pool is made")
+    if self.inputargs['nproc'] > 1:
+      return mp.Pool(processes=self.inputargs['nproc'], initializer=init_worker, initargs=(self.inputargs, self.tags))
+    return None
+
+  def analysed_batches(self, batches, pool=None, formatted=True):
+    """analysed_batches(batches, pool, formatted): Yields the analyse_batch result of each batch, in order, using the worker pool if given"""
+    if not pool:
+      for batch in batches:
+        yield self.analyse_batch(batch, formatted)
+
+    else:
+      for result in self.pooled_results(pool, analyse_worker_batch, ((batch, formatted) for batch in batches)):
+        yield result
+
+  def pooled_results(self, pool, function, arg_tuples):
+    """pooled_results(pool, function, arg_tuples): Yields the results of calling function with each tuple of arguments in the worker pool"""
+    # Jobs are handed to the workers in file order and yielded back in the same order, so the output matches a serial run
+    # Only a few jobs per worker are held in flight at once, so memory use does not grow with the size of the input
+    pending = coll.deque()
+    for arg_tuple in arg_tuples:
+      pending.append(pool.apply_async(function, arg_tuple))
+      if len(pending) >= 4 * self.inputargs['nproc']:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+
+  def decombine(self, records, pool=None, formatted=True):
+    """decombine(records, pool, formatted): Yields the output lines for an iterable of (readid, seq, qual) records, in order,
+      or their DcrRecords if not formatted. Reads are decombined in this process, or in batches by the worker pool if given (see make_pool)."""
+    if self.inputargs['orientation'] == 'auto':
+      records = self.detect_orientation(records)
+
+    if not pool:
+      for readid, seq, qual in records:
+        for record in self.analyse_read(readid, seq, qual, self.counts):
+          if formatted:
+            yield self.stages.build_dcr_string(record, self.stemplate)
+          else:
+            yield record
+        if self.counts['read_count'] % 100000 == 0 and self.inputargs['dontcount'] == False:
+          print '\t read', self.counts['read_count']
 
+    else:
+      for dcr_output, batch_counts in self.analysed_batches(read_batches(records, self.inputargs['batchsize']), pool, formatted):
+        self.merge_batch_counts(batch_counts)
+        for output in dcr_output:
+          yield output
+
+  def decombine_file(self, fqfile, pool=None, formatted=True):
+    """decombine_file(fqfile, pool, formatted): Yields the output lines (or DcrRecords) for the reads in a FASTQ file.
+      With --gzipindex, the ranges of a gzipped file made of many gzip members are decompressed by the workers (see decombine_indexed),
+      once the file has been indexed while first decombining it (see decombine_indexing)."""
+    if pool and self.inputargs['gzipindex'] and fqfile.endswith('.gz') and self.inputargs['orientation'] != 'auto':
+      ranges = load_gzip_index(fqfile)
+      if ranges is None:
+        return self.decombine_indexing(fqfile, pool, formatted)
+      if len(ranges) > 1:
+        return self.decombine_indexed(fqfile, ranges, pool, formatted)
+      print "Cannot split", fqfile, "into ranges for the workers to decompress (it needs to be a plain FASTQ file compressed as many gzip members, e.g. with bgzip)", \
+        "- decompressing it in this process."
+    return self.decombine(self.read_file(fqfile), pool, formatted)
+
+  def decombine_indexing(self, fqfile, pool, formatted=True):
+    """decombine_indexing(fqfile, pool, formatted): Yields the output lines (or DcrRecords) for the reads in a gzipped FASTQ file, read in this
+      process as decombine_file would without --gzipindex, building the file's gzip index as it goes and saving it once the file is read"""
+    print "Indexing gzip members of", fqfile, "while decombining it, so later runs can split it between the workers"
+    indexer = GzipIndexer()
+    records = readfq_blocks(read_gzip_indexing(fqfile, indexer))
+    if self.inputargs['profile']:
+      records = timed_records(records, self.profile_counts)
+    for output in self.decombine(records, pool, formatted):
+      yield output
+    ranges = indexer.ranges(os.path.getsize(fqfile))
+    if ranges is None:
+      print "Cannot index", fqfile, "(it needs to be a plain four line FASTQ file) - it will be decompressed in this process on later runs too."
+    else:
+      save_gzip_index(fqfile, ranges)
+
+  def decombine_indexed(self, fqfile, ranges, pool, formatted=True):
+    """decombine_indexed(fqfile, ranges, pool, formatted): Yields the output lines (or DcrRecords) for the reads in a gzipped FASTQ file, 
+      in order, each worker process decompressing and decombining one of the file's indexed ranges (see gzip_index) at a time"""
+    print "Decompressing", fqfile, "in", len(ranges), "ranges"
+    jobs = ((fqfile, gzip_range, next_range, formatted) for gzip_range, next_range in zip(ranges, ranges[1:] + [None]))
+    for dcr_output, batch_counts in self.pooled_results(pool, analyse_worker_range, jobs):
+      self.merge_batch_counts(batch_counts)
+      for output in dcr_output:
+        yield output
+
+  def decombine_files(self, fqfiles, pool=None, formatted=True):
+    """decombine_files(fqfiles, pool, formatted): Yields the output lines (or DcrRecords) for the reads in a list of FASTQ files, in file order.
+      Several files are read and decombined at the same time (see concurrent_batches)."""
+    fqfiles = [fqfile for fqfile in fqfiles if fqfile]
+    if len(fqfiles) == 1:
+      for output in self.decombine_file(fqfiles[0], pool, formatted):
+        yield output
+
+    else:
+      for dcr_output, batch_counts in self.concurrent_batches(fqfiles, pool, formatted):
+        self.merge_batch_counts(batch_counts)
+        for output in dcr_output:
+          yield output
+
+  def concurrent_batches(self, fqfiles, pool=None, formatted=True):
+    """concurrent_batches(fqfiles, pool, formatted): Yields the analyse_batch results for the reads in several FASTQ files, in file order.
+      Each file is read (and decompressed) by its own thread, and batches from each file are decombined in turn, using the worker pool 
+      if given, so that all the files are processed at once. Results for the files after the first are kept in temporary files until 
+      the files before them are finished, so the output is the same as decombining the files one after another."""
+
+    if self.inputargs['orientation'] == 'auto':
+      self.detect_orientation(self.read_file(fqfiles[0]))
+
+    depth = 4 * max(self.inputargs['nproc'], 1)
+    stalls = coll.Counter() # Stall times are only reported by findTCRs_threaded
+    errors = []
+    queues = []
+    for fqfile in fqfiles:
+      batches = Queue.Queue(maxsize=depth)
+      batch_source = read_batches(self.read_file(fqfile), self.inputargs['batchsize'])
+      reader = threading.Thread(target=reader_stage, args=(batch_source, batches, stalls, errors))
+      reader.daemon = True
+      reader.start()
+      queues.append(batches)
+
+    sources = coll.deque() # Which file each batch in flight came from
+    staged = [tempfile.TemporaryFile(prefix='dcr_staged_') for fqfile in fqfiles[1:]]
+    try:
+      for result in self.analysed_batches(interleaved_batches(queues, sources), pool, formatted):
+        source = sources.popleft()
+        if source == 0:
+          yield result
+        else:
+          cPickle.dump(result, staged[source - 1], cPickle.HIGHEST_PROTOCOL)
+
+      if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+      for staged_file in staged:
+        staged_file.seek(0)
+        while True:
+          try:
+            result = cPickle.load(staged_file)
+          except EOFError:
+            break
+          yield result
+
+    finally:
+      for staged_file in staged:
+        staged_file.close()
+
+  def findTCRs(self, fqfiles, outfile, pool=None):
+    # Scroll through input file(s) and find TCRs
+    # With --binary, outfile is a dcrbinary.DcrBinaryWriter, which is given DcrRecords rather than output lines
+    fqfiles = [fqfile for fqfile in fqfiles if fqfile]
+    if len(fqfiles) > 1:
+      # Files are read in their own threads by concurrent_batches, so --threaded makes no difference here
+      for dcr_output, batch_counts in self.concurrent_batches(fqfiles, pool, not self.inputargs['binary']):
+        self.merge_batch_counts(batch_counts)
+        write_output(outfile, dcr_output, self.inputargs['binary'])
+
+    elif self.inputargs['threaded']:
+      self.findTCRs_threaded(self.read_file(fqfiles[0]), outfile, pool)
+
+    elif self.inputargs['binary']:
+      outfile.write_records(self.decombine_file(fqfiles[0], pool, formatted=False))
 
+    else:
+      for dcr_string in self.decombine_file(fqfiles[0], pool):
+        outfile.write(dcr_string + '\n')
+
+  def merge_batch_counts(self, batch_counts):
+    """merge_batch_counts(batch_counts): Adds the counts from one batch to the run's counts, printing the running read count"""
+    last_count = self.counts['read_count']
+    self.counts.update(batch_counts)
+    if self.counts['read_count'] // 100000 > last_count // 100000 and self.inputargs['dontcount'] == False:
+      print '\t read', self.counts['read_count']
+
+  def findTCRs_threaded(self, records, outfile, pool=None):
+    """findTCRs_threaded(records, outfile, pool): Runs reading, decombining and writing as three threads, passing batches between them
+      through bounded queues, so that decompression and compressed writing (which release the GIL) overlap with analysis.
+      The time each stage spends stalled (waiting on an empty input queue or a full output queue) is added to counts."""
+
+    if self.inputargs['orientation'] == 'auto':
+      records = self.detect_orientation(records)
+
+    depth = 4 * max(self.inputargs['nproc'], 1)
+    batches = Queue.Queue(maxsize=depth)
+    outputs = Queue.Queue(maxsize=depth)
+    stalls = coll.Counter() # Each stage only adds to its own keys, and counts is left to the decombining stage
+    errors = []
+
+    reader = threading.Thread(target=reader_stage, args=(read_batches(records, self.inputargs['batchsize']), batches, stalls, errors))
+    writer = threading.Thread(target=writer_stage, args=(outfile, outputs, stalls, errors, self.inputargs['binary']))
+    for thread in [reader, writer]:
+      thread.daemon = True
+      thread.start()
+
+    try:
+      for dcr_output, batch_counts in self.analysed_batches(queued_batches(batches, stalls), pool, not self.inputargs['binary']):
+        self.merge_batch_counts(batch_counts)
+        timed_put(outputs, dcr_output, stalls, 'stall_decombine')
+    finally:
+      outputs.put(None)
+    writer.join()
+    reader.join()
+
+    if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
+    self.counts.update(stalls)
+
+worker_decombiner = None # Only set in worker processes, by init_worker
+
+def init_worker(inputargs, tags):
+  """init_worker(inputargs, tags): Pool initializer, receives the run settings and TagIndex once per worker process"""
+  global worker_decombiner
+  worker_decombiner = Decombiner(inputargs, tags)
+
+def analyse_worker_batch(batch, formatted=True):
+  """analyse_worker_batch(batch, formatted): Runs analyse_batch in a worker process"""
+  return worker_decombiner.analyse_batch(batch, formatted)
+
+def analyse_worker_range(fqfile, gzip_range, next_range, formatted=True):
+  """analyse_worker_range(fqfile, gzip_range, next_range, formatted): Decompresses one range of a gzipped FASTQ file (see read_gzip_range)
+    and runs analyse_batch on its reads, in a worker process"""
+  if worker_decombiner.profile_counts is not None:
+    records = list(timed_records(readfq_blocks([read_gzip_range(fqfile, gzip_range, next_range)]), worker_decombiner.profile_counts))
+  else:
+    records = list(readfq_blocks([read_gzip_range(fqfile, gzip_range, next_range)]))
+  return worker_decombiner.analyse_batch(records, formatted)
+
+def reader_stage(batch_source, batches, stalls, errors):
+  """reader_stage(batch_source, batches, stalls, errors): Reader thread, queues the batches of records from batch_source and then None"""
+  try:
+    for batch in batch_source:
+      timed_put(batches, batch, stalls, 'stall_read')
+  except Exception:
+    errors.append(sys.exc_info())
+  batches.put(None)
+
+def interleaved_batches(queues, sources):
+  """interleaved_batches(queues, sources): Yields the batches queued by several reader threads, taking one from each in turn,
+    and appending the index of the queue each came from to sources"""
+  active = range(len(queues))
+  while active:
+    for i in list(active):
+      batch = queues[i].get()
+      if batch is None:
+        active.remove(i)
+      else:
+        sources.append(i)
+        yield batch
 
-def build_dcr_string(recom, frame, qual, readid, stemplate):
+def write_output(outfile, dcr_output, binary=False):
+  """write_output(outfile, dcr_output, binary): Writes a batch of output lines, or of DcrRecords to a DcrBinaryWriter"""
+  if binary:
+    outfile.write_records(dcr_output)
+  else:
+    for dcr_string in dcr_output:
+      outfile.write(dcr_string + '\n')
+
+def queued_batches(batches, stalls):
+  """queued_batches(batches, stalls): Yields the batches queued by the reader thread"""
+  batch = timed_get(batches, stalls, 'stall_decombine')
+  while batch is not None:
+    yield batch
+    batch = timed_get(batches, stalls, 'stall_decombine')
+
+def writer_stage(outfile, outputs, stalls, errors, binary=False):
+  """writer_stage(outfile, outputs, stalls, errors, binary): Writer thread, writes queued batches of output lines 
+    (or of DcrRecords, to a DcrBinaryWriter) until it gets None"""
+  dcr_output = timed_get(outputs, stalls, 'stall_write')
+  while dcr_output is not None:
+    if not errors:
+      try:
+        write_output(outfile, dcr_output, binary)
+      except Exception:
+        errors.append(sys.exc_info()) # Keep emptying the queue, so the decombining stage does not block
+    dcr_output = timed_get(outputs, stalls, 'stall_write')
+
+def timed_get(queue, stalls, stage):
+  start = time()
+  item = queue.get()
+  stalls[stage] += time() - start
+  return item
+
+def timed_put(queue, item, stalls, stage):
+  start = time()
+  queue.put(item)
+  stalls[stage] += time() - start
+
+
+# A decombined rearrangement. The first six fields are in the order of the output file columns without barcoding,
+  # so records can be indexed in the same way as split output lines (as reconstructTCR does). 
+  # start is the position of the sequence in the read; barcode and barqual are None without barcoding.
+DcrRecord = coll.namedtuple('DcrRecord', ['chain', 'v', 'j', 'seqid', 'seq', 'qual', 'start', 'barcode', 'barqual'])
+
+def make_record(recom, frame, qual, readid, bc=None):
+  """make_record(recom, frame, qual, readid, bc): Returns the DcrRecord of a recombination found by dcr in the given frame"""
 
  # vdjqual = qual[30:]
 
@@ -781,17 +2124,153 @@ def build_dcr_string(recom, frame, qual, readid, stemplate):
   elif frame == 'forward':
     tcrQ = qual[recom[3]:recom[4]]
 
-  if inputargs['nobarcoding'] == False:
+  if bc is not None:
     bcQ = qual[:30]
-    dcr_string = stemplate.substitute( chain = str(recom[5]) + ',', v = str(recom[0]) + ',', j = str(recom[1]) + ',', del_v_or_j = str(recom[2]) + ',', \
-    seqid = readid + ',', tcr_seq = str(recom[3]) + ',', \
-    tcr_qual = tcrQ + ',', barcode = bc + ',', barqual = bcQ )
+  else:
+    bcQ = None
+
+  return DcrRecord(recom[5], recom[0], recom[1], readid, recom[2], tcrQ, recom[3], bc, bcQ)
+
+def build_dcr_string(record, stemplate):
+
+  if record.barcode is not None:
+    dcr_string = stemplate.substitute( chain = str(record.chain) + ',', v = str(record.v) + ',', j = str(record.j) + ',', del_v_or_j = str(record.seq) + ',', \
+    seqid = record.seqid + ',', tcr_seq = str(record.start) + ',', \
+    tcr_qual = record.qual + ',', barcode = record.barcode + ',', barqual = record.barqual )
     return dcr_string
 
   else:
-    dcr_string = stemplate.substitute(chain = str(recom[5]) + ',', v = str(recom[0]) + ',', j = str(recom[1]) + ',', seqid = readid + ',' , tcr_seq = str(recom[2]) + ',', tcr_qual = tcrQ)   
+    dcr_string = stemplate.substitute(chain = str(record.chain) + ',', v = str(record.v) + ',', j = str(record.j) + ',', seqid = record.seqid + ',' , tcr_seq = str(record.seq) + ',', tcr_qual = record.qual)   
     return dcr_string
 
+plain_stages = DcrStages() # The untimed stage functions, made here once they are all defined
+
+
+class BackgroundGzipWriter(object):
+  """BackgroundGzipWriter(filename, compresslevel): Write-only file object that gzips its output in a background thread.
+    Writes are buffered and handed over in large chunks through a bounded queue, so compression overlaps with decombining
+    (zlib releases the GIL while compressing) and no uncompressed copy of the output is written to disk."""
+
+  def __init__(self, filename, compresslevel=6, chunk_size=1 << 20, queue_size=16):
+    self.gzfile = gzip.open(filename, 'wb', compresslevel)
+    self.chunk_size = chunk_size
+    self.buffer = []
+    self.buffered = 0
+    self.queue = Queue.Queue(maxsize=queue_size)
+    self.error = None
+    self.thread = threading.Thread(target=self.compress)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def compress(self):
+    chunk = self.queue.get()
+    while chunk is not None:
+      if not self.error:
+        try:
+          self.gzfile.write(chunk)
+        except Exception:
+          self.error = sys.exc_info() # Raised again in the main thread; keep emptying the queue so writes there don't block
+      chunk = self.queue.get()
+
+  def write(self, data):
+    self.buffer.append(data)
+    self.buffered += len(data)
+    if self.buffered >= self.chunk_size:
+      self.flush_buffer()
+
+  def flush_buffer(self):
+    if self.error:
+      raise self.error[0], self.error[1], self.error[2]
+    if self.buffer:
+      self.queue.put(''.join(self.buffer))
+      self.buffer = []
+      self.buffered = 0
+
+  def close(self):
+    self.flush_buffer()
+    self.queue.put(None)
+    self.thread.join()
+    self.gzfile.close()
+    if self.error:
+      raise self.error[0], self.error[1], self.error[2]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+class DcrCollapser(object):
+  """DcrCollapser(max_keys, barcoded): Counts the occurrences of each distinct rearrangement, keyed on (chain, V, J, sequence[, barcode]).
+    Up to max_keys distinct keys are counted in memory. Beyond that the counts are sorted and spilled to a temporary file as a run,
+    and the runs merged back together (summing the counts of keys found in several) as they are written out, 
+    so memory use stays bounded however diverse the repertoire is."""
+
+  def __init__(self, max_keys, barcoded=False, block_size=10000):
+    self.max_keys = max_keys
+    self.barcoded = barcoded
+    self.block_size = block_size
+    self.tcr_counts = coll.Counter()
+    self.runs = []
+
+  def add_records(self, records):
+    """add_records(records): Counts an iterable of DcrRecords"""
+    tcr_counts = self.tcr_counts
+    for record in records:
+      if self.barcoded:
+        key = (record.chain, record.v, record.j, record.seq, record.barcode)
+      else:
+        key = (record.chain, record.v, record.j, record.seq)
+      tcr_counts[key] += 1
+      if len(tcr_counts) >= self.max_keys:
+        self.spill()
+        tcr_counts = self.tcr_counts
+
+  def spill(self):
+    """spill(): Writes the counts held in memory to a new sorted run on disk, in pickled blocks of block_size keys"""
+    run = tempfile.TemporaryFile(prefix='dcr_collapse_')
+    items = sorted(self.tcr_counts.iteritems())
+    for i in xrange(0, len(items), self.block_size):
+      cPickle.dump(items[i:i + self.block_size], run, cPickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    self.runs.append(run)
+    self.tcr_counts = coll.Counter()
+
+  def read_run(self, run):
+    while True:
+      try:
+        block = cPickle.load(run)
+      except EOFError:
+        return
+      for item in block:
+        yield item
+
+  def collapsed(self):
+    """collapsed(): Yields (key, count) for every distinct key, in sorted key order"""
+    sources = [self.read_run(run) for run in self.runs] + [iter(sorted(self.tcr_counts.iteritems()))]
+    last_key = None
+    total = 0
+    for key, count in heapq.merge(*sources):
+      if key != last_key:
+        if total:
+          yield last_key, total
+        last_key = key
+        total = 0
+      total += count
+    if total:
+      yield last_key, total
+
+  def write(self, outfile):
+    """write(outfile): Writes each distinct rearrangement once, followed by its count, returning the number written"""
+    written = 0
+    for key, count in self.collapsed():
+      outfile.write(", ".join(map(str, key)) + ", " + str(count) + "\n")
+      written += 1
+    return written
+
+  def close(self):
+    for run in self.runs:
+      run.close()
 
 def sort_permissions(fl):
   # Need to ensure proper file permissions on output data
@@ -804,18 +2283,16 @@ def sort_permissions(fl):
 ############# READ IN COMMAND LINE ARGUMENTS #############
 ##########################################################
 
-if __name__ == '__main__':
+def main(inputargs, dcr_records=None):
+  """main(inputargs, dcr_records): Runs Decombinator as from the command line, writing the output file (and summary file).
+    If a list is given as dcr_records, the DcrRecords found are added to it in memory instead of being written out.
+    Returns the name of the output file (that would have been written)."""
   s_t = time()
 
-  inputargs = vars(args()[0])
-  
-  print "Running Decombinator version", __version__
+  if inputargs['collapse'] and inputargs['binary'] and dcr_records is None:
+    raise ValueError("--collapse output is always text, so cannot be combined with --binary")
 
-  # Determine compression status (and thus opener required)
-  if inputargs['fastq'].endswith('.gz'):
-    opener = gzip.open
-  else:
-    opener = open
+  print "Running Decombinator version", __version__
 
   # Brief FASTQ sanity check
   if inputargs['dontcheck'] == False:
@@ -824,7 +2301,10 @@ if __name__ == '__main__':
       sys.exit()
   
   # Get TCR gene information
-  chain_order = import_tcr_info(inputargs)
+  decombiner = Decombiner(inputargs)
+  inputargs = decombiner.inputargs
+  counts = decombiner.counts
+  chain = decombiner.chain
   
   counts['start_time'] = time()
   
@@ -847,37 +2327,67 @@ if __name__ == '__main__':
     samplenam = snam1
 
   # If chain had not been autodetected, write it out into output file
-  if counts['chain_detected'] == 1:
+  if len(filename_chains(inputargs)) == 1:
     name_results = inputargs['prefix'] + samplenam
   else:
     name_results = inputargs['prefix'] + "_".join(map(chainnams.__getitem__, chain)) + "_" + samplenam
 
-  if inputargs['nobarcoding'] == False:
-    stemplate = string.Template('$chain $v $j $del_v_or_j $seqid $tcr_seq $tcr_qual $barcode $barqual')
-  else:  
-    stemplate = string.Template('$chain $v $j $seqid $tcr_seq $tcr_qual')
-    found_tcrs = coll.Counter()
+  if inputargs['orientation'] == 'auto':
+    # Detected here rather than when first decombining, so the worker processes are given the chosen orientation
+    decombiner.detect_orientation(decombiner.read_file(inputargs['fastq']))
 
-  findTCRs(inputargs['fastq'], 'w')
+  pool = decombiner.make_pool()
 
-  if inputargs['fastq2']:
-    findTCRs(inputargs['fastq2'], 'a')
+  if dcr_records is not None:
+    outfilenam = name_results + suffix
+    print "Keeping results in memory..."
+    dcr_records.extend(decombiner.decombine_files([inputargs['fastq'], inputargs['fastq2']], pool, formatted=False))
 
-  counts['end_time'] = time()
-  timetaken = counts['end_time']-counts['start_time']
+  else:
+    if inputargs['collapse']:
+      suffix = ".freq"
+    elif inputargs['binary']:
+      suffix = ".dcrb"
+
+    # Output is compressed as it is written, rather than afterwards
+    if inputargs['dontgzip'] == False:
+      outfilenam = name_results + suffix + ".gz"
+      outfile = BackgroundGzipWriter(outfilenam, inputargs['compresslevel'])
+    else:
+      outfilenam = name_results + suffix
+      outfile = open(outfilenam, 'wb' if inputargs['binary'] else 'w')
+
+    if inputargs['binary'] and not inputargs['collapse']:
+      import dcrbinary # Only needed (along with NumPy) for binary output
+      outfile = dcrbinary.DcrBinaryWriter(outfile, barcoded=inputargs['nobarcoding'] == False)
+
+    if inputargs['profile']:
+      outfile = TimedWriter(outfile, decombiner.profile_counts)
+
+    print "Writing to " + outfilenam + "..."
+    with outfile:
+      if inputargs['collapse']:
+        collapser = DcrCollapser(inputargs['collapsekeys'], barcoded=inputargs['nobarcoding'] == False)
+        try:
+          collapser.add_records(decombiner.decombine_files([inputargs['fastq'], inputargs['fastq2']], pool, formatted=False))
+          counts['distinct_tcrs'] = collapser.write(outfile)
+          counts['collapse_runs'] = len(collapser.runs)
+        finally:
+          collapser.close()
 
-  if inputargs['dontgzip'] == False:
-    print "Compressing Decombinator output file,", name_results + suffix, "..."
-    
-    with open(name_results + suffix) as infile, gzip.open(name_results + suffix + '.gz', 'wb') as outfile:
-        outfile.writelines(infile)
-    os.unlink(name_results + suffix)
+      else:
+        decombiner.findTCRs([inputargs['fastq'], inputargs['fastq2']], outfile, pool)
 
-    outfilenam = name_results + suffix + ".gz"
-  else:
-    outfilenam = name_results + suffix
+    sort_permissions(outfilenam)
+
+  if pool:
+    pool.close()
+    pool.join()
 
-  sort_permissions(outfilenam)
+  counts['end_time'] = time()
+  timetaken = counts['end_time']-counts['start_time']
+  if inputargs['profile']:
+    counts.update(decombiner.drain_profile()) # Timings of the stages run in this process
   
   ##############################################
   ############# WRITE SUMMARY DATA #############
@@ -886,6 +2396,11 @@ if __name__ == '__main__':
   print "Analysed", "{:,}".format(counts['read_count']), "reads, finding", "{:,}".format(counts['vj_count']), ", ".join(map(chainnams.__getitem__, chain)), "VJ rearrangements"
   print "Reading from", inputargs['fastq'] + ", writing to", outfilenam
   print "Took", str(round(timetaken,2)), "seconds"
+  if inputargs['profile']:
+    print "Stage times (seconds):", ", ".join(stage + " " + str(round(counts['profile_time_' + stage], 2)) for stage in profile_stages)
+  if inputargs['threaded']:
+    print "Stage stall times (seconds): reading", str(round(counts['stall_read'], 2)) + ", decombining", str(round(counts['stall_decombine'], 2)) \
+      + ", writing", str(round(counts['stall_write'], 2))
 
   # Write data to summary file
   if inputargs['suppresssummary'] == False:
@@ -910,7 +2425,7 @@ if __name__ == '__main__':
     # Generate string to write to summary file 
     summstr = "Property,Value\nDirectory," + os.getcwd() + "\nInputFile," + inputargs['fastq'] + "\nOutputFile," + outfilenam \
       + "\nDateFinished," + date + "\nTimeFinished," + strftime("%H:%M:%S") + "\nTimeTaken(Seconds)," + str(round(timetaken,2)) + "\n\nInputArguments:,\n"
-    for s in ['species', 'chain','extension', 'tags', 'dontgzip', 'allowNs', 'orientation', 'lenthreshold']:
+    for s in ['species', 'chain','extension', 'tags', 'dontgzip', 'allowNs', 'orientation', 'lenthreshold', 'tagthreshold', 'tagvariants', 'singlescan', 'cachesize', 'nproc', 'gzipindex', 'threaded', 'collapse', 'profile']:
       summstr = summstr + s + "," + str(inputargs[s]) + "\n"
 
     counts['pc_decombined'] = counts['vj_count'] / counts['read_count']
@@ -922,7 +2437,37 @@ if __name__ == '__main__':
       + "\nV2error," + str(counts['verr2']) \
       + "\nJ1error," + str(counts['jerr1']) \
       + "\nJ2error," + str(counts['jerr2'])
+
+    if inputargs['tagvariants']:
+      summstr = summstr + "\n\nReadsAssignedUsingTagVariants:,\nVVariant," + str(counts['vvariant']) \
+        + "\nJVariant," + str(counts['jvariant']) \
+        + "\nFoundVVariantNotAssigned," + str(counts['foundvvariantnotassigned']) \
+        + "\nFoundJVariantNotAssigned," + str(counts['foundjvariantnotassigned'])
+
+    if counts['auto_sampled']:
+      summstr = summstr + "\n\nOrientationDetection:,\nSampledReads," + str(counts['auto_sampled']) \
+        + "\nForwardRearrangements," + str(counts['auto_forward']) \
+        + "\nReverseRearrangements," + str(counts['auto_reverse']) \
+        + "\nMixedFraction," + str(inputargs['automixed']) \
+        + "\nChosenOrientation," + inputargs['orientation']
+
+    if inputargs['collapse']:
+      summstr = summstr + "\n\nCollapsing:,\nDistinctRearrangements," + str(counts['distinct_tcrs']) \
+        + "\nRunsSpilledToDisk," + str(counts['collapse_runs'])
+
+    # Decombining cache performance
+    if inputargs['cachesize'] > 0:
+      cache_lookups = counts['cache_hits'] + counts['cache_misses']
+      summstr = summstr + "\n\nDecombiningCache:,\nCacheSize," + str(inputargs['cachesize']) \
+        + "\nCacheHits," + str(counts['cache_hits']) \
+        + "\nCacheMisses," + str(counts['cache_misses']) \
+        + "\nCacheHitRate," + str(round(counts['cache_hits'] / max(cache_lookups, 1), 3))
     
+    if inputargs['threaded']:
+      summstr = summstr + "\n\nThreadStallTime(Seconds):,\nRead," + str(round(counts['stall_read'], 2)) \
+        + "\nDecombine," + str(round(counts['stall_decombine'], 2)) \
+        + "\nWrite," + str(round(counts['stall_write'], 2))
+
     # Number reads filtered out
     summstr = summstr + "\n\nReadsFilteredOut:,\nAmbiguousBaseCall(DCR)," + str(counts['dcrfilter_intertagN']) \
       + "\nAmbiguousBaseCall(Barcode)," + str(counts['dcrfilter_barcodeN']) \
@@ -947,5 +2492,20 @@ if __name__ == '__main__':
     print >> summaryfile, summstr 
     summaryfile.close()
     sort_permissions(summaryname)
+
+  if inputargs['profile']:
+    # Next to the summary file, or the output file if there is no summary
+    if inputargs['suppresssummary'] == False:
+      profilename = summaryname[:-len(".csv")] + "_Profile.json"
+    else:
+      profilename = name_results + "_Profile.json"
+    with open(profilename, "w") as profilefile:
+      json.dump(profile_report(counts, inputargs, timetaken), profilefile, indent=2)
+    sort_permissions(profilename)
+    print "Profile written to", profilename
   print("--- %s seconds ---" % (time() - s_t))
+  return outfilenam
+
+if __name__ == '__main__':
+  main(vars(args()[0]))
   sys.exit()
\ No newline at end of file
@@ -2,6 +2,7 @@ import os
 import sys
 import collections
 
+import SingleTagDecombinator
 from SingleTagDecombinator import args, get_chain
 #import SupplementaryScripts.SingleTagTools.reconstructTCR as reconstructTCR
 import reconstructTCR
@@ -12,26 +13,33 @@ import reconstructTCR
 
 def pipelineargs():
 	parser = argparse.ArgumentParser( description='**Pipeline for Single Tag Decombinator**')
-	parser.add_argument('-np', '--nproc', type=int, help='Number of cores for multprocessing alignment', required=False, default=None)
+	parser.add_argument('-np', '--nproc', type=int, help='Number of cores for multprocessing alignment in ReconstructTCR (not passed on to Decombinator, see -dnp)', required=False, default=None)
+	parser.add_argument('-dnp', '--dcrnproc', type=int, help='Number of worker processes for Decombinator (its --nproc). Default = 1', required=False, default=1)
 	parser.add_argument('-of', '--outfolder', type=str, help='Name of output folder for results files', required=False, default="SingleTagAnalysis")
+	parser.add_argument('--stream', action='store_true', help='Pass single tag results to ReconstructTCR in memory, without writing them to a file', required=False)
+	parser.add_argument('-ma', '--matching', type=str, choices=['greedy', 'optimal'], help='How ReconstructTCR assigns J reads to V reads (see reconstructTCR.py). Default = greedy. '
+		'The default output differs from earlier versions, which assigned J reads slice by slice: usually more TCRs are rebuilt', required=False, default='greedy')
 	
 	return parser.parse_known_args()
 
-def getTagFolder():
-	import urllib2
-	try:
-		d = "https://raw.githubusercontent.com/innate2adaptive/Decombinator-Tags-FASTAs/master/"
-		urllib2.urlopen(urllib2.Request(d))      # Request URL, see whether is found
-	except:
-		cwd = os.getcwd()
-		basedir = os.path.dirname(cwd)
-		if os.path.isdir(cwd+os.sep+"Decombinator-Tags-FASTAs"):
-			return cwd+os.sep+"Decombinator-Tags-FASTAs"
-		elif os.path.isdir(basedir+os.sep+"Decombinator-Tags-FASTAs"):
-			return basedir+os.sep+"Decombinator-Tags-FASTAs"
-		else:
-			print "Error: Cannot find online or offline version of Decombinator-Tags-FASTAs directory."
-			sys.exit()
+def getTagFolder(offline=False):
+	# Local copies are looked for first, so the network is only tried when there are none (and never when running offline)
+	cwd = os.getcwd()
+	basedir = os.path.dirname(cwd)
+	if os.path.isdir(cwd+os.sep+"Decombinator-Tags-FASTAs"):
+		return cwd+os.sep+"Decombinator-Tags-FASTAs"
+	elif os.path.isdir(basedir+os.sep+"Decombinator-Tags-FASTAs"):
+		return basedir+os.sep+"Decombinator-Tags-FASTAs"
+	elif not offline:
+		import urllib2
+		try:
+			d = "https://raw.githubusercontent.com/innate2adaptive/Decombinator-Tags-FASTAs/master/"
+			urllib2.urlopen(urllib2.Request(d), timeout=10)      # Request URL, see whether is found
+			return None
+		except:
+			pass
+	print "Error: Cannot find online or offline version of Decombinator-Tags-FASTAs directory."
+	sys.exit()
 
 def organiseOutput(dirname):
 
@@ -85,29 +93,30 @@ def getOutputFile(inputargs):
 	
 	return outfilenam
 
-def getDcrScript():
-	import urllib2
-	try:
-		f = "https://raw.githubusercontent.com/innate2adaptive/Decombinator/half-tag-threshold/Decombinator.py"
-		urllib2.urlopen(urllib2.Request(f))      # Request URL, see whether is found
-		return "curl "+f+" | python - "
-		print ""
-	except:
-		cwd = os.getcwd()
-		basedir = os.path.dirname(cwd)
-		if os.path.isfile(cwd+os.sep+"Decombinator.py"):
-			return "python "+cwd+os.sep+"Decombinator.py "
-		elif os.path.isfile(basedir+os.sep+"Decombinator/Decombinator.py"):
-			return "python "+basedir+os.sep+"Decombinator/Decombinator.py "
-		elif os.path.isfile(basedir+os.sep+"Decombinator.py"):
-			return "python "+basedir+os.sep+"Decombinator.py "
-		else:
-			print "Error: Cannot find online or offline version of Decombinator."
-			sys.exit()
+def getDcrScript(offline=False):
+	# Local copies are looked for first, so the network is only tried when there are none (and never when running offline)
+	cwd = os.getcwd()
+	basedir = os.path.dirname(cwd)
+	if os.path.isfile(cwd+os.sep+"Decombinator.py"):
+		return "python "+cwd+os.sep+"Decombinator.py "
+	elif os.path.isfile(basedir+os.sep+"Decombinator/Decombinator.py"):
+		return "python "+basedir+os.sep+"Decombinator/Decombinator.py "
+	elif os.path.isfile(basedir+os.sep+"Decombinator.py"):
+		return "python "+basedir+os.sep+"Decombinator.py "
+	elif not offline:
+		import urllib2
+		try:
+			f = "https://raw.githubusercontent.com/innate2adaptive/Decombinator/half-tag-threshold/Decombinator.py"
+			urllib2.urlopen(urllib2.Request(f), timeout=10)      # Request URL, see whether is found
+			return "curl "+f+" | python - "
+		except:
+			pass
+	print "Error: Cannot find online or offline version of Decombinator."
+	sys.exit()
 
 
 def Decombinator(dcr_args,outputfiles):
-	cmd = getDcrScript()
+	cmd = getDcrScript(args.offline)
 
 	for c in dcr_args.chain.split(" "):
 		dcr_input = cmd
@@ -139,37 +148,30 @@ def Decombinator(dcr_args,outputfiles):
 if __name__ == '__main__':
 
 	pipelineargs = pipelineargs()
-	args = args()[0]	
-	software_dir = os.path.dirname(__file__)
-	if software_dir == "":
-		software_dir = "."
-	#args.tagfastadir = getTagFolder()
+	# Decombinator is only given the flags the pipeline did not take, so the pipeline's own -np does not also set its --nproc
+	args = args(pipelineargs[1])[0]
+	args.nproc = pipelineargs[0].dcrnproc
+	#args.tagfastadir = getTagFolder(args.offline)
 
 	outdir = organiseOutput(pipelineargs[0].outfolder)
 	outputfiles = []
 
-	st_dcr_input = "python " + software_dir + "/SingleTagDecombinator.py"	
 	print ""
-	for a in vars(args):
-		# if vars(args)[a] == True:
-		# 	st_dcr_input += " "+"--"+a
-		# elif vars(args)[a] != None and vars(args)[a] != False:
-		#st_dcr_input += " "+"--"+a+" "+"\'"+str(vars(args)[a])+"\'"
-		if vars(args)[a] == None:
-			continue
-		st_dcr_input += " "+"--"+a+" "+str(vars(args)[a])
-
-
 	print "###############################"
 	print "Running Single Tag Decombinator"
 	print "###############################"
-	pprint("Command Issued: "+st_dcr_input)
-	
-	os.system(st_dcr_input)
-	outname = getOutputFile(args)
 
-	os.rename(outname, outdir+os.sep+outname)
-	outputfiles.append(outdir+os.sep+outname)
+	# Run in this process, rather than as a subprocess, so the arguments are passed on as parsed
+	if pipelineargs[0].stream:
+		# Records go straight to ReconstructTCR, skipping writing, compressing and parsing the single tag output file
+		dcr_records = []
+		outname = SingleTagDecombinator.main(vars(args), dcr_records)
+	else:
+		dcr_records = None
+		outname = SingleTagDecombinator.main(vars(args))
+
+		os.rename(outname, outdir+os.sep+outname)
+		outputfiles.append(outdir+os.sep+outname)
 
 
 	# recon_args = Namespace(buildfordecombinator = True,
@@ -181,14 +183,14 @@ if __name__ == '__main__':
  #                           outputfile = outdir+os.sep+"OUTPUT.n12",
  #                           separatedir = None)
 
- 	recon_args = Namespace(filename = outdir+os.sep+outname, nproc = pipelineargs[0].nproc)
+ 	recon_args = Namespace(filename = outdir+os.sep+outname, nproc = pipelineargs[0].nproc, matching = pipelineargs[0].matching)
 
 	print "\n################################################"
 	print "Running ReconstructTCR: Building For Decombinator"
 	print "################################################\n"
 
 	# bfdname = reconstructTCR.main(recon_args)
-	bfdname = reconstructTCR.main(recon_args)
+	bfdname = reconstructTCR.main(recon_args, dcr_records)
 	os.rename(bfdname, outdir+os.sep+bfdname)
 	outputfiles.append(outdir+os.sep+bfdname)
 #	outputfiles.append(recon_args.outputfile)
@@ -0,0 +1,207 @@
+##################
+### BACKGROUND ###
+##################
+
+# Compact binary, columnar format for single tag Decombinator output (written with SingleTagDecombinator.py --binary),
+# with a reader for ReconstructTCR and other analysis scripts. Much quicker to write and load than the text .n12 format.
+
+# A file is a header (magic 'DCRB', format version and flags) followed by chunks of up to chunk_size records.
+# Each chunk stores its records as columns:
+  # fixed width integer columns for chain (ASCII code), V index, J index (-1 for n/a), sequence start position,
+    # and the lengths of the sequence id, sequence and barcode
+  # the sequence ids, qualities and barcode qualities as concatenated blocks of bytes
+  # the sequences (and barcodes) as concatenated blocks of 2-bit codes, four bases per byte,
+    # followed by the positions and values of any bases other than A, C, G and T (e.g. N) in the block
+# All integers are little endian. NumPy is needed to read or write the format.
+
+import struct
+import gzip
+import numpy as np
+
+magic = 'DCRB'
+format_version = 1
+
+file_header = struct.Struct('<4sBB')        # magic, version, flags
+chunk_header = struct.Struct('<4sI')        # 'CHNK', number of records
+count = struct.Struct('<I')
+
+FLAG_BARCODED = 1                           # file flag: records have barcodes
+
+# Integer columns in the order they are stored, with their types
+columns = [('chain', '<u1'), ('v', '<i2'), ('j', '<i2'), ('start', '<i4'), ('id_len', '<u2'), ('seq_len', '<u2')]
+barcode_columns = [('bc_len', '<u1')]
+
+base_codes = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+  base_codes[ord(base)] = code
+code_bases = np.frombuffer('ACGT', dtype=np.uint8)
+
+def pack_bases(seq_block):
+  """pack_bases(seq_block): Returns a block of sequence as a string of 2-bit codes, 
+    followed by the number, positions and values of the bases which are not A, C, G or T"""
+  seq = np.frombuffer(seq_block, dtype=np.uint8)
+  codes = base_codes[seq]
+  others = np.flatnonzero(codes == 255)
+  codes[others] = 0
+  padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+  padded[:len(codes)] = codes
+  quads = padded.reshape(-1, 4)
+  packed = quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)
+  return packed.tostring() + count.pack(len(others)) + others.astype('<u4').tostring() + seq[others].tostring()
+
+def read_bases(infile, length):
+  """read_bases(infile, length): Reads a block of length bases written by pack_bases"""
+  packed = np.frombuffer(read_exactly(infile, -(-length // 4)), dtype=np.uint8)
+  codes = np.empty((len(packed), 4), dtype=np.uint8)
+  for n in range(4):
+    codes[:, n] = (packed >> (2 * n)) & 3
+  seq = code_bases[codes.ravel()[:length]]
+  num_others = count.unpack(read_exactly(infile, count.size))[0]
+  if num_others:
+    others = np.frombuffer(read_exactly(infile, 4 * num_others), dtype='<u4')
+    seq[others] = np.frombuffer(read_exactly(infile, num_others), dtype=np.uint8)
+  return seq.tostring()
+
+def na_to_index(index):
+  if index == 'n/a':
+    return -1
+  return index
+
+class DcrBinaryWriter(object):
+  """DcrBinaryWriter(outfile, barcoded, chunk_size): Writes DcrRecords to an open (binary mode) file object in the binary format.
+    Records are gathered into columns and written a chunk at a time. close() writes the last chunk, and closes outfile."""
+
+  def __init__(self, outfile, barcoded, chunk_size=1 << 16):
+    self.outfile = outfile
+    self.barcoded = barcoded
+    self.chunk_size = chunk_size
+    self.outfile.write(file_header.pack(magic, format_version, FLAG_BARCODED if barcoded else 0))
+    self.new_chunk()
+
+  def new_chunk(self):
+    self.chains, self.vs, self.js, self.starts = [], [], [], []
+    self.seqids, self.seqs, self.quals = [], [], []
+    self.barcodes, self.barquals = [], []
+
+  def write_record(self, record):
+    self.chains.append(record.chain)
+    self.vs.append(na_to_index(record.v))
+    self.js.append(na_to_index(record.j))
+    self.starts.append(record.start)
+    self.seqids.append(record.seqid)
+    self.seqs.append(record.seq)
+    self.quals.append(record.qual)
+    if self.barcoded:
+      self.barcodes.append(record.barcode)
+      self.barquals.append(record.barqual)
+    if len(self.chains) >= self.chunk_size:
+      self.write_chunk()
+
+  def write_records(self, records):
+    for record in records:
+      self.write_record(record)
+
+  def write_chunk(self):
+    if not self.chains:
+      return
+    blocks = [np.frombuffer(''.join(self.chains), dtype=np.uint8).tostring(),
+      np.array(self.vs, dtype='<i2').tostring(),
+      np.array(self.js, dtype='<i2').tostring(),
+      np.array(self.starts, dtype='<i4').tostring(),
+      np.array(map(len, self.seqids), dtype='<u2').tostring(),
+      np.array(map(len, self.seqs), dtype='<u2').tostring(),
+      ''.join(self.seqids), pack_bases(''.join(self.seqs)), ''.join(self.quals)]
+    if self.barcoded:
+      blocks.extend([np.array(map(len, self.barcodes), dtype='<u1').tostring(), pack_bases(''.join(self.barcodes)), ''.join(self.barquals)])
+    self.outfile.write(chunk_header.pack('CHNK', len(self.chains)))
+    self.outfile.write(''.join(blocks))
+    self.new_chunk()
+
+  def close(self):
+    self.write_chunk()
+    self.outfile.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+def open_dcr_binary(filename):
+  if filename.endswith('.gz'):
+    return gzip.open(filename, 'rb')
+  return open(filename, 'rb')
+
+def read_exactly(infile, size):
+  data = infile.read(size)
+  if len(data) != size:
+    raise IOError("Truncated Decombinator binary file")
+  return data
+
+def read_chunks(filename):
+  """read_chunks(filename): Yields each chunk of a (optionally gzipped) binary Decombinator file as a dict of columns.
+    Integer columns (see columns) are NumPy arrays; seqids, seqs and quals (and barcodes and barquals, for barcoded files) are
+    each one string holding every record's value, concatenated, which the *_len columns split up (see chunk_records)."""
+
+  with open_dcr_binary(filename) as infile:
+    header = infile.read(file_header.size)
+    if len(header) != file_header.size or header[:4] != magic:
+      raise IOError(filename + " is not a Decombinator binary file")
+    file_magic, version, file_flags = file_header.unpack(header)
+    if version != format_version:
+      raise IOError(filename + " is written in an unsupported version (" + str(version) + ") of the Decombinator binary format")
+
+    while True:
+      header = infile.read(chunk_header.size)
+      if not header:
+        return
+      if len(header) != chunk_header.size or header[:4] != 'CHNK':
+        raise IOError("Corrupt chunk in Decombinator binary file " + filename)
+      chunk_magic, n = chunk_header.unpack(header)
+
+      chunk = {}
+      for name, dtype in columns:
+        chunk[name] = np.frombuffer(read_exactly(infile, n * np.dtype(dtype).itemsize), dtype=dtype)
+      chunk['seqids'] = read_exactly(infile, int(chunk['id_len'].sum()))
+      seq_total = int(chunk['seq_len'].sum())
+      chunk['seqs'] = read_bases(infile, seq_total)
+      chunk['quals'] = read_exactly(infile, seq_total)
+
+      if file_flags & FLAG_BARCODED:
+        for name, dtype in barcode_columns:
+          chunk[name] = np.frombuffer(read_exactly(infile, n * np.dtype(dtype).itemsize), dtype=dtype)
+        bc_total = int(chunk['bc_len'].sum())
+        chunk['barcodes'] = read_bases(infile, bc_total)
+        chunk['barquals'] = read_exactly(infile, bc_total)
+
+      yield chunk
+
+def block_offsets(lengths):
+  """block_offsets(lengths): Returns the start and end offsets of each value in a concatenated block, given their lengths"""
+  ends = np.cumsum(lengths).tolist()
+  return [0] + ends[:-1], ends
+
+def chunk_records(chunk):
+  """chunk_records(chunk): Returns the records of a chunk from read_chunks, as tuples in DcrRecord field order
+    (chain, v, j, seqid, seq, qual, start, barcode, barqual), with 'n/a' for missing V or J indices as in the text output"""
+  chains = map(chr, chunk['chain'].tolist())
+  vs = ['n/a' if v < 0 else v for v in chunk['v'].tolist()]
+  js = ['n/a' if j < 0 else j for j in chunk['j'].tolist()]
+  starts, ends = block_offsets(chunk['id_len'])
+  seqids = map(chunk['seqids'].__getslice__, starts, ends)
+  starts, ends = block_offsets(chunk['seq_len']) # Qualities are the same lengths as the sequences
+  seqs = map(chunk['seqs'].__getslice__, starts, ends)
+  quals = map(chunk['quals'].__getslice__, starts, ends)
+  if 'bc_len' in chunk:
+    starts, ends = block_offsets(chunk['bc_len'])
+    barcodes = map(chunk['barcodes'].__getslice__, starts, ends)
+    barquals = map(chunk['barquals'].__getslice__, starts, ends)
+  else:
+    barcodes = barquals = [None] * len(chains)
+  return zip(chains, vs, js, seqids, seqs, quals, chunk['start'].tolist(), barcodes, barquals)
+
+def read_records(filename):
+  """read_records(filename): Yields the records of a binary Decombinator file, as tuples in DcrRecord field order"""
+  for chunk in read_chunks(filename):
+    for record in chunk_records(chunk):
+      yield record
@@ -1,13 +1,12 @@
 import os
-import sys
+import gzip
 import argparse
 import operator
-from functools import partial
+import heapq
 import multiprocessing as mp
 
 import re
-from Bio import pairwise2
-from Bio.pairwise2 import format_alignment
+import numpy as np
 
 import time
 
@@ -15,6 +14,10 @@ def args():
 	parser = argparse.ArgumentParser( description='** script to find overlaps between fragments of TCR sequence and rebuild complete sequences. **')
 	parser.add_argument('-f', '--filename', type=str, help='File of sequences to be analysed', required=False)
 	parser.add_argument('-np', '--nproc', type=int, help='Number of cores for multprocessing alignment', required=False, default=None)
+	parser.add_argument('-ma', '--matching', type=str, choices=['greedy', 'optimal'], help='How V reads are assigned J reads: greedily, '
+		'longest (then purest) overlaps first, or by a matching of greatest total alignment score. Default = greedy. '
+		'Either way, J reads are assigned once from every alignment found, rather than slice by slice as in earlier versions, so the output '
+		'differs from theirs (usually with more TCRs)', required=False, default='greedy')
 
 	return parser
 
@@ -31,16 +34,21 @@ class TCR:
 		self.longest_overlap = None
 		self.sequence = None
 
-	def determineAlignments(self, jreads,min_o):
+	def determineAlignments(self, jreads,min_o, matches=None):
+		# matches can give the positions of the V read's half seeds in each J read, as found by JReadIndex.candidates
 		s1 = getSequence(self.vread)
-		for j in jreads:
+		for n in range(len(jreads)):
+			j = jreads[n]
 			if j[0] != self.chain:
 				continue
-			s2 = getSequence(j)[:-20]					
-			alignments = align(s1,s2,min_o)
+			s2 = getSequence(j)[:-20]
+			if matches is None:
+				alignments = align(s1,s2,min_o)
+			else:
+				alignments = align(s1,s2,min_o,matches[n])
 			
-			for a in alignments:
-				self.alignments.append(Alignment(a,self.v_id, j))
+			for k in range(len(alignments)):
+				self.alignments.append(Alignment(alignments[k],self.v_id, j, n, k))
 		return self.alignments
 
 	def rankAlignmentLengths(self):
@@ -91,17 +99,21 @@ class TCR:
 		return self.ranked_alignments
 
 	def setSequence(self):
-
-		overlap = list(self.chosen_alignment.alignment[0])
+		# chosen_alignment is one of the alignment tuples from reconstruct_vread, whose sequences are found by aligning the
+		# reads again
+		alignment = align(getSequence(self.vread), getSequence(self.jread)[:-20], 8)[self.chosen_alignment[3]]
+		overlap = list(alignment[0])
 		for i in range(len(overlap)):
 			if overlap[i] == "-":
-				overlap[i] = self.chosen_alignment.alignment[1][i]
+				overlap[i] = alignment[1][i]
 		overlap = "".join(overlap)
 		self.sequence = self.vread[4][:-len(overlap)] + overlap + self.jread[4][len(overlap):]
 		return self.sequence
 
 class Alignment:
-	def __init__(self, alignment, v_id, j):
+	# j_number and number give the alignment's J read (by its position in the J reads aligned to) and its position in the
+	# alignments align found for the two reads
+	def __init__(self, alignment, v_id, j, j_number=None, number=None):
 		self.alignment = alignment
 		self.length = alignment[4]
 		self.score = alignment[2]
@@ -109,6 +121,8 @@ class Alignment:
 		self.v_id  = v_id
 		self.jread = j
 		self.j_id = j[3]
+		self.j_number = j_number
+		self.number = number
 		self.lrank = None
 		self.prank = None
 
@@ -121,7 +135,220 @@ def union(a, b):
 def flatten(l):
 	return [item for sublist in l for item in sublist]
 
-def align(s1,s2,min_o):
+# Overlap alignment, scored as pairwise2.align.globalms(seqA, seqB, 1, 0, -.5, -0.1) scores it (a global alignment with end gaps
+# penalised), returning the same co-optimal alignments in the same order, but only those within the purity budget. Only the 
+# diagonal band of the score matrix such an alignment could pass through is filled, and filling stops once none can be within it.
+match_score = 1.
+mismatch_score = 0.
+gap_open = -.5
+gap_extend = -0.1
+max_purity = 3
+max_alignments = 1000	# most alignments traced back, as pairwise2's MAX_ALIGNMENTS
+outside_band = -1e9	# score of the cells outside the band, whose traces (-1) are never followed
+reverse_trace = {1: 4, 2: 2, 3: 6, 4: 1, 5: 5, 6: 3, 7: 7, 8: 16, 9: 20, 10: 18, 11: 22, 12: 17, 13: 21, 14: 19, 15: 23, 16: 8,
+	17: 12, 18: 10, 19: 14, 20: 9, 21: 13, 22: 11, 23: 15, 24: 24, 25: 28, 26: 26, 27: 30, 28: 25, 29: 29, 30: 27, 31: 31}
+
+def gapScore(length):
+	if length <= 0:
+		return 0
+	return gap_open + gap_extend * length - gap_extend
+
+def rint(x):
+	# Scores are compared to three decimal places, as in pairwise2
+	return int(x * 1000 + 0.5)
+
+def withinPurity(alignment):
+	purity = alignment[4] - alignment[2]
+	return ( purity < max_purity ) or ( purity == max_purity and "-" in alignment[1] )
+
+def overlapMatrices(seqA, seqB):
+	# Returns the score and trace matrices for aligning seqA (down) with seqB (across), and the best score, 
+	# or None if no alignment can be within the purity budget
+	lenA, lenB = len(seqA), len(seqB)
+	# Leaving the diagonals between the start and end of the alignment by more than one needs at least four gaps
+	low = min(0, lenB - lenA) - 1
+	high = max(0, lenB - lenA) + 1
+	needed = rint(max(lenA, lenB) - max_purity)
+	first_gap = gapScore(1)
+
+	score_matrix = [[outside_band] * (lenB + 1) for row in xrange(lenA + 1)]
+	trace_matrix = [[-1] * (lenB + 1) for row in xrange(lenA + 1)]
+	score_matrix[0] = [gapScore(col) for col in xrange(lenB + 1)]
+	trace_matrix[0] = [None] * (lenB + 1)
+	for row in xrange(1, lenA + 1):
+		score_matrix[row][0] = gapScore(row)
+		trace_matrix[row][0] = None
+	col_scores = [0] + [2 * gap_open + gap_extend * col - gap_extend if col <= high + 1 else outside_band for col in xrange(1, lenB + 1)]
+
+	for row in xrange(1, lenA + 1):
+		first = max(1, row + low)
+		last = min(lenB, row + high)
+		if first == 1:
+			row_score = 2 * gap_open + gap_extend * row - gap_extend
+		else:
+			row_score = outside_band
+		base = seqA[row - 1]
+		above = score_matrix[row - 1]
+		scores = score_matrix[row]
+		traces = trace_matrix[row]
+		for col in xrange(first, last + 1):
+			if base == seqB[col - 1]:
+				nogap_score = above[col - 1] + match_score
+			else:
+				nogap_score = above[col - 1] + mismatch_score
+			row_open = scores[col - 1] + first_gap
+			row_extend = row_score + gap_extend
+			row_score = max(row_open, row_extend)
+			col_open = above[col] + first_gap
+			col_extend = col_scores[col] + gap_extend
+			col_score = max(col_open, col_extend)
+			col_scores[col] = col_score
+			best_score = max(nogap_score, col_score, row_score)
+			scores[col] = best_score
+
+			# Traces as in pairwise2: 1 = open gap in seqA, 2 = match/mismatch, 4 = open gap in seqB, 
+			# 8 = extend gap in seqA, 16 = extend gap in seqB, summed over each way of reaching the best score
+			best_rint = rint(best_score)
+			trace = 0
+			if rint(nogap_score) == best_rint:
+				trace += 2
+			if rint(row_score) == best_rint:
+				if rint(row_open) == best_rint:
+					trace += 1
+				if rint(row_extend) == best_rint:
+					trace += 8
+			if rint(col_score) == best_rint:
+				if rint(col_open) == best_rint:
+					trace += 4
+				if rint(col_extend) == best_rint:
+					trace += 16
+			traces[col] = trace
+
+		# Stop once even matching every remaining base can't bring an alignment within the purity budget
+		if rint(max([scores[col] + min(lenA - row, lenB - col) for col in xrange(max(0, row + low), last + 1)])) < needed:
+			return None
+
+	if rint(best_score) < needed:
+		return None
+	return score_matrix, trace_matrix, best_score
+
+def findGapOpen(seqA, seqB, ali_seqA, ali_seqB, row, col, col_gap, score_matrix, trace_matrix, in_process, direction):
+	# Follows an extended gap back to where it could have been opened, as pairwise2's _find_gap_open does
+	dead_end = False
+	target_score = rint(score_matrix[row][col])
+	if direction == "col":
+		target = col
+	else:
+		target = row
+	for n in xrange(target):
+		if direction == "col":
+			col -= 1
+			ali_seqA += "-"
+			ali_seqB += seqB[col]
+		else:
+			row -= 1
+			ali_seqA += seqA[row]
+			ali_seqB += "-"
+		if rint(score_matrix[row][col] + gapScore(n + 1)) == target_score and n > 0:
+			if not trace_matrix[row][col]:
+				break
+			in_process.append((ali_seqA, ali_seqB, row, col, col_gap, trace_matrix[row][col]))
+		if not trace_matrix[row][col]:
+			dead_end = True
+	return ali_seqA, ali_seqB, row, col, dead_end
+
+def overlapTracebacks(seqA, seqB, best_score, score_matrix, trace_matrix, reverse=False):
+	# Traces the alignments back from the end of both sequences, as pairwise2's _recover_alignments does, returning those 
+	# within the purity budget and the number traced back in all
+	lenA, lenB = len(seqA), len(seqB)
+	alignments = []
+	traced = 0
+	in_process = [("", "", lenA, lenB, False, trace_matrix[lenA][lenB])]
+	while in_process and traced < max_alignments:
+		# A gap in seqA may not be followed (going back) by a gap in seqB, which would only give a redundant alignment
+		dead_end = False
+		ali_seqA, ali_seqB, row, col, col_gap, trace = in_process.pop()
+		while (row > 0 or col > 0) and not dead_end:
+			cache = (ali_seqA, ali_seqB, row, col, col_gap)
+			if not trace:
+				# At the edge of the matrix
+				if col and col_gap:
+					dead_end = True
+				else:
+					ali_seqA += seqA[row - 1::-1] if row else ""
+					ali_seqB += seqB[col - 1::-1] if col else ""
+					ali_seqA += "-" * (len(ali_seqB) - len(ali_seqA))
+					ali_seqB += "-" * (len(ali_seqA) - len(ali_seqB))
+				break
+			elif trace % 2 == 1:
+				trace -= 1
+				if col_gap:
+					dead_end = True
+				else:
+					col -= 1
+					ali_seqA += "-"
+					ali_seqB += seqB[col]
+			elif trace % 4 == 2:
+				trace -= 2
+				row -= 1
+				col -= 1
+				ali_seqA += seqA[row]
+				ali_seqB += seqB[col]
+				col_gap = False
+			elif trace % 8 == 4:
+				trace -= 4
+				row -= 1
+				ali_seqA += seqA[row]
+				ali_seqB += "-"
+				col_gap = True
+			elif trace in (8, 24):
+				trace -= 8
+				if col_gap:
+					dead_end = True
+				else:
+					ali_seqA, ali_seqB, row, col, dead_end = findGapOpen(seqA, seqB, ali_seqA, ali_seqB, row, col, col_gap,
+						score_matrix, trace_matrix, in_process, "col")
+			elif trace == 16:
+				trace -= 16
+				col_gap = True
+				ali_seqA, ali_seqB, row, col, dead_end = findGapOpen(seqA, seqB, ali_seqA, ali_seqB, row, col, col_gap,
+					score_matrix, trace_matrix, in_process, "row")
+			if trace:
+				in_process.append(cache + (trace,))
+			trace = trace_matrix[row][col]
+
+		if not dead_end:
+			traced += 1
+			if reverse:
+				alignment = (ali_seqB[::-1], ali_seqA[::-1], best_score, 0, len(ali_seqA))
+			else:
+				alignment = (ali_seqA[::-1], ali_seqB[::-1], best_score, 0, len(ali_seqA))
+			if withinPurity(alignment) and alignment not in alignments:
+				alignments.append(alignment)
+	return alignments, traced
+
+def overlapAlignments(seqA, seqB):
+	# Returns the optimal alignments of seqA and seqB (as pairwise2.align.globalms(seqA, seqB, 1, 0, -.5, -0.1) would) 
+	# that are within the purity budget
+	if not seqA or not seqB:
+		return []
+	if abs(len(seqA) - len(seqB)) >= max_purity:
+		# The end gaps alone would be over budget
+		return []
+	matrices = overlapMatrices(seqA, seqB)
+	if matrices is None:
+		return []
+	score_matrix, trace_matrix, best_score = matrices
+
+	alignments, traced = overlapTracebacks(seqA, seqB, best_score, score_matrix, trace_matrix)
+	if not traced:
+		# As in pairwise2, try again with the sequences swapped if every traceback was a dead end
+		score_matrix = [list(col_scores) for col_scores in zip(*score_matrix)]
+		trace_matrix = [[reverse_trace.get(trace, trace) for trace in col_traces] for col_traces in zip(*trace_matrix)]
+		alignments, traced = overlapTracebacks(seqB, seqA, best_score, score_matrix, trace_matrix, reverse=True)
+	return alignments
+
+def align(s1,s2,min_o,half_matches=None):
 
 	half1  = s1[-min_o:-min_o/2]
 	half2 = s1[-min_o/2:]
@@ -129,24 +356,26 @@ def align(s1,s2,min_o):
 	rel_overlaps = []
 	good_alignments = []
 
-	half1_matches = [m.start() for m in re.finditer('(?='+half1+')', s2)]
-	half2_matches = [m.start() - min_o/2 for m in re.finditer('(?='+half2+')', s2)]
+	if half_matches is None:
+		half1_matches = [m.start() for m in re.finditer('(?='+half1+')', s2)]
+		half2_matches = [m.start() - min_o/2 for m in re.finditer('(?='+half2+')', s2)]
+		overlaps = None
+	else:
+		# Already found (in the same order) with a JReadIndex, along with the seed positions whose overlaps passed its prescreen
+		half1_matches, half2_matches, overlaps = half_matches
 
 	half_matches = union(half1_matches,half2_matches)
 
 	for i in half_matches:
-		aligns = pairwise2.align.globalms(half1+half2,s2[i:i+min_o],1,0,-.5,-0.1)
-
-		for k in aligns: 
-			if ( k[4] - k[2] < 3 ) or ( k[4] - k[2] == 3 and "-" in k[1] ):
-				#rel_overlaps.append([i,k])
-				s2start =  s2[:i + min_o]
-				s1end = s1[-(i + min_o):]
-				aligns2 = pairwise2.align.globalms(s2start,s1end,1,0,-.5,-0.1)
-
-				for j in aligns2:
-					if ( j[4] - j[2] < 3 ) or ( j[4] - j[2] == 3 and "-" in j[1] ):
-						good_alignments.append(j)
+		if overlaps is not None and i not in overlaps:
+			continue
+		aligns = overlapAlignments(half1+half2,s2[i:i+min_o])
+
+		if aligns:
+			s2start =  s2[:i + min_o]
+			s1end = s1[-(i + min_o):]
+			# Each seed alignment within the purity budget adds the overlap alignments again
+			good_alignments.extend(overlapAlignments(s2start,s1end) * len(aligns))
 				
 	# for j in rel_overlaps:
 	# 	s2start =  s2[:j[0] + min_o]
@@ -161,26 +390,247 @@ def align(s1,s2,min_o):
 	return good_alignments
 
 
-def reconstruct(tcr,jreads):
-	tcr.determineAlignments(jreads,8)
+class JReadIndex:
+	# Index of the positions of every k-mer in the J reads of each chain (in the part of them that V reads are aligned to, 
+	# without their last 20 bases), so each V read is only aligned to the J reads holding one of its half seeds.
+	# The same parts of the J reads of each chain are also held as rows of a (zero padded) uint8 matrix, to prescreen the 
+	# overlaps at those seeds all at once (see screenOverlaps).
+	# J reads are numbered in their original order.
+	def __init__(self, jreads, k):
+		self.k = k
+		self.jreads = jreads
+		self.positions = {}	# chain -> k-mer -> list of (J read number, position), in order
+		self.rows = [None] * len(jreads)	# J read number -> its row in its chain's matrix
+		chain_seqs = {}
+		for n in range(len(jreads)):
+			j = jreads[n]
+			s2 = getSequence(j)[:-20]
+			chain_positions = self.positions.setdefault(j[0], {})
+			for p in xrange(len(s2) - k + 1):
+				chain_positions.setdefault(s2[p:p+k], []).append((n, p))
+			seqs = chain_seqs.setdefault(j[0], [])
+			self.rows[n] = len(seqs)
+			seqs.append(s2)
+
+		self.matrices = {}	# chain -> J read sequences, one per row
+		self.lengths = {}	# chain -> J read sequence lengths
+		for chain, seqs in chain_seqs.items():
+			lengths = np.array(map(len, seqs), dtype=int)
+			matrix = np.zeros((len(seqs), max(lengths.max(), 1)), dtype=np.uint8)
+			for row in range(len(seqs)):
+				matrix[row, :lengths[row]] = np.frombuffer(seqs[row], dtype=np.uint8)
+			self.matrices[chain] = matrix
+			self.lengths[chain] = lengths
+
+	def candidates(self, s1, chain, min_o):
+		# Returns the J reads of a chain that a V read's sequence s1 could align to, and for each the positions of its
+		# half seeds (as align would find them), or None for all of them if s1 is too short to give whole seeds
+		numbers, matches = self.candidateNumbers(s1, chain, min_o)
+		return [self.jreads[n] for n in numbers], matches
+
+	def candidateNumbers(self, s1, chain, min_o):
+		# As candidates, but giving the J reads' numbers
+		half1  = s1[-min_o:-min_o/2]
+		half2 = s1[-min_o/2:]
+		if len(half1) != self.k or len(half2) != self.k:
+			numbers = [n for n in range(len(self.jreads)) if self.jreads[n][0] == chain]
+			return numbers, [None] * len(numbers)
+
+		matches = {}
+		chain_positions = self.positions.get(chain, {})
+		for n, p in chain_positions.get(half1, []):
+			matches.setdefault(n, ([], []))[0].append(p)
+		for n, p in chain_positions.get(half2, []):
+			matches.setdefault(n, ([], []))[1].append(p - min_o/2)
+		if not matches:
+			# Including when the chain has no J reads at all
+			return [], []
+		overlaps = self.screenOverlaps(s1, chain, min_o, matches)
+		numbers = [n for n in sorted(matches) if overlaps[n]]
+		return numbers, [matches[n] + (overlaps[n],) for n in numbers]
+
+	def screenOverlaps(self, s1, chain, min_o, matches):
+		# Returns, for each J read in matches, the set of its seed positions whose overlap with s1 (its first i + min_o bases
+		# with the last i + min_o of s1, as align aligns them) could have an alignment within the purity budget.
+		# When the two are the same length, such an alignment has at most two mismatches, or else no mismatches and two gaps,
+		# a gap in one sequence and then in the other; between them the bases that don't match where they are ungapped must 
+		# match one base along. That is checked for every overlap at once, the ungapped comparisons being made in a matrix with
+		# one row per overlap, right aligned at its end (column c comparing base c - (width - length) of the J read with 
+		# base c + len(s1) - width of s1). Overlaps with any part of either sequence missing are kept to be aligned.
+		overlaps = dict((n, set()) for n in matches)
+		lengths = self.lengths[chain]
+		numbers, offsets = [], []
+		for n in matches:
+			for i in union(*matches[n]):
+				o = i + min_o
+				if 0 < o <= lengths[self.rows[n]] and o <= len(s1):
+					numbers.append(n)
+					offsets.append(o)
+				else:
+					overlaps[n].add(i)
+		if not numbers:
+			return overlaps
+
+		rows = np.array([self.rows[n] for n in numbers])
+		offsets = np.array(offsets)
+		width = offsets.max()
+		columns = np.arange(width)
+		positions = columns - (width - offsets)[:, None]
+		inside = positions >= 0
+		jbases = self.matrices[chain][rows[:, None], np.where(inside, positions, 0)]
+		# s1's bases for columns -1 to width, with 1 (which no J read base matches) beyond either end of it
+		start = len(s1) - width - 1
+		vbases = np.ones(width + 2, dtype=np.uint8)
+		vbases[max(0, -start):width + 1] = np.frombuffer(s1[max(0, start):], dtype=np.uint8)
+
+		mismatches = (jbases != vbases[1:-1]) & inside
+		counts = mismatches.sum(axis=1)
+		firsts = mismatches.argmax(axis=1)
+		lasts = width - 1 - mismatches[:, ::-1].argmax(axis=1)
+		ahead = np.zeros((len(rows), width + 1), dtype=int)	# mismatches of each J read base with the next base of s1, so far
+		ahead[:, 1:] = ((jbases != vbases[2:]) & inside).cumsum(axis=1)
+		behind = np.zeros((len(rows), width + 1), dtype=int)	# and with the previous base of s1
+		behind[:, 1:] = ((jbases != vbases[:-2]) & inside).cumsum(axis=1)
+		everyrow = np.arange(len(rows))
+		shifted_ahead = ahead[everyrow, lasts] == ahead[everyrow, firsts]
+		shifted_behind = behind[everyrow, lasts + 1] == behind[everyrow, firsts + 1]
+		kept = (counts <= 2) | shifted_ahead | shifted_behind
+
+		for n, o in zip(np.array(numbers)[kept].tolist(), offsets[kept].tolist()):
+			overlaps[n].add(o - min_o)
+		return overlaps
+
+def reconstruct(tcr,jreads,matches=None):
+	tcr.determineAlignments(jreads,8,matches)
 	tcr.rankAlignmentLengths()
 	tcr.rankAlignmentPurities()
 	tcr.setPriorities()
 	return tcr
 
-def main(args):
+# Each worker process is given the V reads and the J read index once, as it starts (see init_worker), so its tasks are just
+# V read numbers, and it only sends back the J read numbers, lengths and purities of their alignments
+worker_vreads = None
+worker_jindex = None
+
+def init_worker(vreads, jindex):
+	global worker_vreads, worker_jindex
+	worker_vreads = vreads
+	worker_jindex = jindex
+
+def reconstruct_vread(v):
+	# Pool task: reconstruct, for V read number v with the J reads in worker_jindex. Returns v and its ranked alignments,
+	# as (J read number, length, purity, number of the alignment among those align gives for the two reads) tuples
+	vread = worker_vreads[v]
+	numbers, matches = worker_jindex.candidateNumbers(getSequence(vread), vread[0], 8)
+	tcr = reconstruct(TCR(vread = vread), [worker_jindex.jreads[n] for n in numbers], matches)
+	return v, [(numbers[a.j_number], a.length, a.purity, a.number) for a in tcr.ranked_alignments]
+
+# Assignment of J reads to V reads, from the alignments found for every V read. Each alignment is an edge, held as a tuple
+# (-length, purity, V read number, rank among the V read's alignments, J read number, number among the pair's alignments)
+# so that sorting edges puts the longest overlaps first, then the purest. J reads are told apart by their ids, as before.
+# Both return the chosen edge for each V read assigned a J read, by V read number.
+
+def assign_greedy(edges, jreads):
+	# Goes through the edges once, in order, taking each whose V and J reads are both still unassigned
+	chosen = {}
+	used_js = set()
+	for edge in sorted(edges):
+		v, j_id = edge[2], jreads[edge[4]][3]
+		if v in chosen or j_id in used_js:
+			continue
+		chosen[v] = edge
+		used_js.add(j_id)
+	return chosen
+
+def edge_weight(edge):
+	# An edge's alignment score (length - purity), in tenths so it is a whole number
+	return int(round(10 * (-edge[0] - edge[1])))
+
+def assign_optimal(edges, jreads):
+	# Finds the assignment with the greatest total alignment score, as a min cost matching of the V reads, each edge costing
+	# top - its weight (top being the greatest weight). Each V read also has a J read of its own (keyed (v,)) costing top, 
+	# which leaves it unassigned. V reads are added one at a time, each by the cheapest augmenting path from it (the Hungarian
+	# method), found with Dijkstra's algorithm on costs reduced by potentials kept for every read.
+	best = {}	# (V read number, J read id) -> the pair's edge of greatest weight (the first in order, for ties)
+	for edge in sorted(edges):
+		key = (edge[2], jreads[edge[4]][3])
+		if key not in best or edge_weight(edge) > edge_weight(best[key]):
+			best[key] = edge
+	if not best:
+		return {}
+	top = max(map(edge_weight, best.values()))
+	neighbours = {}	# V read number -> [(cost, J read id)], in edge order
+	for (v, j_id), edge in sorted(best.items(), key=operator.itemgetter(1)):
+		neighbours.setdefault(v, []).append((top - edge_weight(edge), j_id))
+
+	match_v, match_j = {}, {}
+	potential_v, potential_j = {}, {}
+	for u in sorted(neighbours):
+		dist_v, dist_j, settled, reached_from = {u: 0}, {}, set(), {}
+		heap = []
+		x, target = u, None
+		while True:
+			# Relax the edges from V read x, other than the one it is matched by
+			for cost, j in neighbours[x] + [(top, (x,))]:
+				if j in settled or match_v.get(x) == j:
+					continue
+				d = dist_v[x] + cost + potential_v.get(x, 0) - potential_j.get(j, 0)
+				if d < dist_j.get(j, d + 1):
+					dist_j[j] = d
+					reached_from[j] = x
+					heapq.heappush(heap, (d, len(reached_from), j))
+			while True:
+				d, order, j = heapq.heappop(heap)
+				if j not in settled and d == dist_j[j]:
+					break
+			settled.add(j)
+			if j not in match_j:
+				target = j
+				break
+			x = match_j[j]
+			dist_v[x] = d
+
+		# Keep the reduced costs of every edge non-negative, and of the matched edges zero
+		top_dist = dist_j[target]
+		for j in settled:
+			potential_j[j] = potential_j.get(j, 0) + dist_j[j] - top_dist
+		for x in dist_v:
+			potential_v[x] = potential_v.get(x, 0) + dist_v[x] - top_dist
+
+		j = target
+		while True:
+			x = reached_from[j]
+			previous = match_v.get(x)
+			match_v[x] = j
+			match_j[j] = x
+			if x == u:
+				break
+			j = previous
+
+	return dict((v, best[(v, j)]) for v, j in match_v.items() if not isinstance(j, tuple))
+
+def readDcrFile(filename):
+	# Reads a (non-barcoded) single tag Decombinator output file, gzipped or not, into lists of its fields
+	if filename.endswith('.dcrb') or filename.endswith('.dcrb.gz'):
+		# Binary format output (SingleTagDecombinator.py --binary)
+		import dcrbinary
+		return list(dcrbinary.read_records(filename))
+	if filename.endswith('.gz'):
+		opener = gzip.open
+	else:
+		opener = open
+	with opener(filename) as f:
+		return [l.rstrip().split(", ") for l in f]
+
+def main(args, reads=None):
+	# reads can be given directly (e.g. as SingleTagDecombinator DcrRecords), rather than read from args.filename,
+	# which is then only used to name the output file
 	total_time = time.time()
-	file = args.filename	
 	cores = args.nproc
 	if not cores: cores = mp.cpu_count()
 
-	lines = []
-	with open(file) as f:
-		for line in f:
-			lines.append(line)	
-	
-
-	reads = [l.rstrip().split(", ") for l in lines]	
+	if reads is None:
+		reads = readDcrFile(args.filename)
 	
 	vreads = []
 	jreads = []
@@ -198,64 +648,52 @@ def main(args):
 	print "reads with J tag", len(jreads)
 	print "reads with both V and J tag", len(bothvandj)
 
-	tcrs = []
-
-
-	for v in vreads:
-		tcrs.append(TCR(vread = v))
+	tcrs_by_v = [TCR(vread = v) for v in vreads]
 
-	#usedjs = []
-
-	reads_count = 0
 	print "Aligning Reads..."
 	print "pooling with pool size:" + str(cores)
-	aligned_tcrs = []
 
-	part_tcrs = [tcrs[i:i + 800] for i in xrange(0, len(tcrs), 800)]
-	usedjs = []
+	part_tcrs = [xrange(i, min(i + 800, len(vreads))) for i in xrange(0, len(vreads), 800)]
+	jindex = JReadIndex(jreads, 8/2)
+	pool = mp.Pool(processes=cores, initializer=init_worker, initargs=(vreads, jindex))
+	edges = []
+	aligned = 0
 
 	for t in part_tcrs:
 		if time.time() - total_time > 144000:
 			break
-		print "jreads considered:", len(jreads)
 		start = time.time()
-		pool = mp.Pool(processes=cores)
-		#results = [pool.apply(reconstruct, args=(tcr,jreads)) for tcr in tcrs[0:200]]
-		results = pool.imap(partial(reconstruct,jreads=jreads),t)
-
-		for x in results:
-			aligned_tcrs.append(x)
-		print str(len(aligned_tcrs)), "aligned"
+		results = pool.imap(reconstruct_vread, t, max(1, len(t) / (4 * cores)))
+
+		for v, ranked_alignments in results:
+			for rank in range(len(ranked_alignments)):
+				j_number, length, purity, number = ranked_alignments[rank]
+				edges.append((-length, purity, v, rank, j_number, number))
+			aligned += 1
+		print str(aligned), "aligned"
 		print time.time() - start
-		pool.close()
-
-	#tcrs = aligned_tcrs	
-	# tcrs with longest overlap alignments get priority for matching
-		print "Reconstructing 800 TCRs..."
 
-		for tcr in sorted(aligned_tcrs,key=operator.attrgetter('longest_overlap'),reverse=True):
+	pool.close()
+	pool.join()
 
-			for a in tcr.ranked_alignments:
-				if a.j_id in usedjs:
-					continue
-				else:
-					tcr.j_id = a.j_id
-					tcr.jread = a.jread
-					tcr.chosen_alignment = a
-					usedjs.append(a.j_id)
-					jreads.remove(a.jread)
-					break
+	print "Assigning J reads to V reads by", args.matching, "matching of", len(edges), "alignments..."
+	start = time.time()
+	if args.matching == 'optimal':
+		chosen = assign_optimal(edges, jreads)
+	else:
+		chosen = assign_greedy(edges, jreads)
+	print time.time() - start
 
-		# tcr.chosen_alignment = tcr.ranked_alignments[0]
-		# tcr.j_id = tcr.ranked_alignments[0].j_id
-		# tcr.jread = tcr.ranked_alignments[0].jread
-		# jreads.remove(tcr.jread)
-			if not tcr.chosen_alignment:
-				aligned_tcrs.remove(tcr)
-			else:
-				tcr.setSequence()
-
-	tcrs = aligned_tcrs
+	# Only the chosen alignments' sequences are needed, so they are only found (again) now
+	tcrs = []
+	for v in sorted(chosen):
+		negative_length, purity, v, rank, j_number, number = chosen[v]
+		tcr = tcrs_by_v[v]
+		tcr.jread = jreads[j_number]
+		tcr.j_id = tcr.jread[3]
+		tcr.chosen_alignment = (j_number, -negative_length, purity, number)
+		tcr.setSequence()
+		tcrs.append(tcr)
 
 	outfile = 'bfd_'+os.path.splitext(os.path.basename(args.filename))[0] + ".fastq"
 	print "writing to", outfile
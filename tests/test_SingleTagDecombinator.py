@@ -0,0 +1,281 @@
+# Tests for SingleTagDecombinator.py and dcrbinary.py. Run from the repository's top directory with:
+#   python -m unittest discover tests
+# The tests that decombine reads need the tag and FASTA files, and are skipped unless a Decombinator-Tags-FASTAs folder
+# is found in the repository's top directory or the one above it.
+
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+import collections as coll
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import SingleTagDecombinator as dcr
+import dcrbinary
+
+def find_tag_folder():
+  top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  for folder in [top, os.path.dirname(top)]:
+    if os.path.isdir(os.path.join(folder, "Decombinator-Tags-FASTAs")):
+      return os.path.join(folder, "Decombinator-Tags-FASTAs")
+  return None
+
+tag_folder = find_tag_folder()
+
+def random_seq(rand, length, alphabet='ACGT'):
+  return ''.join(rand.choice(alphabet) for n in range(length))
+
+def random_fastq(rand, number):
+  records = []
+  for n in range(number):
+    seq = random_seq(rand, rand.randint(1, 80), 'ACGTN')
+    records.append(('read' + str(n), seq, random_seq(rand, len(seq), 'ABCDEFGHIJ')))
+  return records
+
+def fastq_text(records):
+  return ''.join('@' + readid + ' extra\n' + seq + '\n+\n' + qual + '\n' for readid, seq, qual in records)
+
+def write_members(filename, text, rand, most=3000):
+  # Writes text gzipped as many members of random sizes, which need not end at line ends
+  with open(filename, 'wb') as f:
+    pos = 0
+    while pos < len(text):
+      size = rand.randint(1, most)
+      member = gzip.GzipFile(fileobj=f, mode='wb')
+      member.write(text[pos:pos + size])
+      member.close()
+      pos += size
+
+def random_blocks(rand, text):
+  blocks = []
+  pos = 0
+  while pos < len(text):
+    size = rand.choice([1, 2, 7, 50, 300, 5000])
+    blocks.append(text[pos:pos + size])
+    pos += size
+  return blocks
+
+class TempDirTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp(prefix='test_dcr_')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+class TestReadfqBlocks(unittest.TestCase):
+
+  def test_matches_readfq(self):
+    # Four line records split across blocks anywhere
+    rand = random.Random(1)
+    for t in range(50):
+      text = fastq_text(random_fastq(rand, rand.randint(0, 60)))
+      expected = list(dcr.readfq(iter(text.splitlines(True))))
+      self.assertEqual(list(dcr.readfq_blocks(random_blocks(rand, text))), expected)
+
+  def test_fallback_matches_readfq(self):
+    # FASTA records, multi-line records and a last line with no newline are handed over to readfq
+    rand = random.Random(2)
+    for t in range(50):
+      records = random_fastq(rand, rand.randint(1, 30))
+      text = fastq_text(records[:len(records) // 2])
+      odd = rand.choice(['>fasta\nACGT\nGGTT\n', '@multi\nACGT\nAC\n+\nABCD\nAB\n'])
+      text += odd + fastq_text(records[len(records) // 2:])
+      if rand.random() < .5:
+        text = text[:-1]
+      expected = list(dcr.readfq(iter(text.splitlines(True))))
+      self.assertEqual(list(dcr.readfq_blocks(random_blocks(rand, text))), expected)
+
+class TestGzipIndex(TempDirTestCase):
+
+  def test_ranges_cover_file(self):
+    # Reading every range, each on its own, gives all the records of the file in order
+    rand = random.Random(3)
+    for t in range(20):
+      records = random_fastq(rand, rand.randint(1, 300))
+      fqfile = os.path.join(self.tmpdir, 'reads.fq.gz')
+      write_members(fqfile, fastq_text(records), rand)
+      ranges = dcr.build_gzip_index(fqfile, chunk_bytes=rand.choice([1, 100, 2000]))
+      self.assertTrue(ranges)
+      found = []
+      for gzip_range, next_range in zip(ranges, ranges[1:] + [None]):
+        found.extend(dcr.readfq_blocks([dcr.read_gzip_range(fqfile, gzip_range, next_range)]))
+      self.assertEqual(found, records)
+
+  def test_indexed_while_read(self):
+    # read_gzip_indexing gives the same data as read_blocks
+    rand = random.Random(4)
+    text = fastq_text(random_fastq(rand, 500))
+    fqfile = os.path.join(self.tmpdir, 'reads.fq.gz')
+    write_members(fqfile, text, rand)
+    indexer = dcr.GzipIndexer(1000)
+    self.assertEqual(''.join(dcr.read_gzip_indexing(fqfile, indexer, block_size=4096)), text)
+    self.assertEqual(''.join(dcr.read_blocks(fqfile, block_size=4096)), text)
+    self.assertEqual(indexer.ranges(os.path.getsize(fqfile)), dcr.build_gzip_index(fqfile, 1000))
+
+  def test_rejects_multiline_records(self):
+    rand = random.Random(5)
+    text = fastq_text(random_fastq(rand, 200))
+    text = text.replace('\n+\n', '\n\n+\n')
+    fqfile = os.path.join(self.tmpdir, 'reads.fq.gz')
+    write_members(fqfile, text, rand, 500)
+    self.assertEqual(dcr.build_gzip_index(fqfile, 100), None)
+
+  def test_saved_index(self):
+    rand = random.Random(6)
+    fqfile = os.path.join(self.tmpdir, 'reads.fq.gz')
+    write_members(fqfile, fastq_text(random_fastq(rand, 200)), rand)
+    self.assertEqual(dcr.load_gzip_index(fqfile), None)
+    ranges = dcr.build_gzip_index(fqfile, 100)
+    dcr.save_gzip_index(fqfile, ranges)
+    self.assertEqual(dcr.load_gzip_index(fqfile), ranges)
+
+def random_records(rand, number, barcoded, distinct=None):
+  # DcrRecords with V and J indices (or n/a), sequences with the odd N, and barcodes if barcoded.
+  # With distinct, drawn from that many different rearrangements, as collapsing expects.
+  keys = None
+  if distinct:
+    keys = [(rand.choice('ab'), rand.randint(0, 3), rand.randint(0, 3), random_seq(rand, rand.randint(1, 5)),
+      random_seq(rand, 4) if barcoded else None) for n in range(distinct)]
+  records = []
+  for n in range(number):
+    if keys:
+      chain, v, j, seq, barcode = rand.choice(keys)
+    else:
+      chain = rand.choice('abgd')
+      v = rand.choice(['n/a', rand.randint(0, 150)])
+      j = rand.choice(['n/a', rand.randint(0, 70)]) if v != 'n/a' else rand.randint(0, 70)
+      seq = random_seq(rand, rand.randint(0, 90), rand.choice(['ACGT', 'ACGTN']))
+      barcode = random_seq(rand, 30, 'ACGTN') if barcoded else None
+    records.append(dcr.DcrRecord(chain, v, j, 'read' + str(n) * rand.randint(0, 3), seq, random_seq(rand, len(seq), 'ABCDEFGHIJ'),
+      rand.randint(0, 90), barcode, random_seq(rand, len(barcode), 'ABCDEFGHIJ') if barcoded else None))
+  return records
+
+class TestDcrBinary(TempDirTestCase):
+
+  def test_round_trip(self):
+    rand = random.Random(7)
+    for barcoded in [False, True]:
+      for extension in ['.dcrb', '.dcrb.gz']:
+        records = random_records(rand, 500, barcoded)
+        filename = os.path.join(self.tmpdir, 'out' + extension)
+        outfile = gzip.open(filename, 'wb') if extension.endswith('.gz') else open(filename, 'wb')
+        with dcrbinary.DcrBinaryWriter(outfile, barcoded, chunk_size=64) as writer:
+          writer.write_records(records)
+        self.assertEqual(list(dcrbinary.read_records(filename)), [tuple(record) for record in records])
+
+  def test_empty(self):
+    filename = os.path.join(self.tmpdir, 'out.dcrb')
+    dcrbinary.DcrBinaryWriter(open(filename, 'wb'), False).close()
+    self.assertEqual(list(dcrbinary.read_records(filename)), [])
+
+  def test_rejects_other_files(self):
+    filename = os.path.join(self.tmpdir, 'out.n12')
+    with open(filename, 'w') as f:
+      f.write('a, 1, 2, read, ACGT, IIII\n')
+    self.assertRaises(IOError, list, dcrbinary.read_records(filename))
+
+class TestDcrCollapser(unittest.TestCase):
+
+  def test_spills_match_in_memory(self):
+    # A tiny max_keys spills many runs, which must merge back into the same counts
+    rand = random.Random(8)
+    for barcoded in [False, True]:
+      records = random_records(rand, 3000, barcoded, distinct=200)
+      if barcoded:
+        expected = coll.Counter((r.chain, r.v, r.j, r.seq, r.barcode) for r in records)
+      else:
+        expected = coll.Counter((r.chain, r.v, r.j, r.seq) for r in records)
+      for max_keys, block_size in [(10 ** 6, 10000), (5, 2), (50, 7)]:
+        collapser = dcr.DcrCollapser(max_keys, barcoded, block_size)
+        collapser.add_records(records)
+        self.assertEqual(len(collapser.runs) > 0, max_keys < 200)
+        self.assertEqual(list(collapser.collapsed()), sorted(expected.items()))
+        collapser.close()
+
+  def test_binary_rejected(self):
+    self.assertRaises(ValueError, dcr.main, dcr.default_inputargs(chain='a', collapse=True, binary=True))
+
+class TestBackgroundGzipWriter(TempDirTestCase):
+
+  def test_round_trip(self):
+    rand = random.Random(9)
+    pieces = [random_seq(rand, rand.randint(0, 3000)) for n in range(300)]
+    filename = os.path.join(self.tmpdir, 'out.gz')
+    with dcr.BackgroundGzipWriter(filename, chunk_size=4096, queue_size=2) as writer:
+      for piece in pieces:
+        writer.write(piece)
+    self.assertEqual(gzip.open(filename).read(), ''.join(pieces))
+
+@unittest.skipIf(tag_folder is None, "Needs a Decombinator-Tags-FASTAs folder")
+class TestDecombining(TempDirTestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    import SingleTagBenchmark
+    cls.settings = dict(chain='a b', nobarcoding=True, orientation='both', tagfastadir=tag_folder, offline=True, dontcount=True)
+    cls.tags = dcr.import_tcr_info(dcr.default_inputargs(**cls.settings))
+    benchargs = vars(SingleTagBenchmark.args(['-c', 'a b', '-tfdir', tag_folder, '-off', '-rv', '0.5'])[0])
+    cls.reads = [read[:3] for read in SingleTagBenchmark.synthesise_reads(cls.tags, benchargs, 2000, 1)]
+
+  def decombine(self, **settings):
+    inputargs = dict(self.settings)
+    inputargs.update(settings)
+    decombiner = dcr.Decombiner(dcr.default_inputargs(**inputargs), self.tags)
+    return list(decombiner.decombine(self.reads, formatted=False)), decombiner.counts
+
+  def test_cache_matches_uncached(self):
+    # Repeat reads replay the counts of their first decombining
+    records, counts = self.decombine(cachesize=0)
+    cached_records, cached_counts = self.decombine(cachesize=100)
+    self.assertTrue(records)
+    self.assertEqual(cached_records, records)
+    self.assertTrue(cached_counts.pop('cache_hits') > 0)
+    cached_counts.pop('cache_misses')
+    self.assertEqual(cached_counts, counts)
+
+  def test_single_scan_matches(self):
+    for orientation in ['forward', 'reverse', 'either', 'both']:
+      records, counts = self.decombine(orientation=orientation, cachesize=0)
+      self.assertEqual(self.decombine(orientation=orientation, cachesize=0, singlescan=True), (records, counts))
+
+  def test_binary_matches_records(self):
+    records, counts = self.decombine()
+    filename = os.path.join(self.tmpdir, 'out.dcrb')
+    with dcrbinary.DcrBinaryWriter(open(filename, 'wb'), False) as writer:
+      writer.write_records(records)
+    self.assertEqual(list(dcrbinary.read_records(filename)), [tuple(record) for record in records])
+
+  def test_collapse_spills_match(self):
+    # The whole run, with --collapsekeys small enough to spill, gives the same .freq file
+    fqfile = os.path.join(self.tmpdir, 'reads.fq')
+    with open(fqfile, 'w') as f:
+      f.write(fastq_text(self.reads))
+    outputs = []
+    for collapsekeys in [10 ** 6, 3]:
+      inputargs = dcr.default_inputargs(fastq=fqfile, collapse=True, collapsekeys=collapsekeys, dontgzip=True, suppresssummary=True,
+        prefix=os.path.join(self.tmpdir, str(collapsekeys) + '_'), **self.settings)
+      with open(dcr.main(inputargs)) as f:
+        outputs.append(f.read())
+    self.assertTrue(outputs[0])
+    self.assertEqual(outputs[1], outputs[0])
+
+  def test_tag_variants_match_window_scan(self):
+    # find_variants finds the same variants as checking every window of the read
+    rand = random.Random(10)
+    tags = dcr.import_tcr_info(dcr.default_inputargs(tagvariants=True, tagthreshold=1, **self.settings))
+    lengths = dict((gene, sorted(set(map(len, tags.variant_to_indices[gene])))) for gene in 'vj')
+    for readid, seq, qual in self.reads[:300]:
+      for gene in 'vj':
+        tag = list(rand.choice(tags.seqs[gene]))
+        tag[rand.randrange(len(tag))] = rand.choice('ACGTN')
+        for read in [seq, seq[:30] + ''.join(tag) + seq[30:]]:
+          expected = sorted(((read[pos:pos + length], pos) for length in lengths[gene] for pos in range(len(read) - length + 1)
+            if read[pos:pos + length] in tags.variant_to_indices[gene]), key=lambda match: match[1])
+          self.assertEqual(tags.find_variants(read, gene, tags.scan(read)), expected)
+
+if __name__ == '__main__':
+  unittest.main()
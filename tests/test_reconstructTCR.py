@@ -0,0 +1,144 @@
+# Tests for reconstructTCR.py. Run from the repository's top directory with:
+#   python -m unittest discover tests
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import reconstructTCR
+
+try:
+	from Bio import pairwise2
+except ImportError:
+	pairwise2 = None
+
+def jread(chain, j_id, seq):
+	return (chain, 'n/a', 1, j_id, seq)
+
+def vread(chain, v_id, seq):
+	return (chain, 1, 'n/a', v_id, seq)
+
+def mutate(seq, alphabet, edits, rand):
+	seq = list(seq)
+	for e in range(edits):
+		p = rand.randrange(len(seq) + 1)
+		r = rand.random()
+		if r < .4 and p < len(seq):
+			seq[p] = rand.choice(alphabet)
+		elif r < .7:
+			seq.insert(p, rand.choice(alphabet))
+		elif p < len(seq):
+			del seq[p]
+	return ''.join(seq)
+
+class TestOverlapAlignments(unittest.TestCase):
+
+	@unittest.skipIf(pairwise2 is None, "Biopython is needed to compare with pairwise2")
+	def test_matches_pairwise2(self):
+		# overlapAlignments should give exactly the alignments (in order) that align used to keep from pairwise2
+		rand = random.Random(22)
+		for t in range(5000):
+			alphabet = rand.choice(['AC', 'ACG', 'ACGT', 'ACGTN'])
+			length = rand.choice([1, 2, 3, 5, 8, 8, 8, 12, 20, 30, 45])
+			a = ''.join(rand.choice(alphabet) for n in range(length))
+			if rand.random() < .8:
+				b = mutate(a, alphabet, rand.choice([0, 1, 1, 2, 2, 3, 4, 6]), rand)
+			else:
+				b = ''.join(rand.choice(alphabet) for n in range(rand.choice([length, length + 1, length + 2, max(length - 1, 1)])))
+			if rand.random() < .5:
+				a, b = b, a
+			expected = [k for k in pairwise2.align.globalms(a, b, 1, 0, -.5, -0.1)
+				if ( k[4] - k[2] < 3 ) or ( k[4] - k[2] == 3 and "-" in k[1] )]
+			self.assertEqual(reconstructTCR.overlapAlignments(a, b), expected, (a, b))
+
+	def test_reverse_trace(self):
+		# Swapping the two sequences swaps the gap traces (1 <-> 4, 8 <-> 16), keeping the match trace (2)
+		for trace, reverse in reconstructTCR.reverse_trace.items():
+			self.assertEqual(reverse & 2, trace & 2)
+			self.assertEqual((reverse & 1, reverse & 8), ((trace & 4) / 4, (trace & 16) / 2))
+			self.assertEqual(reconstructTCR.reverse_trace[reverse], trace)
+
+class TestJReadIndex(unittest.TestCase):
+
+	def test_chain_without_j_reads(self):
+		# V reads of a chain with no J reads (or with no J reads at all) have no candidates
+		jreads = [jread('b', 'j0', 'ACGTACGTTTGACCATGGCA' + 'G' * 20)]
+		jindex = reconstructTCR.JReadIndex(jreads, 4)
+		self.assertEqual(jindex.candidateNumbers('GGGGACGTACGT', 'a', 8), ([], []))
+		self.assertEqual(reconstructTCR.JReadIndex([], 4).candidateNumbers('GGGGACGTACGT', 'a', 8), ([], []))
+
+		reconstructTCR.init_worker([vread('a', 'v0', 'GGGGACGTACGT')], jindex)
+		self.assertEqual(reconstructTCR.reconstruct_vread(0), (0, []))
+
+class TestAssignment(unittest.TestCase):
+
+	def random_graph(self, rand):
+		# Edges are (-length, purity, V read number, rank, J read number, alignment number), as built in main.
+		# Some J reads share an id, as repeated J reads do
+		nv, nj = rand.randint(1, 7), rand.randint(1, 7)
+		jreads = [jread('a', 'j%d' % rand.randint(0, nj), 'ACGT') for n in range(nj)]
+		edges = []
+		for v in range(nv):
+			for rank in range(rand.randint(0, 5)):
+				edges.append((-rand.randint(8, 14), rand.choice([0, 0.5, 1, 1.5, 2, 2.6, 3]), v, rank, rand.randrange(nj), 0))
+		return edges, jreads
+
+	def best_total(self, edges, jreads):
+		# The greatest total edge_weight of any matching of V reads to J read ids, by brute force over the V reads
+		best = {}
+		for edge in edges:
+			key = (edge[2], jreads[edge[4]][3])
+			best[key] = max(best.get(key, 0), reconstructTCR.edge_weight(edge))
+		vs = sorted(set(edge[2] for edge in edges))
+		memo = {}
+		def total(i, used):
+			if i == len(vs):
+				return 0
+			if (i, used) not in memo:
+				memo[(i, used)] = max([total(i + 1, used)] + [weight + total(i + 1, used | set([j_id]))
+					for (v, j_id), weight in best.items() if v == vs[i] and j_id not in used])
+			return memo[(i, used)]
+		return total(0, frozenset())
+
+	def check_assignment(self, chosen, edges, jreads):
+		# Each V read is given one of its own edges, and no J read id is given twice
+		self.assertTrue(all(edge in edges and edge[2] == v for v, edge in chosen.items()))
+		j_ids = [jreads[edge[4]][3] for edge in chosen.values()]
+		self.assertEqual(len(j_ids), len(set(j_ids)))
+
+	def test_optimal_matches_brute_force(self):
+		rand = random.Random(25)
+		for t in range(1000):
+			edges, jreads = self.random_graph(rand)
+			chosen = reconstructTCR.assign_optimal(edges, jreads)
+			self.check_assignment(chosen, edges, jreads)
+			self.assertEqual(sum(map(reconstructTCR.edge_weight, chosen.values())), self.best_total(edges, jreads), edges)
+
+	def test_greedy(self):
+		rand = random.Random(25)
+		for t in range(1000):
+			edges, jreads = self.random_graph(rand)
+			chosen = reconstructTCR.assign_greedy(edges, jreads)
+			self.check_assignment(chosen, edges, jreads)
+			# The same whatever order the edges come in (such as from different numbers of workers)
+			shuffled = list(edges)
+			rand.shuffle(shuffled)
+			self.assertEqual(reconstructTCR.assign_greedy(shuffled, jreads), chosen)
+			# No edge left out could have been taken instead of a later (shorter, or less pure) one
+			used = dict((jreads[edge[4]][3], edge) for edge in chosen.values())
+			for edge in edges:
+				j_id = jreads[edge[4]][3]
+				if edge[2] not in chosen:
+					self.assertTrue(j_id in used and used[j_id] < edge)
+				elif j_id not in used:
+					self.assertTrue(chosen[edge[2]] < edge)
+
+		# Longest overlap first, then purest
+		jreads = [jread('a', 'j0', 'ACGT'), jread('a', 'j1', 'ACGT')]
+		edges = [(-10, 0, 0, 0, 0, 0), (-12, 2, 1, 0, 0, 0), (-12, 1, 2, 0, 0, 0), (-9, 0, 1, 1, 1, 0)]
+		self.assertEqual(reconstructTCR.assign_greedy(edges, jreads), {2: edges[2], 1: edges[3]})
+
+if __name__ == '__main__':
+	unittest.main()